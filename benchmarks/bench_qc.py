@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Time and memory of the QC reports on synthetic subjects of several sizes.
+
+For every size a synthetic subject is generated (make_fixture.py, cached in
+the work directory) and each report runs in its own process, so its peak RSS
+is not polluted by the other reports. Each report is split in stages:
+
+    load     bval/bvec files, brain mask and tissue ROIs (shared inputs)
+    compute  the report's own reads (4D series streamed, eddy text tables)
+             and statistics
+    table    appending the subject to the group store (and cohort statistics)
+    render   plotting and saving the report
+
+plus the tensor fit (tensorfit, fit + save) that replaces dtifit. One JSON
+record per stage is appended to the output file, with the wall and CPU
+time of the stage and the peak RSS of the process at the end of it.
+
+    python benchmarks/bench_qc.py --sizes 96x96x60x32,112x112x72x300 -o bench.jsonl
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'plotting'))
+
+from make_fixture import make_fixture, parse_size
+
+REPORTS = ['tensorfit', 'dti', 'motion', 'outliers']
+SIZES = '96x96x60x32,96x96x60x100,112x112x72x300'
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss/(1024*1024) if sys.platform == 'darwin' else rss/1024
+
+
+class StageTimer:
+    """Collect wall/CPU time and peak RSS of consecutive stages."""
+
+    def __init__(self, **fields):
+        self.fields = fields
+        self.records = []
+
+    def run(self, stage, func, *args):
+        t0, c0 = time.perf_counter(), time.process_time()
+        out = func(*args)
+        self.records.append(dict(self.fields, stage=stage,
+                                 wall_s=round(time.perf_counter()-t0, 4),
+                                 cpu_s=round(time.process_time()-c0, 4),
+                                 peak_rss_mb=round(peak_rss_mb(), 1)))
+        return out
+
+
+def fixture(workdir, size, compress):
+    """Path of the synthetic subject for size, generated on first use."""
+    out = os.path.join(workdir, size+('' if compress else '_nii'))
+    done = os.path.join(out, '.complete')
+    if not os.path.isfile(done):
+        shape, nvols = parse_size(size)
+        print('Generating', out)
+        make_fixture(out, shape, nvols, compress=compress)
+        open(done, 'w').close()
+    return out
+
+
+def report_argv(fix, outdir):
+    """qc_reports.py command line for the synthetic subject."""
+    qc = os.path.join(fix, 'qc')
+    data = [f for f in ['dwi.nii.gz', 'dwi.nii'] if os.path.isfile(os.path.join(fix, f))][0]
+    return [qc, 'BENCH', os.path.join(qc, 'bvals'), os.path.join(fix, data),
+            '--bvecs', os.path.join(qc, 'bvecs'),
+            '--gm_mask', os.path.join(qc, 'synthseg', 'cortex_mask.nii.gz'),
+            '--csf_mask', os.path.join(qc, 'synthseg', 'ventricles_mask.nii.gz'),
+            '--eddy_dir', os.path.join(fix, 'eddy'), '--pdfdir', outdir, '--group_dir', outdir,
+            '--cache_dir', os.path.join(outdir, 'eddy_cache')]
+
+
+def worker(report, fix, outdir, size):
+    """Run one report on the synthetic subject, return the stage records."""
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    from qcinputs import QCInputs
+    import qc_reports
+    timer = StageTimer(size=size, report=report)
+    dargs = qc_reports.get_parser().parse_args(report_argv(fix, outdir))
+    inputs = QCInputs()
+    if report == 'tensorfit':
+        import nibabel as nib
+        import tensorfit
+        from niftiio import load_mask
+        bval, bvec, mask = timer.run('load', lambda: (inputs.bvals(dargs.bvals), inputs.bvecs(dargs.bvecs),
+                                                      load_mask(os.path.join(dargs.qcdir, 'lowb_brain_mask.nii.gz'))))
+        result = timer.run('compute', tensorfit.fit, dargs.data, bval, bvec, mask)
+        timer.run('save', tensorfit.save, result, nib.load(dargs.data).slicer[..., 0],
+                  os.path.join(outdir, 'dtifit'))
+        return timer.records
+    if report == 'dti':
+        import noeddyqc as module
+    elif report == 'motion':
+        import qc_motion as module
+    else:
+        import qc_ol as module
+    from groupstore import GroupStore
+    args = module.get_parser().parse_args(qc_reports.report_args(dargs)[report])
+    timer.run('load', lambda: (inputs.bvals(dargs.bvals), inputs.mask(os.path.join(dargs.qcdir, 'lowb_brain_mask.nii.gz')),
+                               inputs.rois(os.path.join(dargs.qcdir, 'wm_mask.nii.gz'), dargs.gm_mask, dargs.csf_mask)))
+    m = timer.run('compute', module.compute, args, inputs)
+    m['cohort'] = timer.run('table', lambda: GroupStore(args.txt_output).append(module.group_row(m, args.subj)))
+    timer.run('render', module.render, m, args)
+    return timer.records
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Benchmark the QC reports on synthetic subjects')
+    parser.add_argument('--sizes', default=SIZES,
+                        help='Comma-separated NXxNYxNZxNVOLS. Default: '+SIZES)
+    parser.add_argument('--reports', default=','.join(REPORTS),
+                        help='Comma-separated reports to run. Default: '+','.join(REPORTS))
+    parser.add_argument('-w', '--workdir', default='bench_data',
+                        help='Directory of the synthetic subjects and report outputs. Default: bench_data')
+    parser.add_argument('-o', '--output', default='bench_qc.jsonl', help='JSON-lines results. Default: bench_qc.jsonl')
+    parser.add_argument('-r', '--repeat', type=int, default=1, help='Runs per report and size. Default: 1')
+    parser.add_argument('--uncompressed', action='store_true', help='Use .nii instead of .nii.gz series')
+    parser.add_argument('--worker', nargs=4, metavar=('REPORT', 'FIXTURE', 'OUTDIR', 'RESULT'),
+                        help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    if args.worker:
+        report, fix, outdir, result = args.worker
+        records = worker(report, fix, outdir, os.path.basename(fix))
+        with open(result, 'w') as f:
+            json.dump(records, f)
+        return 0
+
+    reports = args.reports.split(',')
+    with open(args.output, 'a') as out:
+        for size in args.sizes.split(','):
+            fix = fixture(args.workdir, size, not args.uncompressed)
+            for report in reports:
+                for rep in range(args.repeat):
+                    outdir = os.path.join(args.workdir, 'out_'+os.path.basename(fix), report)
+                    shutil.rmtree(outdir, ignore_errors=True)
+                    os.makedirs(outdir)
+                    result = os.path.join(outdir, 'stages.json')
+                    with open(os.path.join(outdir, 'log.txt'), 'w') as log:
+                        subprocess.run([sys.executable, os.path.abspath(__file__), '--worker',
+                                        report, fix, outdir, result], stdout=log, stderr=subprocess.STDOUT,
+                                       check=True)
+                    with open(result) as f:
+                        records = json.load(f)
+                    for r in records:
+                        r['repeat'] = rep
+                        out.write(json.dumps(r)+'\n')
+                        print('{size:>16} {report:>10} {stage:>8} {wall_s:9.3f}s cpu {cpu_s:9.3f}s '
+                              'peak {peak_rss_mb:8.1f} MB'.format(**r))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
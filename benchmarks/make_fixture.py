@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Synthetic subject for the QC benchmarks.
+
+Writes a DWI series simulated from a known tensor field (ellipsoid brain
+with WM, cortex and ventricles), and the files dwi_qa.sh would have produced
+for it, laid out like a dwi_qa.sh output directory:
+
+    <out>/dwi.nii[.gz], dwi.bval, dwi.bvec        input series (FSL gradients)
+    <out>/qc/bvals, bvecs, lowb_brain_mask, wm_mask, synthseg/*_mask
+    <out>/qc/dtifit/dtifit_*                      plotting/tensorfit.py outputs
+    <out>/qc/bzeros_snr, tsnr_orig.txt, cnrwm.txt
+    <out>/eddy/eddy_unwarped.eddy_*               eddy text outputs, residuals, CNR maps
+
+Only numpy and nibabel are needed (no FSL, FreeSurfer or MRtrix).
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import nibabel as nib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plotting'))
+import tensorfit
+from niftiio import VolumeWriter, load_mask
+
+# tissue: (FA, MD [mm^2/s], S0)
+TISSUES = {'WM': (0.65, 0.7e-3, 900.), 'GM': (0.15, 0.85e-3, 1100.), 'CSF': (0.05, 3.0e-3, 2000.)}
+NOISE = 20.
+EDDY = 'eddy_unwarped'
+
+
+def parse_size(text):
+    """'96x96x60x32' -> ((96, 96, 60), 32)."""
+    dims = [int(d) for d in text.lower().split('x')]
+    if len(dims) != 4:
+        raise argparse.ArgumentTypeError('size must be NXxNYxNZxNVOLS, got '+text)
+    return tuple(dims[:3]), dims[3]
+
+
+def gradients(nvols, shells, nb0, rng):
+    """b-values (b0s spread through the series) and unit gradient directions."""
+    ndw = nvols-nb0
+    bval = np.zeros(nvols)
+    dw = np.setdiff1d(np.arange(nvols), np.linspace(0, nvols-1, nb0).round().astype(int))
+    bval[dw] = np.repeat(shells, int(np.ceil(ndw/len(shells))))[:ndw]
+    bvec = rng.normal(size=(nvols, 3))
+    bvec /= np.linalg.norm(bvec, axis=1)[:, None]
+    bvec[bval == 0] = 0
+    return bval, bvec
+
+
+def tissue_labels(shape):
+    """Ellipsoid brain: ventricles in the centre, WM, then a cortical rim."""
+    grid = np.indices(shape, dtype=np.float32)
+    r = np.sqrt(sum(((g-(n-1)/2)/(0.42*n))**2 for g, n in zip(grid, shape)))
+    labels = np.zeros(shape, dtype=np.uint8)
+    labels[r < 1] = 2     # GM
+    labels[r < 0.85] = 1  # WM
+    labels[r < 0.25] = 3  # CSF
+    return labels
+
+
+def tensors(labels, rng):
+    """Tensor components (n, 6), S0 and true FA/MD of the brain voxels."""
+    lab = labels.ravel(order='F')
+    index = np.flatnonzero(lab)
+    lab = lab[index]
+    n = index.size
+    fa, md, s0 = [np.array([TISSUES[t][k] for t in ['WM', 'GM', 'CSF']])[lab-1] for k in range(3)]
+    fa = np.clip(fa+rng.normal(0, 0.05, n), 0.01, 0.95)
+    # prolate tensor with the requested FA and MD: l1 = md(1+2a), l2 = l3 = md(1-a)
+    a = fa/np.sqrt(3-2*fa**2)
+    l1, l2 = md*(1+2*a), md*(1-a)
+    v1 = rng.normal(size=(n, 3))
+    v1 /= np.linalg.norm(v1, axis=1)[:, None]
+    d = l2[:, None, None]*np.eye(3)+(l1-l2)[:, None, None]*v1[:, :, None]*v1[:, None, :]
+    comps = d[:, [0, 0, 0, 1, 1, 2], [0, 1, 2, 1, 2, 2]]
+    return index, comps, s0
+
+
+def write_dwi(out, shape, affine, bval, bvec, index, comps, s0, rng):
+    """Simulate the series one volume at a time, yielding (i, brain signal)."""
+    nvols = bval.size
+    nvox = int(np.prod(shape))
+    X = tensorfit.design_matrix(bval, bvec)
+    ref = nib.Nifti1Image(np.zeros(shape, np.int16), affine)
+    signal = np.zeros(nvox, dtype=np.float32)
+    with VolumeWriter(out, ref, nvols, np.int16) as w:
+        for i in range(nvols):
+            s = s0*np.exp(comps @ X[i, 1:])
+            # Rician noise in the brain, Rayleigh background
+            s = np.hypot(s+rng.normal(0, NOISE, s.size), rng.normal(0, NOISE, s.size))
+            signal[:] = np.hypot(rng.normal(0, NOISE, nvox), rng.normal(0, NOISE, nvox))
+            signal[index] = s
+            w.write(signal.reshape(shape, order='F').round())
+            yield i, s
+
+
+def make_fixture(out, shape=(96, 96, 60), nvols=32, shells=(1000, 2000), nb0=None,
+                 compress=True, seed=0):
+    """Write a synthetic subject in out; returns the path of the DWI series."""
+    rng = np.random.default_rng(seed)
+    nb0 = nb0 or max(1, nvols//10)
+    qc = os.path.join(out, 'qc')
+    for d in ['dtifit', 'synthseg']:
+        os.makedirs(os.path.join(qc, d), exist_ok=True)
+    os.makedirs(os.path.join(out, 'eddy'), exist_ok=True)
+    affine = np.diag([2., 2., 2., 1.])
+    save = lambda data, path: nib.save(nib.Nifti1Image(data, affine), path)
+
+    bval, bvec = gradients(nvols, shells, nb0, rng)
+    np.savetxt(os.path.join(out, 'dwi.bval'), bval[None], fmt='%g')
+    np.savetxt(os.path.join(out, 'dwi.bvec'), bvec.T, fmt='%.6f')
+    np.savetxt(os.path.join(qc, 'bvals'), bval, fmt='%g')
+    np.savetxt(os.path.join(qc, 'bvecs'), bvec, fmt='%.6f')
+
+    labels = tissue_labels(shape)
+    save((labels > 0).astype(np.uint8), os.path.join(qc, 'lowb_brain_mask.nii.gz'))
+    save((labels == 1).astype(np.uint8), os.path.join(qc, 'wm_mask.nii.gz'))
+    save((labels == 2).astype(np.uint8), os.path.join(qc, 'synthseg', 'cortex_mask.nii.gz'))
+    save((labels == 3).astype(np.uint8), os.path.join(qc, 'synthseg', 'ventricles_mask.nii.gz'))
+    index, comps, s0 = tensors(labels, rng)
+    wm = labels.ravel(order='F')[index] == 1
+
+    dwi = os.path.join(out, 'dwi.nii.gz' if compress else 'dwi.nii')
+    cnrwm = np.zeros((nvols, 2))
+    b0_sum = np.zeros(index.size)
+    b0_sq = np.zeros(index.size)
+    for i, s in write_dwi(dwi, shape, affine, bval, bvec, index, comps, s0, rng):
+        cnrwm[i] = s[wm].mean(), s[wm].std()
+        if bval[i] == 0:
+            b0_sum += s
+            b0_sq += s*s
+    np.savetxt(os.path.join(qc, 'cnrwm.txt'), cnrwm, fmt='%.6f')
+    b0_mean = b0_sum/nb0
+    tsnr = b0_mean/np.sqrt(np.maximum(b0_sq/nb0-b0_mean**2, 1e-6))
+    vol = np.zeros(int(np.prod(shape)), dtype=np.float32)
+    vol[index] = tsnr
+    save(vol.reshape(shape, order='F'), os.path.join(qc, 'bzeros_snr.nii.gz'))
+    np.savetxt(os.path.join(qc, 'tsnr_orig.txt'), [[tsnr.mean(), tsnr.std()]], fmt='%.6f')
+
+    # tensor fit with the pipeline's own code
+    mask = os.path.join(qc, 'lowb_brain_mask.nii.gz')
+    fit = tensorfit.fit(dwi, bval, bvec, load_mask(mask))
+    tensorfit.save(fit, nib.load(mask), os.path.join(qc, 'dtifit', 'dtifit'))
+
+    write_eddy(os.path.join(out, 'eddy', EDDY), shape, affine, bval, index, rng)
+    return dwi
+
+
+def write_eddy(prefix, shape, affine, bval, index, rng):
+    """eddy text outputs, residuals and CNR maps."""
+    nvols = bval.size
+    nslices = shape[2]
+    nvox = int(np.prod(shape))
+    drift = np.cumsum(rng.normal(0, 0.05, (nvols, 6)), axis=0)
+    params = np.zeros((nvols, 16))
+    params[:, :6] = drift
+    params[:, 6:9] = rng.normal(0, 0.002, (nvols, 3))
+    np.savetxt(prefix+'.eddy_parameters', params, fmt='%.8e')
+    s2v = np.repeat(drift, nslices, axis=0)+rng.normal(0, 0.05, (nvols*nslices, 6))
+    s2v[:, 3:] = np.deg2rad(s2v[:, 3:])
+    np.savetxt(prefix+'.eddy_movement_over_time', s2v, fmt='%.8e')
+    rms = np.abs(drift[:, :3]).sum(axis=1)
+    rel = np.r_[0, np.abs(np.diff(rms))]
+    np.savetxt(prefix+'.eddy_movement_rms', np.c_[rms, rel], fmt='%.8e')
+    np.savetxt(prefix+'.eddy_restricted_movement_rms', 0.5*np.c_[rms, rel], fmt='%.8e')
+    nstd = rng.normal(0, 1.2, (nvols, nslices))
+    nstd[bval == 0] = 0
+    with open(prefix+'.eddy_outlier_n_stdev_map', 'w') as f:
+        f.write('One row per scan, one column per slice. b0-scans included.\n')
+        np.savetxt(f, nstd, fmt='%.4f')
+    with open(prefix+'.eddy_outlier_map', 'w') as f:
+        f.write('One row per scan, one column per slice. Outlier: 1, Non-outlier: 0\n')
+        np.savetxt(f, (nstd < -4).astype(int), fmt='%d')
+
+    ref = nib.Nifti1Image(np.zeros(shape, np.float32), affine)
+    vol = np.zeros(nvox, dtype=np.float32)
+    with VolumeWriter(prefix+'.eddy_residuals.nii.gz', ref, nvols) as w:
+        for i in range(nvols):
+            vol[index] = rng.normal(0, NOISE, index.size)
+            w.write(vol.reshape(shape, order='F'))
+    shells = np.unique(bval)
+    with VolumeWriter(prefix+'.eddy_cnr_maps.nii.gz', ref, shells.size) as w:
+        for b in shells:
+            vol[index] = rng.gamma(4, 5 if b == 0 else 2, index.size)
+            w.write(vol.reshape(shape, order='F'))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Write a synthetic subject for the QC benchmarks')
+    parser.add_argument('out', help='Output directory')
+    parser.add_argument('--size', type=parse_size, default=parse_size('96x96x60x32'),
+                        help='NXxNYxNZxNVOLS. Default: 96x96x60x32')
+    parser.add_argument('--shells', default='1000,2000', help='Comma-separated b-values. Default: 1000,2000')
+    parser.add_argument('--nb0', type=int, default=None, help='Number of b0 volumes. Default: nvols/10')
+    parser.add_argument('--uncompressed', action='store_true', help='Write dwi.nii instead of dwi.nii.gz')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    shape, nvols = args.size
+    print(make_fixture(args.out, shape, nvols, [float(b) for b in args.shells.split(',')],
+                       args.nb0, not args.uncompressed, args.seed))
+
+
+if __name__ == '__main__':
+    main()
@@ -29,7 +29,23 @@ echo "-e   path to eddy output folder"
 echo "-g   performs MRtrix gradients check"
 echo "-s   provide subject id"
 echo "-f   specify threshold for WM mask. Default=0.2"
+echo "-R   save 4D DTIFIT residuals (dtifit/dtifit_residuals.nii.gz)"
 echo "-q	  specify directory group QC outputs"
+echo "-F   force re-run of stages: all or comma-separated stage names"
+echo "     (--force is the same as -F all). By default stages whose inputs,"
+echo "     command and tool versions are unchanged are skipped"
+echo "-n   number of threads used by all the stages together (--nthreads)."
+echo "     Default: \$DWIQAC_NTHREADS or all cores"
+echo "-w   scratch directory for the intermediate files (--scratch), e.g."
+echo "     \$TMPDIR or /dev/shm. They are written uncompressed and removed"
+echo "     at the end; only the QC outputs are written to the output directory"
+echo "-p   preview (--preview): one-page report in reports/qc_preview.pdf from"
+echo "     the b0s, a few volumes per shell and the central slices, with"
+echo "     threshold masks. A full run removes it"
+echo "-m   multiband factor (--mb_factor): within-volume motion across"
+echo "     excitation groups in the motion report. Default=1"
+echo "-l   eddy slspec file (--slspec), one row of slices per excitation."
+echo "     Overrides -m"
 }
 ######## Checking args ###############################
 NO_ARGS=0
@@ -38,8 +54,27 @@ if [ $# -eq "$NO_ARGS" ]; then
     echo "USAGE: $0 -h for help"
     exit 1
 fi
+######## Long options ##################################
+args=()
+for arg in "$@"; do
+	case $arg in
+	   --force) args+=("-F" "all");;
+	   --force=*) args+=("-F" "${arg#--force=}");;
+	   --nthreads) args+=("-n");;
+	   --nthreads=*) args+=("-n" "${arg#--nthreads=}");;
+	   --scratch) args+=("-w");;
+	   --scratch=*) args+=("-w" "${arg#--scratch=}");;
+	   --preview) args+=("-p");;
+	   --mb_factor) args+=("-m");;
+	   --mb_factor=*) args+=("-m" "${arg#--mb_factor=}");;
+	   --slspec) args+=("-l");;
+	   --slspec=*) args+=("-l" "${arg#--slspec=}");;
+	   *) args+=("$arg");;
+	esac
+done
+set -- "${args[@]}"
 ######## Checking options ##############################
-while getopts "he:o:b:r:i:gs:q:f:" option; do
+while getopts "he:o:b:r:i:gs:q:f:F:Rn:w:pm:l:" option; do
 	case $option in
 	   h) # display Help
 	      Help
@@ -65,12 +100,50 @@ while getopts "he:o:b:r:i:gs:q:f:" option; do
 	      fgrp=${OPTARG};;
 	   f) #Threshold WM mask
 	      thr=${OPTARG};;
+	   R) #Save 4D tensor residuals
+	      saveres=1;;
+	   F) #Force re-run of stages
+	      FORCE=${OPTARG};;
+	   n) #Thread budget
+	      nthreads=${OPTARG};;
+	   w) #Scratch directory
+	      scratch=${OPTARG};;
+	   p) #Preview on a subset
+	      preview=1;;
+	   m) #Multiband factor
+	      mb=${OPTARG};;
+	   l) #Slice order per excitation (eddy slspec)
+	      slspec=${OPTARG};;
   	esac
 done
 
 codedir=`realpath $0`
 codedir=`dirname $codedir`
 echo $codedir
+source $codedir/utils/stages.sh
+############### Thread budget ##########################
+# shared by the stages running in parallel; every stage gets its share in
+# the OpenMP/BLAS/ITK/MRtrix thread variables (utils/stages.sh)
+nthreads=${nthreads:-${DWIQAC_NTHREADS:-`nproc`}}
+if ! [[ $nthreads =~ ^[1-9][0-9]*$ ]]; then
+	echo "ERROR: number of threads must be a positive integer"
+	exit 1
+fi
+export DWIQAC_NTHREADS=$nthreads
+set_threads $nthreads
+echo "Using $nthreads threads"
+############### Multiband ##############################
+if [[ $mb ]] && ! [[ $mb =~ ^[1-9][0-9]*$ ]]; then
+	echo "ERROR: multiband factor must be a positive integer"
+	exit 1
+fi
+if [[ $slspec ]]; then
+	if [[ ! -f $slspec ]]; then
+		echo "ERROR: slspec file not found"
+		exit 1
+	fi
+	slspec=`realpath $slspec`
+fi
 #########################################################
 ################### Check FSL/FS/MRTRIX #################
 if ! command -v mrinfo &> /dev/null; then
@@ -134,9 +207,55 @@ else
 	outdir=$wdir/dwi_qa
 	mkdir -p $outdir
 fi
+############### Scratch directory ######################
+# intermediates (b0 series, SynthSeg labels, gradient rows) go to a private
+# folder in the scratch directory as uncompressed NIfTI, or to the output
+# directory (gzipped) without one
+SCRATCHDIR=""
+if [[ $scratch ]]; then
+	if [[ ! -d $scratch ]]; then
+		echo "ERROR: Scratch directory does not exist"
+		exit 1
+	fi
+	SCRATCHDIR=`mktemp -d \`realpath $scratch\`/dwiqac.XXXXXX`
+	echo "Intermediate files will be written to $SCRATCHDIR"
+	tmpdir=$SCRATCHDIR
+	ext=.nii
+	# FSL chooses the output format from FSLOUTPUTTYPE, not from the name
+	fslnii="FSLOUTPUTTYPE=NIFTI "
+else
+	tmpdir=$outdir
+	ext=.nii.gz
+	fslnii=""
+fi
+
+cleanup()
+{
+# stop the stages still running and remove the intermediates, on success or failure
+local j
+for j in `jobs -p`; do
+	kill_tree $j
+done
+rm -f $tmpdir/tmp.bval_row $tmpdir/tmp.bvec_row
+if [[ $SCRATCHDIR ]]; then
+	rm -rf $SCRATCHDIR
+fi
+}
+trap cleanup EXIT
+trap 'exit 1' INT TERM
 ############### Create log file ########################
 touch $outdir/log.txt
 LF=$outdir/log.txt
+############### Stage manifests ########################
+# stages are skipped when inputs, command and tool versions are unchanged
+STAGEDIR=$outdir/stage_manifest
+TOOLVER="mrtrix:`mrinfo -version | head -n 1` fsl:`cat $FSLDIR/etc/fslversion 2>/dev/null` fs:`cat $FREESURFER_HOME/build-stamp.txt 2>/dev/null || true`"
+############### Stage timing ###########################
+# one JSON line per command/stage (wall, CPU, max RSS, output sizes); the
+# Python reports add their phases to the same file
+TIMELOG=$outdir/stage_times.jsonl
+TIMEBIN=`gnu_time`
+export DWIQAC_TIMELOG=$TIMELOG DWIQAC_SUBJ=$subjid
 ######## Check bval and bvec ########################
 if [[ $bval ]]; then
 	bval=`realpath $bval`
@@ -165,66 +284,74 @@ else
 			echo "bvecs are:" $bvec
 	fi
 fi
-######## Check number of directions match ####################
-nbval=`wc -l $bval | awk '{print $1}'`
-nbvec=`wc -l $bvec | awk '{print $1}'`
-if [[ $nbval == 1 ]]; then #rows
-	cmd="$codedir/utils/row2col.sh $bval $outdir/bvals"
-	echo ${cmd}; eval ${cmd}
- 	echo ${cmd} >> $LF
-	nbval=`wc -l $outdir/bvals | awk '{print $1}'`
-fi
-if [[ $nbval -ne $dim4 ]]; then 
-
-	echo "ERROR: Bval file does not have the same length as DWI"
-	exit 1
-fi
-
-if [[ $nbvec == 3 ]]; then #rows
-        cmd="$codedir/utils/row2col.sh  $bvec $outdir/bvecs"
-		echo ${cmd}; eval ${cmd}
- 		echo ${cmd} >> $LF
-        nbvec=`wc -l $outdir/bvecs | awk '{print $1}'`
-fi
-
-if [[ $nbvec -ne $dim4 ]]; then
-        echo "ERROR: Bvec file does not have the same length as DWI"
-        exit 1
-fi
+######## Check gradients ####################################
+# bvals/bvecs in rows or columns are checked against the number of volumes
+# in the DWI header and written in columns to the output directory
+cmd="python $codedir/plotting/gradients.py columns $bval $bvec $outdir/bvals $outdir/bvecs --dwi $data"
+run_stage gradients "$bval $bvec $data" "$outdir/bvals $outdir/bvecs" "$cmd"
 
 bval=$outdir/bvals
 bvec=$outdir/bvecs
+######## Preview ####################################################
+# quick look from a subset of volumes and slices, in one Python process;
+# nothing is added to the group tables
+if [[ $preview ]]; then
+	echo "########## PREVIEW #################"
+	mkdir -p $outdir/reports
+	cmd="python $codedir/plotting/preview.py $data $bval $bvec $outdir/reports/qc_preview.pdf --fa_thr ${thr:-0.2}"
+	# -s is often left out at the scanner; the command is eval'ed, so quote the ID
+	if [[ $subjid ]]; then
+		cmd="$cmd --subj `printf '%q' "$subjid"`"
+	fi
+	if [[ $fgrp ]]; then
+		cmd="$cmd --group_dir `realpath $fgrp`"
+	else
+		cmd="$cmd --group_dir $outdir/reports"
+	fi
+	run_cmd "$cmd"
+	echo "Preview done! Run without -p for the full QC"
+	exit 0
+fi
+######## Stage graph #################################################
+# Stages are registered with the stages they depend on and their number of
+# threads, and run by dag_run, independent stages in parallel within the
+# thread budget. The first failing stage stops the pipeline.
+# SynthSeg takes all threads but one; the gradient check and tensor fit,
+# which run alongside it, take the rest
+if command -v mri_synthseg &> /dev/null && (( nthreads > 1 )); then
+	sseg_threads=$(( nthreads-1 ))
+	grad_threads=1
+else
+	sseg_threads=$nthreads
+	grad_threads=$nthreads
+fi
 ######## Creating brain mask #######################################
 echo "Creating brain mask..."
 if ! command -v dwigradcheck &> /dev/null; then
                 echo "WARNING: MRtrix command not found."
            	exit 1
 else
-cmd="dwiextract $data -bzero -force -fslgrad $bvec $bval $outdir/tmp.bzeros.nii.gz"
-echo ${cmd}; eval ${cmd};
-echo ${cmd} >> $LF
+# MRtrix thread options refer to the share of the stage, so the manifests do
+# not change with the budget
+bzeros=$tmpdir/tmp.bzeros$ext
+bzeros_tmean=$tmpdir/tmp.bzeros_tmean$ext
+bzeros_tstd=$tmpdir/tmp.bzeros_tstd$ext
+cmd="dwiextract $data -bzero -force -nthreads \$DWIQAC_STAGE_THREADS -fslgrad $bvec $bval $bzeros"
+dag_add dwiextract "" 1 run_stage dwiextract "$data $bvec $bval" "$bzeros" "$cmd"
 
-cmd="fslmaths $outdir/tmp.bzeros.nii.gz -Tmean $outdir/tmp.bzeros_tmean.nii.gz"
-echo ${cmd}; eval ${cmd};
-echo ${cmd} >> $LF
+cmd="${fslnii}fslmaths $bzeros -Tmean $bzeros_tmean"
+dag_add bzeros_tmean "dwiextract" 1 run_stage bzeros_tmean "$bzeros" "$bzeros_tmean" "$cmd"
 
-cmd="bet2 $outdir/tmp.bzeros_tmean.nii.gz $outdir/lowb_brain -m"
-echo ${cmd}; eval ${cmd}
-echo ${cmd} >> $LF
+cmd="bet2 $bzeros_tmean $outdir/lowb_brain -m"
+dag_add bet2 "bzeros_tmean" 1 run_stage bet2 "$bzeros_tmean" "$outdir/lowb_brain.nii.gz $outdir/lowb_brain_mask.nii.gz" "$cmd"
 
 mask=$outdir/lowb_brain_mask.nii.gz
 fi
 ######### Run DWIGRADCHECK ###################################
 if [[ $dogradcheck ]]; then 
 	echo "Performing MRtrix grad check"
-	# Mrtrix likes them in rows and not columns....
-	cmd="$codedir/utils/transpose_gradients.py $bval $outdir/tmp.bval_row"
-	echo ${cmd}; eval ${cmd}
- 	echo ${cmd} >> $LF
-	bval=$outdir/tmp.bval_row
 	if ! command -v dwigradcheck &> /dev/null; then 
         	echo "WARNING: MRtrix command not found. Skipping grad check"
-			rm -rf $outdir/tmp.bval_row
 	else
 		if  [[ -v $eddyout ]]; then
 			echo "Eddy-corrected bvecs found. Running gradient check on them"
@@ -232,15 +359,19 @@ if [[ $dogradcheck ]]; then
 		else
         		bvec=$bvec
 		fi		
-	cmd="$codedir/utils/transpose_gradients.py $bvec $outdir/tmp.bvec_row"
+	# the check is cached on the original gradients, the row files are temporary
+	gradin="$bval $bvec"
+	# Mrtrix likes them in rows and not columns....
+	cmd="python $codedir/plotting/gradients.py rows $bval $bvec $tmpdir/tmp.bval_row $tmpdir/tmp.bvec_row"
 	echo ${cmd}; eval ${cmd}
-    echo ${cmd} >> $LF
-	bvec=$outdir/tmp.bvec_row
+ 	echo ${cmd} >> $LF
+	bval=$tmpdir/tmp.bval_row
+	bvec=$tmpdir/tmp.bvec_row
 	bvalc=$outdir/bvals_c
     bvecc=$outdir/bvecs_c
-    cmd="dwigradcheck $data -mask $mask -fslgrad $bvec $bval -force -export_grad_fsl $bvecc $bvalc"
-    echo ${cmd}; eval ${cmd}
-    echo ${cmd} >> $LF
+    cmd="dwigradcheck $data -mask $mask -fslgrad $bvec $bval -force -nthreads \$DWIQAC_STAGE_THREADS -export_grad_fsl $bvecc $bvalc"
+    dag_add gradcheck "bet2" $grad_threads run_stage gradcheck "$data $mask $gradin" "$bvecc $bvalc" "$cmd"
+	gradchecked=1
 	fi
 fi
 ######## Run DTIFIT #############################
@@ -255,7 +386,8 @@ fi
 dtidir=$outdir/dtifit
 mkdir -p $dtidir
 
-if [[ -f $outdir/bvecs_c ]]; then
+# the checked gradients are used once the gradient check has run
+if [[ $gradchecked ]] || [[ -f $outdir/bvecs_c ]]; then
 	bvec=$outdir/bvecs_c
 	bval=$outdir/bvals_c
 else
@@ -263,19 +395,50 @@ else
 	bval=$outdir/bvals
 fi
 
-cmd="dtifit -k $data -o $dtidir/dtifit --save_tensor -b $bval -r $bvec -m $mask"
-echo ${cmd}; eval ${cmd}
-echo ${cmd} >> $LF
-
-cmd="dtigen -t $dtidir/dtifit_tensor.nii.gz -o $dtidir/dtifit_pred --s0=$dtidir/dtifit_S0.nii.gz -b $bval -r $bvec -m $mask"
-echo ${cmd}; eval ${cmd}
-echo ${cmd} >> $LF
-
-cmd="fslmaths $data -sub $dtidir/dtifit_pred.nii.gz $dtidir/dtifit_residuals.nii.gz"
-echo ${cmd}; eval ${cmd}
-echo ${cmd} >> $LF
+# tensor fit in python: same outputs as dtifit --save_tensor, residuals are
+# summarised by the report without writing 4D prediction/residual images
+dtiout="$dtidir/dtifit_FA.nii.gz $dtidir/dtifit_MD.nii.gz $dtidir/dtifit_V1.nii.gz $dtidir/dtifit_S0.nii.gz $dtidir/dtifit_tensor.nii.gz"
+cmd="python $codedir/plotting/tensorfit.py $data $bval $bvec $mask $dtidir/dtifit"
+if [[ $saveres ]]; then
+	cmd="$cmd --save_residuals"
+	dtiout="$dtiout $dtidir/dtifit_residuals.nii.gz"
+fi
+dag_add dtifit "bet2 gradcheck" $grad_threads run_stage dtifit "$codedir/plotting/tensorfit.py $codedir/plotting/niftiio.py $data $bval $bvec $mask" "$dtiout" "$cmd"
 
 ####### Run Synthseg ########################################
+synthseg_masks()
+{
+# segmentation and tissue masks are one cached stage (masks are converted in place)
+if stage_needed synthseg "$outdir/lowb_brain.nii.gz" "$sseg_out" "mri_synthseg --parc"; then
+	rm -f $STAGEDIR/synthseg.txt
+	# labels and resampled labels are intermediates, only the binary masks are kept
+	cmd="mri_synthseg --i $outdir/lowb_brain.nii.gz --o $ssegtmp/synthseg_out$ext --parc --threads $DWIQAC_STAGE_THREADS"
+	run_cmd "$cmd"
+	#Extract WM mask
+	cmd="mri_extract_label $ssegtmp/synthseg_out$ext 2 41 $ssegtmp/wm_mask$ext"
+	run_cmd "$cmd"
+	cmd="mri_convert $ssegtmp/wm_mask$ext -rl $outdir/lowb_brain.nii.gz -rt nearest $ssegtmp/wm_mask$ext "
+	run_cmd "$cmd"
+	cmd="fslmaths $ssegtmp/wm_mask$ext -bin $outdir/wm_mask.nii.gz"
+	run_cmd "$cmd"
+
+	cmd="${fslnii}fslmaths $ssegtmp/synthseg_out$ext -thr 100 $ssegtmp/cortex_mask$ext"
+	run_cmd "$cmd"
+	cmd="mri_convert $ssegtmp/cortex_mask$ext -rt nearest -rl $outdir/lowb_brain.nii.gz $ssegtmp/cortex_mask$ext"
+	run_cmd "$cmd"
+	cmd="fslmaths $ssegtmp/cortex_mask$ext -bin $ssegdir/cortex_mask.nii.gz"
+	run_cmd "$cmd"
+
+	cmd="mri_extract_label $ssegtmp/synthseg_out$ext 14 15 $ssegtmp/ventricles_mask$ext"
+	run_cmd "$cmd"
+	cmd="mri_convert $ssegtmp/ventricles_mask$ext -rt nearest -rl $outdir/lowb_brain.nii.gz $ssegtmp/ventricles_mask$ext"
+	run_cmd "$cmd"
+	cmd="fslmaths $ssegtmp/ventricles_mask$ext -bin $ssegdir/ventricles_mask.nii.gz"
+	run_cmd "$cmd"
+	stage_done synthseg "$outdir/lowb_brain.nii.gz" "$sseg_out" "mri_synthseg --parc"
+fi
+}
+
 if ! command -v mri_synthseg &> /dev/null; then
         echo "WARNING: FreeSurfer Synthseg command not found."
         echo "WARNING: WM mask will be obtained from FA"
@@ -286,86 +449,45 @@ if ! command -v mri_synthseg &> /dev/null; then
         	thr=0.2
 	fi
         cmd="fslmaths $dtidir/dtifit_FA.nii.gz -thr $thr -uthr 1 -bin $outdir/wm_mask.nii.gz"
-        echo ${cmd}; eval ${cmd};
-        echo ${cmd} >> $LF
+        dag_add wm_mask "dtifit" 1 run_stage wm_mask "$dtidir/dtifit_FA.nii.gz" "$outdir/wm_mask.nii.gz" "$cmd"
+	wmstage=wm_mask
 else
 	ssegdir=$outdir/synthseg
 	mkdir -p $ssegdir
-        cmd="mri_synthseg --i $outdir/lowb_brain.nii.gz --o $ssegdir/synthseg_out.nii.gz --parc --threads 5"
-        echo ${cmd}; eval ${cmd}
-        echo ${cmd} >> $LF
-        #Extract WM mask
-        cmd="mri_extract_label $ssegdir/synthseg_out.nii.gz 2 41 $ssegdir/wm_mask.nii.gz"
-        echo ${cmd}; eval ${cmd};
-        echo ${cmd} >> $LF
-        cmd="mri_convert $ssegdir/wm_mask.nii.gz -rl $outdir/lowb_brain.nii.gz -rt nearest $ssegdir/wm_mask.nii.gz "
-        echo ${cmd}; eval ${cmd};
-        echo ${cmd} >> $LF
-        cmd="fslmaths $ssegdir/wm_mask.nii.gz -bin $outdir/wm_mask.nii.gz"
-        echo ${cmd}; eval ${cmd};
-        echo ${cmd} >> $LF
-
-	cmd="fslmaths $ssegdir/synthseg_out.nii.gz -thr 100 $ssegdir/cortex_mask.nii.gz"
-	echo ${cmd}; eval ${cmd};
-	echo ${cmd} >> $LF
-	cmd="mri_convert $ssegdir/cortex_mask.nii.gz -rt nearest -rl $outdir/lowb_brain.nii.gz $ssegdir/cortex_mask.nii.gz"
-	echo ${cmd}; eval ${cmd};
-	echo ${cmd} >> $LF
-	cmd="fslmaths $ssegdir/cortex_mask.nii.gz -bin $ssegdir/cortex_mask.nii.gz"
-	echo ${cmd}; eval ${cmd};
-	echo ${cmd} >> $LF
-
-	cmd="mri_extract_label $ssegdir/synthseg_out.nii.gz 14 15 $ssegdir/ventricles_mask.nii.gz"
-	echo ${cmd}; eval ${cmd};
-        echo ${cmd} >> $LF
-	cmd="mri_convert $ssegdir/ventricles_mask.nii.gz -rt nearest -rl $outdir/lowb_brain.nii.gz $ssegdir/ventricles_mask.nii.gz"
-        echo ${cmd}; eval ${cmd};
-        echo ${cmd} >> $LF
-	cmd="fslmaths $ssegdir/ventricles_mask.nii.gz -bin $ssegdir/ventricles_mask.nii.gz"
-        echo ${cmd}; eval ${cmd};
-        echo ${cmd} >> $LF
-	
+	if [[ $SCRATCHDIR ]]; then
+		ssegtmp=$SCRATCHDIR/synthseg
+		mkdir -p $ssegtmp
+	else
+		ssegtmp=$ssegdir
+	fi
+	sseg_out="$outdir/wm_mask.nii.gz $ssegdir/cortex_mask.nii.gz $ssegdir/ventricles_mask.nii.gz"
+	# only needs the brain: runs alongside the gradient check and the tensor fit
+	dag_add synthseg "bet2" $sseg_threads synthseg_masks
+	wmstage=synthseg
 fi
 ####### CNR IN WM ###########
 echo "~~~~~~~~~ Computing CNR in WM ~~~~~~~"
-cmd="fslstats -t $data -k $outdir/wm_mask.nii.gz -m -s"
-echo ${cmd}; eval ${cmd};
-echo ${cmd} >> $LF
-${cmd} > $outdir/cnrwm.txt 
+cmd="fslstats -t $data -k $outdir/wm_mask.nii.gz -m -s > $outdir/cnrwm.txt"
+dag_add cnrwm "$wmstage" 1 run_stage cnrwm "$data $outdir/wm_mask.nii.gz" "$outdir/cnrwm.txt" "$cmd"
 
 ######### SNR ###########
 echo "~~~~~~~~~ Computing Temporal SNR ~~~~~~~"
 
-cmd="fslmaths $outdir/tmp.bzeros.nii.gz -Tstd $outdir/tmp.bzeros_tstd.nii.gz"
-echo ${cmd}; eval ${cmd};
-echo ${cmd} >> $LF
-
-cmd="fslmaths $outdir/tmp.bzeros_tmean.nii.gz -div $outdir/tmp.bzeros_tstd.nii.gz $outdir/bzeros_snr.nii.gz"
-echo ${cmd}; eval ${cmd};
-echo ${cmd} >> $LF
-
-cmd="fslstats $outdir/bzeros_snr.nii.gz -k $mask -M -S"
-echo ${cmd}; eval ${cmd};
-echo ${cmd} >> $LF
-${cmd} > $outdir/tsnr_orig.txt
+cmd="${fslnii}fslmaths $bzeros -Tstd $bzeros_tstd"
+dag_add bzeros_tstd "dwiextract" 1 run_stage bzeros_tstd "$bzeros" "$bzeros_tstd" "$cmd"
 
-########## TAKE SCREENSHOTS ###################
-ssdir=$outdir/screenshots
-mkdir -p $ssdir
+cmd="fslmaths $bzeros_tmean -div $bzeros_tstd $outdir/bzeros_snr.nii.gz"
+dag_add tsnr "bzeros_tmean bzeros_tstd" 1 run_stage tsnr "$bzeros_tmean $bzeros_tstd" "$outdir/bzeros_snr.nii.gz" "$cmd"
 
-if ! command -v freeview &> /dev/null; then
-        echo "WARNING: freeview command not found."
-	echo "screenshots will not be taken"
-else
-	#I think the following only if mrtrix env is sourced
-	cmd="env -u LD_LIBRARY_PATH sh $codedir/utils/qc_screenshots.sh $outdir $data"
-	if [[ $eddyout ]]; then
-		cmd="$cmd $eddydir"
-	fi
-	echo ${cmd}; eval ${cmd};
-	echo ${cmd} >> $LF
+# the b0 series and its mean/std only exist in scratch: they are re-created
+# only when the brain mask or the tSNR map has to be
+if [[ $SCRATCHDIR ]]; then
+	dag_transient dwiextract bzeros_tmean bzeros_tstd
 fi
 
+cmd="fslstats $outdir/bzeros_snr.nii.gz -k $mask -M -S > $outdir/tsnr_orig.txt"
+dag_add tsnr_stats "tsnr bet2" 1 run_stage tsnr_stats "$outdir/bzeros_snr.nii.gz $mask" "$outdir/tsnr_orig.txt" "$cmd"
+
 ######## CREATE PDF DTIFIT/GRAD/SNR/SIGNAL  ###############
 #create PDF and dataframe for dti/gradient/snr qc
 pdfdir=$outdir/reports
@@ -388,15 +510,17 @@ pdfout=$pdfdir/qc.pdf
                 fgrp=$pdfdir
         fi      
 
-fgrpq=$fgrp/group_dti,snr.txt
 wm=$outdir/wm_mask.nii.gz
 
-cmd="python $codedir/plotting/noeddyqc.py $outdir $subjid $pdfout $fgrpq $wm $bval $data"
+# one stage per report, the eddy reports run alongside the DTI report
+cmd="python $codedir/plotting/qc_reports.py $outdir $subjid $bval $data --bvecs $bvec --mask $mask --wm_mask $wm --pdfdir $pdfdir --group_dir $fgrp"
+# report stages also depend on the plotting code
+repin="$codedir/plotting/*.py $data $bval $bvec $mask $wm $outdir/tsnr_orig.txt $outdir/cnrwm.txt $outdir/bzeros_snr.nii.gz $dtiout"
 if [[ -d $ssegdir ]]; then
 	cmd="$cmd --gm_mask $ssegdir/cortex_mask.nii.gz --csf_mask $ssegdir/ventricles_mask.nii.gz"
+	repin="$repin $ssegdir/cortex_mask.nii.gz $ssegdir/ventricles_mask.nii.gz"
 fi
-echo ${cmd}; eval ${cmd};
-echo ${cmd} >> $LF
+dag_add report_dti "dtifit $wmstage cnrwm tsnr_stats" 1 run_stage report_dti "$repin" "$pdfout $outdir/metrics/dti.npz $outdir/metrics/dti.json" "$cmd --reports dti"
 
 ######### Run QA on EDDY Outputs ############################
 if [[ $eddyout ]]; then
@@ -409,78 +533,55 @@ if [[ $eddyout ]]; then
         	echo "QA will include motion qa and eddy qa"
 	fi
 	
-	### Create PDF and dataframe for motion QC ###
-        fs2v=`echo $eddyout/*.eddy_movement_over_time`
-        frms=`echo $eddyout/*.eddy_movement_rms`
-        fres_rms=`echo $eddyout/*.eddy_restricted_movement_rms`
-        fparams=`echo $eddyout/*.eddy_parameters`
+	### Motion and outlier QC inputs ###
         dim3=`fslinfo $data | grep -w "dim3" | awk '{print $2}'`
-	pdf_output=$pdfdir/qc_motion.pdf
-
-	# Assigning group QC directory output #
-	if [[ $fgrp ]]; then
-		fgrp=`realpath $fgrp`
-		if [[ -d $fgrp ]]; then
-			echo "Group dataframes will be saved in $fgrp"
-			fgrp=$fgrp
-		else
-			echo "Warning: path to group dataframes directory inexistent"
-			echo "Group dataframes will be saved in $pdfdir"
-			fgrp=$pdfdir
-		fi
-	else	
-		echo "Path to group QC not specified. Output will be saved in $pdfdir"
-		fgrp=$pdfdir
-	fi	
-	fgrpm=$fgrp/group_motion.txt
-	fgrpo=$fgrp/group_eddyoutliers.txt
-
         echo "nslices is $dim3"
-        cmd="python $codedir/plotting/qc_motion.py $fs2v $frms $fres_rms $fparams $dim3 $bvalc $subjid $pdf_output $fgrpm"
-        echo ${cmd}; eval ${cmd};
-        echo ${cmd} >> $LF
-
-	#create PDF and dataframe for outlier/top up qc
-	ol_file=`echo $eddyout/*.eddy_outlier_map`
-	ol_std_file=`echo $eddyout/*.eddy_outlier_n_stdev_map`
 	res_file=`echo $eddyout/*.eddy_residuals.nii.gz`
 	if [[ ! -f $res_file ]]; then
 		echo "WARNING: Eddy residuals file not found. Specify --residuals when running Eddy"
 		echo "Residuals plot omitted by QC" 
 	fi
-	pdf_output=$pdfdir/qc_outliers.pdf
 
 	cnrmaps=`echo $eddyout/*.eddy_cnr_maps.nii.gz`
 	if [[ ! -f $cnrmaps ]]; then
         	echo "WARNING: CNR maps not found in eddy output dir. Specify cnr_maps when running Eddy"
 		echo "Eddy CNR plots omitted by QC"
-	else
-    		cmd="fslstats -t $cnrmaps -k $mask -n -m -s"
-    		echo ${cmd}; eval ${cmd};
-    		echo ${cmd} >> $LF
-    		${cmd} > $outdir/eddy_cnr_maps.txt
-		cnr_eddy=$outdir/eddy_cnr_maps.txt
 	fi
 
-	cmd="python $codedir/plotting/qc_ol.py $ol_file $ol_std_file $fparams $bvalc $mask $subjid $pdf_output $fgrpo"
-	if [[ -f $res_file ]]; then
-		cmd="$cmd --eddy_res $res_file"
-	else
-                echo "WARNING: Eddy residuals file not found. Specify --residuals when running Eddy"
-                echo "Residuals plot omitted by QC" 
-        fi
-	if [[ -f $cnrmaps ]]; then
-		cmd="$cmd --cnr_eddy $cnr_eddy"
+	cmd="$cmd --eddy_dir $eddyout --nslices $dim3"
+	# excitation groups of the within-volume motion (multiband)
+	motcmd="$cmd --reports motion"
+	motin="$codedir/plotting/*.py $bval $eddyout/*.eddy_*"
+	if [[ $mb ]]; then
+		motcmd="$motcmd --mb_factor $mb"
+	fi
+	if [[ $slspec ]]; then
+		motcmd="$motcmd --slspec $slspec"
+		motin="$motin $slspec"
 	fi
-	echo ${cmd}; eval ${cmd};
-        echo ${cmd} >> $LF
+	dag_add report_motion "gradcheck" 1 run_stage report_motion "$motin" \
+		"$pdfdir/qc_motion.pdf $outdir/metrics/motion.npz $outdir/metrics/motion.json" "$motcmd"
+	dag_add report_outliers "bet2 gradcheck $wmstage" 1 run_stage report_outliers "$codedir/plotting/*.py $bval $mask $wm $eddyout/*.eddy_*" \
+		"$pdfdir/qc_outliers.pdf $outdir/metrics/outliers.npz $outdir/metrics/outliers.json" "$cmd --reports outliers"
 else
         echo "Eddy directory not provided"
         echo "QA will not include motion and eddy qa"
 fi
-############ Remove tmp files ##########################
-rm -rf $outdir/tmp.bvec_row
-rm -rf $outdir/tmp.bval_row
+########## TAKE SCREENSHOTS ###################
+# slice snapshots of the QC maps for visual inspection, drawn without a display
+ssdir=$outdir/screenshots
+cmd="python $codedir/plotting/screenshots.py $outdir"
+ssin="$codedir/plotting/screenshots.py $codedir/plotting/render.py $outdir/bzeros_snr.nii.gz $dtiout $outdir/lowb_brain.nii.gz $mask"
+if [[ $eddyout ]]; then
+	cmd="$cmd --eddy_dir $eddyout"
+	ssin="$ssin $eddyout/*.eddy_command_txt"
+fi
+dag_add screenshots "tsnr dtifit" 1 run_stage screenshots "$ssin" \
+	"$ssdir/tsnr.png $ssdir/dti_v1_coronal.png $ssdir/dti_v1_axial.png $ssdir/dti_fa_coronal.png $ssdir/dti_md_coronal.png $ssdir/brain_mask.png $ssdir/lowb_orig.png" "$cmd"
+dag_run
+# the full reports replace the preview
+rm -f $pdfdir/qc_preview.*
+# intermediates are removed on exit (cleanup)
 ######################################
 echo "DWI QA done!"
 ######################################
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Run dwi_qa.sh over a cohort described by a manifest.
+
+The manifest is a tab-separated file with a header and one row per session:
+    subj    dwi    bval    bvec    eddy
+bval, bvec and eddy may be left empty (bval/bvec then default to the dwi
+basename, as in dwi_qa.sh). Each subject is written to <outdir>/<subj> and
+all subjects share the group QC tables in <outdir>/group (or -q).
+
+Subjects run in parallel (-j workers, -t threads per worker). Every state
+change is appended to <outdir>/batch_status.jsonl; re-running the same
+command resumes the batch and skips subjects already done. Extra manifest
+columns such as site or scanner are used by the cohort report (--report).
+"""
+
+import argparse
+import csv
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+codedir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(codedir, 'plotting'))
+
+# environment variables honoured by the libraries/tools called by dwi_qa.sh
+# (DWIQAC_NTHREADS: thread budget shared by the stages of a subject, which
+# dwi_qa.sh splits between the stages it runs in parallel)
+THREAD_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+               'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'MRTRIX_NTHREADS', 'DWIQAC_NTHREADS']
+GROUP_TABLES = ['group_dti,snr.txt', 'group_motion.txt', 'group_eddyoutliers.txt']
+
+
+def read_manifest(path):
+    with open(path, newline='') as f:
+        rows = [r for r in csv.DictReader(f, delimiter='\t')]
+    for r in rows:
+        if not r.get('subj') or not r.get('dwi'):
+            raise ValueError('Manifest rows need at least subj and dwi: '+str(r))
+    subjs = [r['subj'] for r in rows]
+    if len(set(subjs)) != len(subjs):
+        raise ValueError('Duplicated subject IDs in manifest')
+    return rows
+
+
+def read_status(path):
+    """Last recorded state of each subject."""
+    status = {}
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # line cut by a crash
+                status[rec['subj']] = rec['status']
+    return status
+
+
+def qa_command(row, outdir, grpdir, extra):
+    cmd = [os.path.join(codedir, 'dwi_qa.sh'), '-i', row['dwi'], '-o', outdir,
+           '-s', row['subj'], '-q', grpdir]
+    if row.get('bval'):
+        cmd += ['-b', row['bval']]
+    if row.get('bvec'):
+        cmd += ['-r', row['bvec']]
+    if row.get('eddy'):
+        cmd += ['-e', row['eddy']]
+    return cmd + extra
+
+
+def run_subject(cmd, outdir, threads):
+    """Worker: run dwi_qa.sh for one subject with a bounded thread budget."""
+    from groupstore import EXPORT_ENV
+    env = dict(os.environ)
+    for v in THREAD_VARS:
+        env[v] = str(threads)
+    # the group text tables are exported once, at the end of the batch
+    env[EXPORT_ENV] = '0'
+    start = time.time()
+    with open(os.path.join(outdir, 'dwi_qa.out'), 'w') as log:
+        ret = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT, env=env)
+    return ret, time.time()-start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run dwi_qa.sh on a cohort manifest')
+    parser.add_argument('manifest', help='TSV with columns subj, dwi, bval, bvec, eddy')
+    parser.add_argument('outdir', help='Output root, one folder per subject')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='Subjects processed in parallel. Default=1')
+    parser.add_argument('-t', '--threads', type=int, default=1,
+                        help='Threads per subject. Default=1')
+    parser.add_argument('-q', '--group_dir', default=None,
+                        help='Directory for group QC outputs. Default: <outdir>/group')
+    parser.add_argument('--qa_args', default='',
+                        help='Extra options passed to dwi_qa.sh, e.g. "-g -f 0.25"')
+    parser.add_argument('--report', default=None, metavar='FORMATS',
+                        help='Also write the cohort QC report <group_dir>/group_report.* in these formats '
+                             '(e.g. pdf,html), with the breakdowns by the site/scanner columns of the manifest')
+    parser.add_argument('--rerun', action='store_true',
+                        help='Ignore the status log and process every subject')
+    args = parser.parse_args(argv)
+
+    rows = read_manifest(args.manifest)
+    os.makedirs(args.outdir, exist_ok=True)
+    grpdir = os.path.realpath(args.group_dir or os.path.join(args.outdir, 'group'))
+    os.makedirs(grpdir, exist_ok=True)
+    status_file = os.path.join(args.outdir, 'batch_status.jsonl')
+    status = {} if args.rerun else read_status(status_file)
+    todo = [r for r in rows if status.get(r['subj']) != 'done']
+    print(len(rows)-len(todo), 'subjects already done,', len(todo), 'to run')
+
+    def record(subj, state, **kw):
+        kw.update(subj=subj, status=state, time=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        slog.write(json.dumps(kw)+'\n')
+        slog.flush()
+
+    failed = 0
+    with open(status_file, 'a') as slog, ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {}
+        for r in todo:
+            sdir = os.path.realpath(os.path.join(args.outdir, r['subj']))
+            os.makedirs(sdir, exist_ok=True)
+            cmd = qa_command(r, sdir, grpdir, shlex.split(args.qa_args))
+            futures[pool.submit(run_subject, cmd, sdir, args.threads)] = r['subj']
+            record(r['subj'], 'queued', cmd=' '.join(cmd))
+        for fut in as_completed(futures):
+            subj = futures[fut]
+            try:
+                ret, wall = fut.result()
+            except Exception as e:
+                ret, wall = -1, 0
+                print(subj, 'worker error:', e)
+            state = 'done' if ret == 0 else 'failed'
+            failed += ret != 0
+            record(subj, state, returncode=ret, wall_s=round(wall, 1))
+            print(subj, state, '('+str(round(wall))+' s)')
+
+    # group tables are appended in completion order, export them in manifest order
+    from groupstore import GroupStore
+    order = [r['subj'] for r in rows]
+    for t in GROUP_TABLES:
+        store = GroupStore(os.path.join(grpdir, t))
+        if os.path.isfile(store.db_path):
+            store.export(order=order)
+    if args.report:
+        import group_report
+        group_report.main([grpdir, os.path.join(grpdir, 'group_report.pdf'), '--covariates', args.manifest,
+                           '--qc_root', args.outdir, '--format', args.report])
+    print('Batch done:', len(todo)-failed, 'succeeded,', failed, 'failed')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Running cohort statistics of the group QC measures.
+
+Every numeric column of a group table keeps its count, Welford mean and
+sum of squared deviations, and P^2 sketches (Jain & Chlamtac, 1985) of a few
+percentiles. Adding a subject updates them in constant time and memory,
+whatever the size of the cohort, and a subject is compared with the cohort
+before it is added: z-score and pass/flag decision. A value can be removed
+from the count, mean and variance (a subject re-run), but not from the
+percentile sketches, which keep the values of replaced subjects until they
+are rebuilt from the stored rows (groupstore.py rebuild).
+"""
+
+import json
+import math
+
+# percentiles tracked by the sketches
+PERCENTILES = (5, 50, 95)
+# |z| above which a measure is flagged
+Z_FLAG = 3.0
+# no decision against cohorts smaller than this
+MIN_COHORT = 10
+
+
+def is_number(v):
+    if v is None or isinstance(v, (bool, str, bytes)):
+        return False
+    try:
+        return math.isfinite(float(v))
+    except (TypeError, ValueError):
+        return False
+
+
+class P2Quantile:
+    """P^2 estimate of one quantile from five markers."""
+
+    def __init__(self, p, state=None):
+        self.p = p
+        state = state or {}
+        self.count = state.get('count', 0)
+        self.q = list(state.get('q', []))
+        self.n = list(state.get('n', [1, 2, 3, 4, 5]))
+
+    def state(self):
+        return {'count': self.count, 'q': self.q, 'n': self.n}
+
+    def _desired(self, count):
+        p = self.p
+        return [1, 1+(count-1)*p/2, 1+(count-1)*p, 1+(count-1)*(1+p)/2, count]
+
+    def add(self, x):
+        self.count += 1
+        if self.count <= 5:
+            self.q = sorted(self.q+[x])
+            return
+        q, n = self.q, self.n
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = max(i for i in range(4) if q[i] <= x)
+        for i in range(k+1, 5):
+            n[i] += 1
+        desired = self._desired(self.count)
+        for i in (1, 2, 3):
+            d = desired[i]-n[i]
+            if (d >= 1 and n[i+1]-n[i] > 1) or (d <= -1 and n[i-1]-n[i] < -1):
+                d = 1 if d > 0 else -1
+                qp = q[i] + d/(n[i+1]-n[i-1])*((n[i]-n[i-1]+d)*(q[i+1]-q[i])/(n[i+1]-n[i])
+                                               + (n[i+1]-n[i]-d)*(q[i]-q[i-1])/(n[i]-n[i-1]))
+                if not q[i-1] < qp < q[i+1]:
+                    qp = q[i] + d*(q[i+d]-q[i])/(n[i+d]-n[i])
+                q[i] = qp
+                n[i] += d
+
+    def value(self):
+        if not self.q:
+            return None
+        if self.count > 5:
+            return self.q[2]
+        # exact percentile of the first few values
+        pos = (len(self.q)-1)*self.p
+        lo = int(math.floor(pos))
+        hi = min(lo+1, len(self.q)-1)
+        return self.q[lo] + (pos-lo)*(self.q[hi]-self.q[lo])
+
+
+class RunningStats:
+    """Count, mean, variance and percentile sketches of one measure."""
+
+    def __init__(self, n=0, mean=0.0, m2=0.0, sketch=None):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+        sketch = json.loads(sketch) if sketch else {}
+        self.sketches = {pc: P2Quantile(pc/100, sketch.get(str(pc))) for pc in PERCENTILES}
+
+    def sketch(self):
+        return json.dumps({str(pc): s.state() for pc, s in self.sketches.items()})
+
+    def add(self, x, sketch=True):
+        self.n += 1
+        delta = x-self.mean
+        self.mean += delta/self.n
+        self.m2 += delta*(x-self.mean)
+        if sketch:
+            for s in self.sketches.values():
+                s.add(x)
+
+    def remove(self, x):
+        """Undo add(x) on the mean and variance (the sketches cannot forget a value)."""
+        if self.n <= 1:
+            self.n, self.mean, self.m2 = 0, 0.0, 0.0
+            return
+        delta = x-self.mean
+        self.n -= 1
+        self.mean -= delta/self.n
+        self.m2 = max(self.m2-delta*(x-self.mean), 0.0)
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2/(self.n-1)) if self.n > 1 else float('nan')
+
+    def percentile(self, pc):
+        return self.sketches[pc].value()
+
+    def compare(self, x):
+        """z-score of x against the cohort and the QC decision."""
+        std = self.std
+        z = (x-self.mean)/std if self.n > 1 and std > 0 else float('nan')
+        if self.n < MIN_COHORT or not math.isfinite(z):
+            decision = None
+        else:
+            decision = 'flag' if abs(z) > Z_FLAG else 'pass'
+        return {'value': float(x), 'n': self.n, 'mean': self.mean, 'std': std, 'z': z,
+                'percentiles': {pc: self.percentile(pc) for pc in PERCENTILES},
+                'decision': decision}
+
+
+def print_flags(cohort):
+    """Print the measures flagged against the cohort."""
+    for name, c in (cohort or {}).items():
+        if c['decision'] == 'flag':
+            print('WARNING: '+name+' = {:.4g} is {:+.1f} SD from the cohort mean (n={})'.format(
+                  c['value'], c['z'], c['n']))
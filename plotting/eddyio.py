@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Readers for eddy text outputs.
+
+eddy writes large whitespace-separated ASCII tables (*.eddy_outlier_map,
+*.eddy_outlier_n_stdev_map, *.eddy_movement_over_time with nvols*nslices
+rows, ...). They are parsed once with the pandas C parser. When a cache
+directory is given, the parsed array is stored there as a .npz sidecar and
+re-used as long as the size and modification time of the text file are
+unchanged.
+"""
+
+import os
+
+import numpy as np
+
+# header line of the outlier maps ("One row per scan, one column per slice...")
+OUTLIER_HEADER = 1
+
+
+def _sidecar(path, cache_dir):
+    return os.path.join(cache_dir, os.path.basename(path)+'.npz')
+
+
+def _source_id(path):
+    st = os.stat(path)
+    return np.array([st.st_size, st.st_mtime_ns], dtype=np.int64)
+
+
+def parse_table(path, skip_header=0):
+    """Parse a whitespace-separated numeric table into a 2D float array."""
+    import pandas as pd
+    df = pd.read_csv(path, sep=r'\s+', header=None, skiprows=skip_header,
+                     dtype=np.float64, engine='c')
+    return df.to_numpy()
+
+
+def read_table(path, skip_header=0, cache_dir=None):
+    """Read an eddy text output, using/refreshing the .npz sidecar in cache_dir."""
+    if cache_dir:
+        sidecar = _sidecar(path, cache_dir)
+        source = _source_id(path)
+        if os.path.isfile(sidecar):
+            try:
+                with np.load(sidecar) as f:
+                    if np.array_equal(f['source'], source) and int(f['skip_header']) == skip_header:
+                        return f['data']
+            except (OSError, ValueError, KeyError):
+                pass  # unreadable sidecar, parse again
+    data = parse_table(path, skip_header)
+    if cache_dir:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = sidecar+'.tmp.npz'
+            np.savez(tmp, data=data, source=source, skip_header=skip_header)
+            os.replace(tmp, sidecar)
+        except OSError as e:
+            print('WARNING: could not write eddy cache', sidecar, e)
+    return data
+
+
+def read_outlier_map(path, cache_dir=None):
+    """*.eddy_outlier_map / *.eddy_outlier_n_stdev_map: (nvols, nslices)."""
+    return read_table(path, OUTLIER_HEADER, cache_dir)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Gradient tables (FSL bval/bvec files).
+
+bvals and bvecs are read in rows or columns, checked against the number of
+volumes of the DWI header, and every volume is assigned to a shell: b-values
+below B0_MAX are b0s, the others are clustered when they are within the
+tolerance of each other (e.g. 995, 1000 and 1005 are one b=1000 shell).
+
+As a script it writes the gradient files used by dwi_qa.sh:
+    gradients.py columns bval bvec out_bval out_bvec --dwi data.nii.gz
+    gradients.py rows bval bvec out_bval out_bvec
+"""
+
+import argparse
+import sys
+import numpy as np
+
+# b-values below this are b0 volumes
+B0_MAX = 100
+# b-values closer than this belong to the same shell
+SHELL_TOL = 50
+
+
+def read_bvals(path):
+    """bvals as a 1D array, whatever the orientation on disk."""
+    return np.loadtxt(path, ndmin=2).ravel()
+
+
+def read_bvecs(path):
+    """bvecs as (nvols, 3), whatever the orientation on disk."""
+    bvec = np.loadtxt(path, ndmin=2)
+    if bvec.shape[0] == 3 and bvec.shape[1] != 3:
+        bvec = bvec.T
+    if bvec.shape[1] != 3:
+        raise ValueError(path+' is not a bvec file: shape '+str(bvec.shape))
+    return bvec
+
+
+def cluster_shells(bval, tol=SHELL_TOL):
+    """Shell b-values and the shell index of every volume.
+
+    Sorted b-values are split where two consecutive values differ by more
+    than tol. The b-value of a shell is the median of its volumes rounded
+    to 10 s/mm^2, shell 0 holds the b0s (b=0) when there are any.
+    """
+    bval = np.asarray(bval, dtype=float)
+    index = np.zeros(bval.size, dtype=int)
+    shells = []
+    b0 = bval < B0_MAX
+    if b0.any():
+        shells.append(0)
+    dw = np.flatnonzero(~b0)
+    if dw.size:
+        order = dw[np.argsort(bval[dw], kind='stable')]
+        splits = np.flatnonzero(np.diff(bval[order]) > tol)+1
+        for group in np.split(order, splits):
+            index[group] = len(shells)
+            shells.append(int(np.round(np.median(bval[group]), -1)))
+    return np.array(shells, dtype=int), index
+
+
+class GradientTable:
+    """bvals, bvecs and shells of a DWI series."""
+
+    def __init__(self, bval, bvec=None, tol=SHELL_TOL):
+        self.bvals = np.asarray(bval, dtype=float)
+        self.bvecs = None if bvec is None else np.asarray(bvec, dtype=float)
+        if self.bvecs is not None and self.bvecs.shape[0] != self.bvals.size:
+            raise ValueError('bvecs have '+str(self.bvecs.shape[0])+' volumes, bvals '+str(self.bvals.size))
+        self.shells, self.index = cluster_shells(self.bvals, tol)
+
+    @property
+    def nvols(self):
+        return self.bvals.size
+
+    @property
+    def b0(self):
+        return self.bvals < B0_MAX
+
+    @property
+    def labels(self):
+        return ['b='+str(b) for b in self.shells]
+
+    def volume_shells(self):
+        """Shell b-value of every volume."""
+        return self.shells[self.index]
+
+    def check(self, nvols, what='DWI'):
+        if self.nvols != nvols:
+            raise ValueError('Gradient table has '+str(self.nvols)+' volumes, '+what+' has '+str(nvols))
+        return self
+
+
+def load(bvals, bvecs=None, dwi=None, tol=SHELL_TOL):
+    """GradientTable of the given files, checked against the DWI header if given."""
+    gt = GradientTable(read_bvals(bvals), None if bvecs is None else read_bvecs(bvecs), tol)
+    if dwi is not None:
+        from niftiio import n_volumes
+        gt.check(n_volumes(dwi), dwi)
+    return gt
+
+
+def write_fsl(gt, bval_path, bvec_path, rows=False):
+    """Write bvals and bvecs one volume per line (columns) or per column (rows)."""
+    bval = gt.bvals[None] if rows else gt.bvals[:, None]
+    np.savetxt(bval_path, bval, fmt='%.16g')
+    np.savetxt(bvec_path, gt.bvecs.T if rows else gt.bvecs, fmt='%1.16f')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='Check and convert FSL gradient files')
+    parser.add_argument('layout', choices=['columns', 'rows'],
+                        help='Output layout: one volume per line (columns) or per column (rows, MRtrix)')
+    parser.add_argument('bvals', help='Input bval file (rows or columns)')
+    parser.add_argument('bvecs', help='Input bvec file (rows or columns)')
+    parser.add_argument('out_bvals', help='Output bval file')
+    parser.add_argument('out_bvecs', help='Output bvec file')
+    parser.add_argument('--dwi', default=None, help='DWI data: the gradients must have as many volumes')
+    parser.add_argument('--tol', default=SHELL_TOL, type=float,
+                        help='b-values closer than this are one shell. Default='+str(SHELL_TOL))
+    args = parser.parse_args(argv)
+    try:
+        gt = load(args.bvals, args.bvecs, args.dwi, args.tol)
+    except ValueError as e:
+        print('ERROR: '+str(e))
+        return 1
+    write_fsl(gt, args.out_bvals, args.out_bvecs, rows=args.layout == 'rows')
+    print(str(gt.nvols)+' volumes, shells: '+', '.join(
+          '{} ({})'.format(l, n) for l, n in zip(gt.labels, np.bincount(gt.index))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
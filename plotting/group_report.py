@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Cohort QC report over the group tables.
+
+Reads the SQLite group stores (group_dti,snr / group_motion /
+group_eddyoutliers) of a study and writes a multi-page report: the cohort
+distribution of SNR, FA/MD in WM, motion and outlier measures with the
+number of subjects flagged, the worst subjects of each measure and, with a
+covariates table (e.g. the dwi_qa_batch.py manifest with site/scanner
+columns), the measures per site or scanner.
+
+The tables are never loaded whole: each measure is read column by column in
+chunks into fixed-bin histograms, the worst subjects come from ORDER BY ...
+LIMIT and the breakdowns from GROUP BY in SQLite, so memory does not grow
+with the number of subjects. With --qc_root the per-subject metrics
+(metrics.py) are streamed one subject at a time for the WM CNR per shell.
+
+    python plotting/group_report.py cohort_qa/group cohort_qa/group/group_report.pdf \\
+        --covariates manifest.tsv --by site,scanner --qc_root cohort_qa
+"""
+
+import argparse
+import csv
+import os
+import sqlite3
+import sys
+
+import numpy as np
+##########################
+from datetime import date
+from qc_reports import GROUP_FILES
+date = date.today().strftime('%d%m%y')
+# (column, group table, label, worst tail: low, high or both by |z|)
+MEASURES = [('Average_SNR(b<100)', 'dti', 'SNR b=0', 'low'),
+            ('Mean_FA_WM', 'dti', 'FA in WM', 'both'),
+            ('Mean_MD_WM', 'dti', 'MD in WM [mm$^2$/s]', 'both'),
+            ('Average_Absolute_Motion', 'motion', 'Absolute motion [mm]', 'high'),
+            ('Average_Relative_Motion', 'motion', 'Relative motion [mm]', 'high'),
+            ('Total_Outliers', 'outliers', 'Outliers [%]', 'high'),
+            ('Eddy_Residuals', 'outliers', 'Eddy residuals', 'high')]
+# rows fetched at a time from a group table
+CHUNK = 10000
+# bins of the cohort histograms
+NBINS = 60
+# worst subjects listed per measure
+NWORST = 10
+# largest groups shown per covariate
+MAX_GROUPS = 30
+
+
+def _q(name):
+    return '"'+str(name).replace('"', '""')+'"'
+
+
+def _numeric(col, alias=''):
+    return 'typeof('+alias+_q(col)+") IN ('integer', 'real')"
+
+
+def _std(n, ssd):
+    """Sample SD from the count and the sum of squared deviations."""
+    return float(np.sqrt(max(ssd, 0)/(n-1))) if n > 1 else float('nan')
+
+
+def connect(group_dir):
+    """Connection with the group stores of group_dir attached read only, by report name."""
+    from groupstore import GroupStore
+    con = sqlite3.connect('', uri=True)
+    tables = {}
+    for name, txt in GROUP_FILES.items():
+        db = GroupStore(os.path.join(group_dir, txt)).db_path
+        if not os.path.isfile(db):
+            continue
+        con.execute('ATTACH DATABASE ? AS '+name, ('file:'+os.path.abspath(db)+'?mode=ro',))
+        cols = [r[1] for r in con.execute('PRAGMA '+name+'.table_info(qc)')]
+        if cols:
+            tables[name] = cols
+    return con, tables
+
+
+def load_covariates(con, path, by):
+    """Covariates table (tab-separated, subject in 'subj' or 'Sub') as a temporary table.
+
+    Returns the columns of by that exist in the file.
+    """
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f, delimiter='\t')
+        header = reader.fieldnames or []
+        sub = 'subj' if 'subj' in header else 'Sub'
+        if sub not in header:
+            raise ValueError(path+' has no subj (or Sub) column')
+        cols = [c for c in by if c in header]
+        for c in by:
+            if c not in header:
+                print('WARNING: no '+c+' column in '+path)
+        con.execute('CREATE TEMP TABLE cov ("Sub" TEXT PRIMARY KEY'
+                    +''.join(', '+_q(c)+' TEXT' for c in cols)+')')
+        con.executemany('INSERT OR REPLACE INTO cov VALUES ('+', '.join('?'*(len(cols)+1))+')',
+                        ((r[sub],)+tuple(r[c] or 'n/a' for c in cols) for r in reader))
+    return cols
+
+
+def measure_stats(con, table, col, nbins=NBINS):
+    """Count, mean, SD, histogram and percentiles of a column, read in chunks."""
+    from cohortstats import PERCENTILES
+    src = table+'.qc'
+    where = ' FROM '+src+' WHERE '+_numeric(col)
+    n, lo, hi, mean = con.execute('SELECT COUNT(*), MIN('+_q(col)+'), MAX('+_q(col)+'), AVG('+_q(col)+')'
+                                  +where).fetchone()
+    if not n:
+        return None
+    # second pass for the squared deviations (no cancellation for small SDs)
+    ssd = con.execute('SELECT SUM(('+_q(col)+' - ?)*('+_q(col)+' - ?))'+where, (mean, mean)).fetchone()[0]
+    std = _std(n, ssd)
+    edges = np.linspace(lo, hi if hi > lo else lo+1, nbins+1)
+    counts = np.zeros(nbins, dtype=np.int64)
+    cur = con.execute('SELECT '+_q(col)+where)
+    while True:
+        rows = cur.fetchmany(CHUNK)
+        if not rows:
+            break
+        counts += np.histogram(np.fromiter((r[0] for r in rows), float, len(rows)), edges)[0]
+    # percentiles from the cumulative histogram, linear within a bin
+    cdf = np.concatenate([[0], np.cumsum(counts)])/n
+    pct = {pc: float(np.interp(pc/100, cdf, edges)) for pc in PERCENTILES}
+    return {'n': n, 'mean': mean, 'std': std, 'min': lo, 'max': hi,
+            'counts': counts, 'edges': edges, 'percentiles': pct}
+
+
+def flag_limits(s):
+    """Values outside these limits are flagged (as cohortstats), None for small cohorts."""
+    from cohortstats import MIN_COHORT, Z_FLAG
+    if s['n'] < MIN_COHORT or not s['std'] > 0:
+        return None
+    return s['mean']-Z_FLAG*s['std'], s['mean']+Z_FLAG*s['std']
+
+
+def n_flagged(con, table, col, s):
+    lim = flag_limits(s)
+    if lim is None:
+        return None
+    return con.execute('SELECT COUNT(*) FROM '+table+'.qc WHERE '+_numeric(col)+' AND ('
+                       +_q(col)+' < ? OR '+_q(col)+' > ?)', lim).fetchone()[0]
+
+
+def worst(con, table, col, tail, s, n=NWORST):
+    """Subject, value and z of the n worst subjects of a measure."""
+    order = {'low': _q(col)+' ASC', 'high': _q(col)+' DESC', 'both': 'ABS('+_q(col)+' - ?) DESC'}[tail]
+    params = (s['mean'],) if tail == 'both' else ()
+    rows = con.execute('SELECT "Sub", '+_q(col)+' FROM '+table+'.qc WHERE '+_numeric(col)
+                       +' ORDER BY '+order+' LIMIT ?', params+(n,)).fetchall()
+    z = lambda x: (x-s['mean'])/s['std'] if s['std'] > 0 else float('nan')
+    return [(str(sub), x, z(x)) for sub, x in rows]
+
+
+def breakdown(con, table, col, by, s, limit=MAX_GROUPS):
+    """n, mean, SD and flagged subjects of a measure per value of a covariate.
+
+    Subjects missing from the covariates table are grouped as n/a.
+    """
+    lim = flag_limits(s) or (-np.inf, np.inf)
+    # deviations from the cohort mean: the group variance is well conditioned
+    x = '(qc.'+_q(col)+' - ?)'
+    rows = con.execute('SELECT COALESCE(cov.'+_q(by)+", 'n/a') AS g, COUNT(*), AVG("+x+'), SUM('+x+'*'+x+'), '
+                       'SUM(qc.'+_q(col)+' < ? OR qc.'+_q(col)+' > ?) FROM '+table+'.qc AS qc LEFT JOIN cov '
+                       'ON cov."Sub" = CAST(qc."Sub" AS TEXT) WHERE '+_numeric(col, 'qc.')
+                       +' GROUP BY g ORDER BY COUNT(*) DESC, g LIMIT ?',
+                       (s['mean'],)*3+tuple(lim)+(limit,)).fetchall()
+    out = []
+    for g, n, dev, ssd, flagged in rows:
+        out.append({'group': str(g), 'n': n, 'mean': s['mean']+dev, 'std': _std(n, ssd-n*dev*dev),
+                    'flagged': int(flagged or 0)})
+    return out
+
+
+def shell_cnr(qc_root):
+    """Cohort statistics of the subject median WM CNR of each shell.
+
+    The DTI metrics of <qc_root>/*/metrics are read one subject at a time.
+    """
+    import metrics
+    from cohortstats import RunningStats
+    stats = {}
+    nsub = 0
+    with os.scandir(qc_root) as it:
+        for entry in it:
+            prefix = os.path.join(entry.path, 'metrics', 'dti')
+            if not entry.is_dir() or not os.path.isfile(prefix+'.json'):
+                continue
+            try:
+                m, _ = metrics.load(prefix, 'dti')
+            except (OSError, ValueError) as e:
+                print('WARNING: '+str(e))
+                continue
+            shell = np.asarray(m['shell'])
+            cnr = np.asarray(m['cnr_wm'])
+            for b in np.unique(shell):
+                v = cnr[(shell == b) & np.isfinite(cnr)]
+                if v.size:
+                    stats.setdefault(int(b), RunningStats()).add(float(np.median(v)))
+            nsub += 1
+    return nsub, dict(sorted(stats.items()))
+
+
+def compute(args):
+    """Cohort statistics of every measure found in the group tables."""
+    con, tables = connect(args.group_dir)
+    if not tables:
+        raise ValueError('No group tables in '+args.group_dir)
+    by = []
+    if args.covariates:
+        by = load_covariates(con, args.covariates, [c for c in args.by.split(',') if c])
+    out = {'tables': {t: con.execute('SELECT COUNT(*) FROM '+t+'.qc').fetchone()[0] for t in tables},
+           'measures': [], 'by': by}
+    try:
+        for col, table, label, tail in MEASURES:
+            if col not in tables.get(table, []):
+                continue
+            s = measure_stats(con, table, col)
+            if s is None:
+                continue
+            s.update(col=col, table=table, label=label, tail=tail,
+                     flagged=n_flagged(con, table, col, s),
+                     worst=worst(con, table, col, tail, s, args.worst),
+                     groups={c: breakdown(con, table, col, c, s) for c in by})
+            out['measures'].append(s)
+    finally:
+        con.close()
+    out['cnr'] = shell_cnr(args.qc_root) if args.qc_root else None
+    return out
+
+
+def _grid(fig, n, ncols=2):
+    nrows = max(1, int(np.ceil(n/ncols)))
+    gs = fig.add_gridspec(nrows, ncols)
+    return [fig.add_subplot(gs[i//ncols, i % ncols]) for i in range(n)]
+
+
+def _distributions(m):
+    import render as rd
+    fig = rd.a4_figure(tight_layout=True)
+    ncnr = m['cnr'] is not None and bool(m['cnr'][1])
+    axes = _grid(fig, len(m['measures'])+ncnr)
+    for ax, s in zip(axes, m['measures']):
+        rd.hist(ax, s['counts'], s['edges'], alpha=0.5, ec='k', fc='tab:blue')
+        ax.axvline(s['mean'], color='k', linewidth=1)
+        lim = flag_limits(s)
+        for x in lim or []:
+            ax.axvline(x, color='r', linestyle='--', linewidth=0.8)
+        ax.set_xlim(s['edges'][0], s['edges'][-1])
+        ax.set_title(s['label'], fontsize=10)
+        ax.annotate('n={}  mean={:.3g} +/- {:.3g}  flagged={}'.format(
+                    s['n'], s['mean'], s['std'], '-' if s['flagged'] is None else s['flagged']),
+                    (0.02, 0.92), xycoords='axes fraction', fontsize=7)
+        ax.ticklabel_format(axis='x', style='sci', scilimits=(-3, 4))
+        ax.tick_params(labelsize=7)
+    if ncnr:
+        from cohortstats import PERCENTILES
+        ax = axes[-1]
+        nsub, stats = m['cnr']
+        x = np.arange(len(stats))
+        lo, hi = PERCENTILES[0], PERCENTILES[-1]
+        ax.errorbar(x, [s.mean for s in stats.values()], [s.std for s in stats.values()],
+                    marker='o', linestyle='none', label='mean +/- SD')
+        band = [(s.percentile(lo), s.percentile(hi)) for s in stats.values()]
+        if all(p is not None for b in band for p in b):
+            ax.vlines(x+0.15, *zip(*band), color='tab:orange', label='P'+str(lo)+' - P'+str(hi))
+        ax.set_xticks(x)
+        ax.set_xticklabels(['b='+str(b) for b in stats], fontsize=7)
+        ax.set_title('Median CNR in WM per shell ({} subjects)'.format(nsub), fontsize=10)
+        ax.legend(fontsize=7)
+    fig.suptitle('Cohort QC '+str(date)+' - subjects: '+', '.join(
+                 '{} {}'.format(t, n) for t, n in m['tables'].items()), fontsize=12)
+    return fig
+
+
+def _tables(m, nworst):
+    import render as rd
+    from cohortstats import PERCENTILES, Z_FLAG
+    fig = rd.a4_figure()
+    fmt = '{:.4g}'.format
+    nrows = int(np.ceil(len(m['measures'])/2))
+    gs = fig.add_gridspec(1+nrows, 2, height_ratios=[1.2]+[1]*nrows, left=0.05, right=0.95,
+                          top=0.93, bottom=0.03, hspace=0.35, wspace=0.1)
+    ax = fig.add_subplot(gs[0, :])
+    ax.set_axis_off()
+    rows = [[s['label'], str(s['n']), fmt(s['mean'])+' +/- '+fmt(s['std']),
+             ' / '.join(fmt(s['percentiles'][pc]) for pc in PERCENTILES),
+             '-' if s['flagged'] is None else str(s['flagged'])] for s in m['measures']]
+    table = ax.table(cellText=rows, bbox=[0, 0, 1, 1], cellLoc='center', colWidths=[0.3, 0.08, 0.25, 0.27, 0.1],
+                     colLabels=['Measure', 'n', 'Mean +/- SD', 'P'+'/P'.join(str(p) for p in PERCENTILES),
+                                'Flagged'])
+    table.auto_set_font_size(False)
+    table.set_fontsize(7)
+    ax.set_title('Cohort summary (flag: |z| > '+str(Z_FLAG)+')', fontsize=10)
+    for i, s in enumerate(m['measures']):
+        ax = fig.add_subplot(gs[1+i//2, i % 2])
+        ax.set_axis_off()
+        rows = [[str(r+1), sub, fmt(x), '{:+.2f}'.format(z)] for r, (sub, x, z) in enumerate(s['worst'])]
+        colors = [['#f4c7c3' if abs(z) > Z_FLAG else 'w']*4 for _, _, z in s['worst']]
+        height = min(1.0, (len(rows)+1)/(nworst+1))
+        table = ax.table(cellText=rows, cellColours=colors, bbox=[0, 1-height, 1, height], cellLoc='center',
+                         colWidths=[0.1, 0.45, 0.25, 0.2], colLabels=['#', 'Subject', 'Value', 'z'])
+        table.auto_set_font_size(False)
+        table.set_fontsize(6)
+        tail = {'low': 'lowest', 'high': 'highest', 'both': 'largest |z|'}[s['tail']]
+        ax.set_title(s['label']+' - '+tail, fontsize=9)
+    fig.suptitle('Cohort summary and worst subjects', fontsize=12)
+    return fig
+
+
+def _breakdown(m, by):
+    import render as rd
+    fig = rd.a4_figure(tight_layout=True)
+    axes = _grid(fig, len(m['measures']))
+    for ax, s in zip(axes, m['measures']):
+        groups = s['groups'][by]
+        x = np.arange(len(groups))
+        ax.errorbar(x, [g['mean'] for g in groups], [g['std'] for g in groups], marker='o', linestyle='none')
+        ax.axhline(s['mean'], color='k', linewidth=0.8)
+        ax.set_xticks(x)
+        ax.set_xticklabels(['{} ({}{})'.format(g['group'], g['n'], ', '+str(g['flagged'])+' fl.' if g['flagged'] else '')
+                            for g in groups], rotation=45, ha='right', fontsize=6)
+        ax.set_title(s['label'], fontsize=10)
+        ax.tick_params(axis='y', labelsize=7)
+    fig.suptitle('QC measures per '+by+' (mean +/- SD, n subjects, flagged)', fontsize=12)
+    return fig
+
+
+def render(m, args):
+    """Write the cohort report pages."""
+    import render as rd
+    print('Creating cohort QC report')
+    if not m['measures']:
+        raise ValueError('No QC measures in the group tables of '+args.group_dir)
+    figs = [_distributions(m), _tables(m, args.worst)] + [_breakdown(m, by) for by in m['by']]
+    rd.save_pages(figs, args.pdf_output, rd.parse_formats(args.format), 'Cohort QC')
+    print('Cohort QC report saved!')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+            description='Create the cohort QC report from the group QC tables')
+    parser.add_argument('group_dir', help='Group QC directory (group_*.sqlite)')
+    parser.add_argument('pdf_output', help='Cohort report')
+    parser.add_argument('--covariates', default=None,
+                        help='Tab-separated table with a subj (or Sub) column, e.g. the batch manifest')
+    parser.add_argument('--by', default='site,scanner',
+                        help='Comma-separated covariate columns for the breakdowns. Default: site,scanner')
+    parser.add_argument('--qc_root', default=None,
+                        help='Directory of the subject QC folders: adds the WM CNR per shell from their metrics')
+    parser.add_argument('--worst', default=NWORST, type=int,
+                        help='Worst subjects listed per measure. Default='+str(NWORST))
+    parser.add_argument('--format', default='pdf', type=str,
+                        help='Comma-separated report formats (pdf,png,html). Default: pdf')
+    return parser
+
+
+def run(args):
+    from qclog import phase
+    with phase('group', 'compute', 'cohort'):
+        m = compute(args)
+    with phase('group', 'render', 'cohort'):
+        render(m, args)
+    return m
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    try:
+        run(args)
+    except (OSError, ValueError) as e:
+        print('ERROR: '+str(e))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
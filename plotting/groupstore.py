@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Concurrency-safe group QC store.
+
+Each group table (group_dti,snr / group_motion / group_eddyoutliers) lives in
+a SQLite file next to its text export. Appending a subject is a single
+INSERT under the database write lock, so concurrent dwi_qa.sh runs never
+lose rows and an append does not grow with the cohort. The fixed-width text
+file is regenerated by export() from a snapshot of the database, outside
+the write lock, and replaced atomically, keeping the layout of previous
+versions: qc_reports.py exports the tables of a subject once its reports
+are done (unless DWIQAC_GROUP_EXPORT=0, as set by dwi_qa_batch.py, which
+exports once at the end). An existing text file is imported once when the
+database is created. Re-running a subject replaces its previous row and
+its values in the running statistics, except in the percentile sketches,
+which cannot forget a value: after many re-runs, rebuild them from the
+stored rows with 'groupstore.py rebuild'.
+
+Usage: groupstore.py export|stats|rebuild group_motion.sqlite [group_motion.txt]
+"""
+
+import argparse
+import os
+import sqlite3
+import tempfile
+
+import numpy as np
+
+from cohortstats import RunningStats, is_number
+
+TABLE = 'qc'
+STATS = 'qc_stats'
+# set to 0 to leave the text export to the caller (batch runs)
+EXPORT_ENV = 'DWIQAC_GROUP_EXPORT'
+
+
+def _quote(name):
+    return '"'+str(name).replace('"', '""')+'"'
+
+
+def _value(v):
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+
+class GroupStore:
+
+    def __init__(self, txt_path, timeout=600):
+        self.txt_path = txt_path
+        self.db_path = os.path.splitext(txt_path)[0]+'.sqlite'
+        self.timeout = timeout
+
+    def _connect(self):
+        con = sqlite3.connect(self.db_path, timeout=self.timeout, isolation_level=None)
+        return con
+
+    def _columns(self, con):
+        return [r[1] for r in con.execute('PRAGMA table_info('+TABLE+')')]
+
+    def _ensure_columns(self, con, names):
+        cols = self._columns(con)
+        if not cols:
+            con.execute('CREATE TABLE '+TABLE+' ('+', '.join(_quote(n) for n in names)+')')
+            if 'Sub' in names:
+                con.execute('CREATE INDEX '+TABLE+'_sub ON '+TABLE+' ("Sub")')
+            return
+        for n in names:
+            if n not in cols:
+                con.execute('ALTER TABLE '+TABLE+' ADD COLUMN '+_quote(n))
+
+    def _insert(self, con, row):
+        self._ensure_columns(con, list(row))
+        con.execute('INSERT INTO '+TABLE+' ('+', '.join(_quote(n) for n in row)+') VALUES ('
+                    +', '.join('?'*len(row))+')', [_value(v) for v in row.values()])
+
+    def _stats_table(self, con):
+        """Create the statistics table, from the rows already stored (once)."""
+        if con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (STATS,)).fetchone():
+            return
+        con.execute('CREATE TABLE '+STATS+' (name TEXT PRIMARY KEY, n INTEGER, mean REAL, m2 REAL, sketch TEXT)')
+        if not self._columns(con):
+            return
+        stats = {}
+        cur = con.execute('SELECT * FROM '+TABLE+' ORDER BY rowid')
+        names = [d[0] for d in cur.description]
+        for values in cur:
+            for name, v in zip(names, values):
+                if name != 'Sub' and is_number(v):
+                    stats.setdefault(name, RunningStats()).add(float(v))
+        self._save_stats(con, stats)
+
+    def _load_stats(self, con, names):
+        names = list(names)
+        if not names:
+            return {}
+        rows = con.execute('SELECT name, n, mean, m2, sketch FROM '+STATS+' WHERE name IN ('
+                           +', '.join('?'*len(names))+')', names)
+        return {r[0]: RunningStats(*r[1:]) for r in rows}
+
+    def _save_stats(self, con, stats):
+        con.executemany('INSERT OR REPLACE INTO '+STATS+' (name, n, mean, m2, sketch) VALUES (?, ?, ?, ?, ?)',
+                        [(name, s.n, s.mean, s.m2, s.sketch()) for name, s in stats.items()])
+
+    def _update_stats(self, con, row, old):
+        """Compare row with the cohort, then add it (replacing old) to the statistics."""
+        new = {k: float(v) for k, v in row.items() if k != 'Sub' and is_number(v)}
+        old = {k: float(v) for k, v in (old or {}).items() if k != 'Sub' and is_number(v)}
+        stats = self._load_stats(con, set(new) | set(old))
+        for name, x in old.items():
+            stats.setdefault(name, RunningStats()).remove(x)
+        cohort = {}
+        for name, x in new.items():
+            s = stats.setdefault(name, RunningStats())
+            cohort[name] = s.compare(x)
+            s.add(x, sketch=name not in old)
+        self._save_stats(con, stats)
+        return cohort
+
+    def _import_txt(self, con):
+        # previous versions kept the group table only as df.to_string() output
+        import pandas as pd
+        print('Importing existing group QC text file into', self.db_path)
+        df = pd.read_fwf(self.txt_path)
+        df = df.loc[:, [c for c in df.columns if not str(c).startswith('Unnamed')]]
+        for row in df.to_dict('records'):
+            self._insert(con, row)
+
+    def append(self, row):
+        """Append one subject row, the text export is not refreshed (see export()).
+
+        A previous row of the same subject (stage re-run) is replaced; its
+        values stay in the percentile sketches (see rebuild_stats()).
+        Returns the comparison of each numeric measure with the cohort
+        (see cohortstats.RunningStats.compare).
+        """
+        con = self._connect()
+        try:
+            con.execute('BEGIN IMMEDIATE')
+            if not self._columns(con) and os.path.isfile(self.txt_path):
+                self._import_txt(con)
+            self._stats_table(con)
+            old = None
+            if row.get('Sub') and 'Sub' in self._columns(con):
+                cur = con.execute('SELECT * FROM '+TABLE+' WHERE "Sub" = ?', (str(row['Sub']),))
+                names = [d[0] for d in cur.description]
+                prev = cur.fetchone()
+                old = dict(zip(names, prev)) if prev else None
+                con.execute('DELETE FROM '+TABLE+' WHERE "Sub" = ?', (str(row['Sub']),))
+            cohort = self._update_stats(con, row, old)
+            self._insert(con, row)
+            con.execute('COMMIT')
+        except BaseException:
+            con.execute('ROLLBACK')
+            raise
+        finally:
+            con.close()
+        return cohort
+
+    def stats(self):
+        """Running statistics of every numeric column, by column name."""
+        con = self._connect()
+        try:
+            con.execute('BEGIN IMMEDIATE')
+            self._stats_table(con)
+            rows = con.execute('SELECT name, n, mean, m2, sketch FROM '+STATS+' ORDER BY name').fetchall()
+            con.execute('COMMIT')
+        finally:
+            con.close()
+        return {r[0]: RunningStats(*r[1:]) for r in rows}
+
+    def rebuild_stats(self):
+        """Recompute the running statistics, sketches included, from the stored rows."""
+        con = self._connect()
+        try:
+            con.execute('BEGIN IMMEDIATE')
+            con.execute('DROP TABLE IF EXISTS '+STATS)
+            self._stats_table(con)
+            con.execute('COMMIT')
+        except BaseException:
+            con.execute('ROLLBACK')
+            raise
+        finally:
+            con.close()
+
+    def compare(self, row):
+        """Compare a subject row with the cohort without storing it.
+
+        A stored row of the same subject is left out of the statistics, as
+        in append(). Returns None when the database does not exist.
+        """
+        if not os.path.isfile(self.db_path):
+            return None
+        con = self._connect()
+        try:
+            con.execute('BEGIN IMMEDIATE')
+            self._stats_table(con)
+            old = {}
+            if row.get('Sub') and 'Sub' in self._columns(con):
+                cur = con.execute('SELECT * FROM '+TABLE+' WHERE "Sub" = ?', (str(row['Sub']),))
+                prev = cur.fetchone()
+                old = dict(zip([d[0] for d in cur.description], prev)) if prev else {}
+            new = {k: float(v) for k, v in row.items() if k != 'Sub' and is_number(v)}
+            stats = self._load_stats(con, new)
+            con.execute('COMMIT')
+        finally:
+            con.close()
+        cohort = {}
+        for name, x in new.items():
+            s = stats.get(name, RunningStats())
+            if is_number(old.get(name)):
+                s.remove(float(old[name]))
+            cohort[name] = s.compare(x)
+        return cohort
+
+    def read(self, con=None):
+        """Whole group table as a DataFrame, in insertion order."""
+        import pandas as pd
+        own = con is None
+        con = con or self._connect()
+        try:
+            if not self._columns(con):
+                return pd.DataFrame()
+            return pd.read_sql_query('SELECT * FROM '+TABLE+' ORDER BY rowid', con)
+        finally:
+            if own:
+                con.close()
+
+    def _write(self, df, txt_path, order=None):
+        if order is not None and 'Sub' in df:
+            rank = {str(sub): i for i, sub in enumerate(order)}
+            key = df['Sub'].astype(str).map(rank).fillna(len(rank))
+            df = df.iloc[np.argsort(key.to_numpy(), kind='stable')].reset_index(drop=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(txt_path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as tfile:
+                tfile.write(df.to_string())
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, txt_path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def export(self, txt_path=None, order=None):
+        """Write the text layout of the group table (atomic replace).
+
+        The rows are read in one transaction and the file is written after
+        it, so appends are not held up by the export.
+        order: optional list of subject IDs giving the row order, rows of
+        other subjects follow in insertion order.
+        """
+        con = self._connect()
+        try:
+            con.execute('BEGIN')
+            df = self.read(con)
+            con.execute('COMMIT')
+        finally:
+            con.close()
+        self._write(df, txt_path or self.txt_path, order)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a group QC store to its text layout, print its cohort '
+                                     'statistics or rebuild them from the stored rows')
+    parser.add_argument('cmd', choices=['export', 'stats', 'rebuild'])
+    parser.add_argument('store', help='Group QC database (.sqlite) or its text file')
+    parser.add_argument('txt_output', nargs='?', default=None,
+                        help='Output text file. Default: next to the store')
+    args = parser.parse_args()
+    txt = os.path.splitext(args.store)[0]+'.txt'
+    if args.cmd == 'stats':
+        from cohortstats import PERCENTILES
+        print('{:<40} {:>7} {:>12} {:>12}'.format('measure', 'n', 'mean', 'std')
+              + ''.join('{:>12}'.format('p'+str(pc)) for pc in PERCENTILES))
+        for name, s in GroupStore(txt).stats().items():
+            print('{:<40} {:>7} {:>12.4g} {:>12.4g}'.format(name, s.n, s.mean, s.std)
+                  + ''.join('{:>12.4g}'.format(s.percentile(pc)) for pc in PERCENTILES))
+    elif args.cmd == 'rebuild':
+        GroupStore(txt).rebuild_stats()
+    else:
+        GroupStore(txt).export(args.txt_output)
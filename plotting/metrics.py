@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Per-subject metrics artifacts of the QC reports.
+
+The quantities computed by a report (compute() of noeddyqc.py, qc_motion.py
+and qc_ol.py: per-volume CNR and residuals, histogram counts, slices, motion
+traces, outlier matrices) are written as <prefix>.npz, holding the arrays,
+and <prefix>.json, holding the scalars, labels and the layout of the
+dictionary with a format version. render_reports.py rebuilds the reports
+from these files only, without reading the imaging data or eddy outputs.
+
+The cohort comparison is not stored: it changes as subjects are added and
+is read from the group tables when a report is rendered.
+"""
+
+import datetime
+import json
+import os
+
+import numpy as np
+
+# bumped when the content of compute() changes, older artifacts are refused
+VERSION = 1
+# key of an array reference in the JSON layout
+ARRAY = '__npz__'
+
+
+def paths(prefix):
+    return prefix+'.npz', prefix+'.json'
+
+
+def _split(obj, arrays):
+    """JSON layout of obj, arrays are moved to the arrays dict."""
+    if isinstance(obj, np.ndarray):
+        key = 'a'+str(len(arrays))
+        arrays[key] = obj
+        return {ARRAY: key}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, dict):
+        return {str(k): _split(v, arrays) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_split(v, arrays) for v in obj]
+    return obj
+
+
+def _join(obj, arrays):
+    if isinstance(obj, dict):
+        if set(obj) == {ARRAY}:
+            return arrays[obj[ARRAY]]
+        return {k: _join(v, arrays) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_join(v, arrays) for v in obj]
+    return obj
+
+
+def _replace(path, write):
+    tmp = path+'.tmp'
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def save(m, prefix, report, subj):
+    """Write the metrics of one report of a subject (atomic replace).
+
+    The npz is written first, so the JSON always describes a complete file.
+    """
+    npz, jsn = paths(prefix)
+    os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+    arrays = {}
+    layout = _split({k: v for k, v in m.items() if k != 'cohort'}, arrays)
+    doc = {'version': VERSION, 'report': report, 'subj': str(subj),
+           'created': datetime.datetime.now().isoformat(timespec='seconds'),
+           'metrics': layout}
+
+    def write_npz(tmp):
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+
+    def write_json(tmp):
+        with open(tmp, 'w') as f:
+            json.dump(doc, f, indent=1)
+
+    _replace(npz, write_npz)
+    _replace(jsn, write_json)
+    return jsn
+
+
+def load(prefix, report=None):
+    """Metrics dictionary and header (version, report, subj) of an artifact."""
+    npz, jsn = paths(prefix)
+    with open(jsn) as f:
+        doc = json.load(f)
+    if doc.get('version') != VERSION:
+        raise ValueError(jsn+' has metrics version '+str(doc.get('version'))+', expected '
+                         +str(VERSION)+': run the report again to recompute it')
+    if report is not None and doc.get('report') != report:
+        raise ValueError(jsn+' holds the '+str(doc.get('report'))+' metrics, not '+report)
+    with np.load(npz, allow_pickle=False) as z:
+        arrays = {k: z[k] for k in z.files}
+    m = _join(doc.pop('metrics'), arrays)
+    return m, doc
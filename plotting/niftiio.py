@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Streaming NIfTI access for the QC reports.
+
+4D series are never loaded whole: uncompressed files are memory-mapped and
+gzipped files are decompressed sequentially, one volume at a time. Data keep
+their on-disk dtype unless the header carries a scaling factor.
+"""
+
+import numpy as np
+import nibabel as nib
+
+
+def load_map(path):
+    """Load a 3D map (FA, MD, tSNR...) keeping the on-disk dtype."""
+    return np.asanyarray(nib.load(path).dataobj)
+
+
+def load_mask(path):
+    """Load a binary mask as a boolean array."""
+    return load_map(path) > 0
+
+
+def n_volumes(path):
+    """Number of volumes from the header only."""
+    shape = nib.load(path).shape
+    return shape[3] if len(shape) > 3 else 1
+
+
+def _is_scaled(proxy):
+    return not (proxy.slope in (None, 1.0) and proxy.inter in (None, 0.0))
+
+
+def decode_volume(buf, proxy, shape):
+    """3D volume from its on-disk bytes, scaled when the header says so."""
+    vol = np.frombuffer(buf, dtype=proxy.dtype).reshape(shape, order='F')
+    if _is_scaled(proxy):
+        vol = vol.astype(np.float32)*np.float32(proxy.slope) + np.float32(proxy.inter)
+    return vol
+
+
+def iter_volumes(path, vols=None):
+    """Yield (index, volume) for each 3D volume of a NIfTI series.
+
+    Peak memory is one volume whatever the series length. vols restricts
+    the output to the given volume indices (in increasing order); gzipped
+    volumes in between are decompressed but not copied.
+    """
+    img = nib.load(path, mmap=True)
+    proxy = img.dataobj
+    shape = img.shape[:3]
+    nvols = img.shape[3] if len(img.shape) > 3 else 1
+    dtype = proxy.dtype
+    scaled = _is_scaled(proxy)
+    fname = proxy.file_like
+
+    vols = range(nvols) if vols is None else sorted(vols)
+
+    if not str(fname).endswith('.gz') and not scaled:
+        data = np.memmap(fname, dtype=dtype, mode='r', offset=proxy.offset,
+                         shape=shape+(nvols,), order='F')
+        for i in vols:
+            yield i, data[..., i]
+        return
+
+    nbytes = int(np.prod(shape))*dtype.itemsize
+    with nib.openers.ImageOpener(fname) as fobj:
+        for i in vols:
+            fobj.seek(proxy.offset+i*nbytes)
+            buf = fobj.read(nbytes)
+            if len(buf) != nbytes:
+                raise IOError('Truncated NIfTI data in '+str(fname)+' at volume '+str(i))
+            yield i, decode_volume(buf, proxy, shape)
+
+
+def flat_indices(mask):
+    """Flat voxel indices of a mask, in the on-disk (Fortran) voxel order."""
+    return np.flatnonzero(np.asarray(mask).ravel(order='F'))
+
+
+class _RoiBatch:
+    """All ROIs gathered with a single fancy index per volume."""
+
+    def __init__(self, masks):
+        idx = [m if m.ndim == 1 else flat_indices(m) for m in masks]
+        self.counts = np.array([i.size for i in idx])
+        self.index = np.concatenate(idx) if idx else np.zeros(0, int)
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]])
+        self.valid = self.counts > 0
+
+    def gather(self, vol):
+        return np.asarray(vol).ravel(order='F')[self.index].astype(np.float64)
+
+    def sums(self, v):
+        out = np.zeros(self.counts.size)
+        out[self.valid] = np.add.reduceat(v, self.starts[self.valid]) if v.size else 0
+        return out
+
+    def means(self, v):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.valid, self.sums(v)/self.counts, np.nan)
+
+
+def roi_volume_stats(path, masks):
+    """Per-volume mean and std inside each mask.
+
+    Masks are boolean volumes or flat index arrays (see flat_indices).
+    Returns two arrays of shape (len(masks), nvols).
+    """
+    batch = _RoiBatch(masks)
+    nvols = n_volumes(path)
+    mean = np.full((len(masks), nvols), np.nan)
+    std = np.full((len(masks), nvols), np.nan)
+    for i, vol in iter_volumes(path):
+        v = batch.gather(vol)
+        mean[:, i] = batch.means(v)
+        d = v - np.repeat(mean[:, i][batch.valid], batch.counts[batch.valid])
+        std[:, i] = np.sqrt(batch.means(d*d))
+    return mean, std
+
+
+def roi_volume_summary(path, masks, q=(5, 25, 50, 75, 95)):
+    """Per-volume mean, std and percentiles q inside each mask, in one pass.
+
+    Returns mean and std of shape (len(masks), nvols) and the percentiles
+    of shape (len(masks), nvols, len(q)).
+    """
+    batch = _RoiBatch(masks)
+    nvols = n_volumes(path)
+    mean = np.full((len(masks), nvols), np.nan)
+    std = np.full((len(masks), nvols), np.nan)
+    pct = np.full((len(masks), nvols, len(q)), np.nan)
+    ends = batch.starts + batch.counts
+    for i, vol in iter_volumes(path):
+        v = batch.gather(vol)
+        mean[:, i] = batch.means(v)
+        d = v - np.repeat(mean[:, i][batch.valid], batch.counts[batch.valid])
+        std[:, i] = np.sqrt(batch.means(d*d))
+        for r in np.flatnonzero(batch.valid):
+            pct[r, i] = np.percentile(v[batch.starts[r]:ends[r]], q)
+    return mean, std, pct
+
+
+def roi_mean_square(path, masks):
+    """Per-volume mean of the squared values inside each mask.
+
+    Returns an array of shape (len(masks), nvols).
+    """
+    batch = _RoiBatch(masks)
+    ms = np.full((len(masks), n_volumes(path)), np.nan)
+    for i, vol in iter_volumes(path):
+        v = batch.gather(vol)
+        ms[:, i] = batch.means(v*v)
+    return ms
+
+
+def roi_signal_means(path, masks):
+    """Per-volume mean raw and b0-normalised signal inside each mask.
+
+    The first volume is taken as the reference b0, as in the reports. All
+    ROIs come out of a single pass over the series and only the ROI voxels
+    of the reference b0 are kept in memory.
+    Returns two arrays of shape (len(masks), nvols).
+    """
+    batch = _RoiBatch(masks)
+    nvols = n_volumes(path)
+    raw = np.full((len(masks), nvols), np.nan)
+    norm = np.full((len(masks), nvols), np.nan)
+    b0 = None
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i, vol in iter_volumes(path):
+            v = batch.gather(vol)
+            if b0 is None:
+                b0 = v
+            raw[:, i] = batch.means(v)
+            norm[:, i] = batch.means(v/b0)
+    return raw, norm
+
+
+class VolumeWriter:
+    """Write a 4D NIfTI volume by volume (gzipped if the name ends in .gz)."""
+
+    def __init__(self, path, ref_img, nvols, dtype=np.float32):
+        self.path = path
+        hdr = nib.Nifti1Header.from_header(ref_img.header)
+        hdr.extensions.clear()
+        hdr.set_data_dtype(dtype)
+        hdr.set_data_shape(ref_img.shape[:3]+(nvols,))
+        hdr.set_data_offset(352)
+        hdr.set_slope_inter(1, 0)
+        self.dtype = np.dtype(dtype)
+        self.fobj = nib.openers.ImageOpener(path, 'wb')
+        hdr.write_to(self.fobj)
+
+    def write(self, vol):
+        self.fobj.write(np.asarray(vol, dtype=self.dtype).tobytes(order='F'))
+
+    def close(self):
+        self.fobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -4,203 +4,258 @@
 #cmaffei@mgh.harvard.edu
 
 import argparse
-##########################
-import nibabel as nib
+import os
 import numpy as np
-import matplotlib.pyplot as pltm
-import pandas as pd
-import seaborn as sns
 ##########################
-import os.path
 from datetime import date
-from PIL import Image
+from qcinputs import QCInputs
 date = date.today().strftime('%d%m%y')
+# heavy libraries (nibabel, matplotlib, seaborn, pandas) are imported
+# by the functions that need them
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+            description='Create QC summary as PDF and saves updated dataframes with qc values for single subject')
+    parser.add_argument('qcdir', metavar='qcdir',type=str,
+                            help='QC directory')
+    parser.add_argument('subj', metavar='subj', help='Subj ID')
+    parser.add_argument('pdf_output', metavar='pdf_output', type = str,
+                            help='File with qc plots and screenshots')
+    parser.add_argument('txt_output', metavar='txt_output', type=str,
+                            help='Text file with qc params')
+    parser.add_argument('wm_mask', metavar='wm_mask', type=str,
+                            help='White Matter Binary Mask')
+    parser.add_argument('bvals', metavar='bvals', type=str,
+                            help='Bval file')
+    parser.add_argument('data', metavar='data', type=str,
+                            help='DWI data')
+    #optional args
+    parser.add_argument('--gm_mask', default = None, metavar='gm_mask',type=str,
+                            help='Gray Matter Binary Mask')
+    parser.add_argument('--csf_mask', default = None, metavar='csf_mask',type=str,
+                            help='Gray Matter Binary Mask')
+    parser.add_argument('--bvecs', default = None, metavar='bvecs',type=str,
+                            help='Bvec file. If given, DTIFIT residuals are computed from dtifit_tensor/dtifit_S0 '
+                                 'instead of being read from dtifit_residuals.nii.gz')
+    parser.add_argument('--metrics', default = None, metavar='metrics', type=str,
+                            help='Also write the computed metrics to <metrics>.npz/.json (render_reports.py)')
+    parser.add_argument('--format', default = 'pdf', metavar='format', type=str,
+                            help='Comma-separated report formats (pdf,png,html). Default: pdf')
+    return parser
+
+
+def compute(args, inputs):
+    """Load the subject data and compute every quantity shown in the report."""
+    from niftiio import load_map, roi_volume_stats, roi_signal_means
+    from render import dec_slices
+    from tensorfit import residual_stats
+    ############### Directories ################
+    qcdir = args.qcdir
+    dtdir = qcdir+'/dtifit'
+    ########### Loading data #############
+    # tissue masks are loaded once, their voxel indices and statistics are cached
+    rois = inputs.rois(args.wm_mask, args.gm_mask, args.csf_mask)
+    fa = load_map(dtdir+'/dtifit_FA.nii.gz')
+    md = load_map(dtdir+'/dtifit_MD.nii.gz')
+    rois.add_map('FA', fa)
+    rois.add_map('MD', md)
+    tsnr = load_map(qcdir+'/bzeros_snr.nii.gz')
+    cnr_wm = np.loadtxt(qcdir+'/cnrwm.txt')
+    gt = inputs.gradients(args.bvals)
+    bval = gt.bvals
+    # 4D images are streamed volume by volume, only per-volume summaries are kept
+    if args.bvecs:
+        res_mean, res_std = residual_stats(args.data, load_map(dtdir+'/dtifit_S0.nii.gz'),
+                                           load_map(dtdir+'/dtifit_tensor.nii.gz'), bval,
+                                           inputs.bvecs(args.bvecs), rois.indices(['WM']))
+    else:
+        res_mean, res_std = roi_volume_stats(dtdir+'/dtifit_residuals.nii.gz', rois.indices(['WM']))
+    sig, sig_norm = roi_signal_means(args.data, rois.indices())
+
+    y = int(tsnr.shape[1]/2)
+    z = int(tsnr.shape[2]/2)
+    # V1 coloured by direction and FA, rendered here instead of screenshots
+    v1_path = dtdir+'/dtifit_V1.nii.gz'
+    v1 = load_map(v1_path) if os.path.isfile(v1_path) else None
+    hist_rois = [n for n in ['WM', 'GM'] if n in rois.names]
+    return {'roinames': rois.names,
+            'bval': bval,
+            # shell b-value of every volume: one box/point per shell
+            'shell': gt.volume_shells(),
+            'snr': np.loadtxt(qcdir+'/tsnr_orig.txt'),
+            'cnr_wm': np.divide(cnr_wm[:,0],cnr_wm[:,1]),
+            'tsnr_slice': tsnr[:,y,:],
+            'fa_slice': fa[:,:,z],
+            'md_slice': md[:,:,z],
+            'md_max': md.max(),
+            'v1_cor': None if v1 is None else dec_slices(fa, v1, 1, y)[0],
+            'v1_ax': None if v1 is None else dec_slices(fa, v1, 2, z)[0],
+            'hist_rois': hist_rois,
+            'fa_hist': [rois.hist('FA', r) for r in hist_rois],
+            'md_hist': [rois.hist('MD', r) for r in hist_rois],
+            'fa_wm': (rois.mean('FA','WM'), rois.std('FA','WM')),
+            'md_wm': (rois.mean('MD','WM'), rois.std('MD','WM')),
+            'res_mean': res_mean[0],
+            'res_std': res_std[0],
+            'sig': sig,
+            'sig_norm': sig_norm}
+
+
+def _layout():
+    import render as rd
+    fig = rd.a4_figure(dpi=300, tight_layout=True)
+    gs = fig.add_gridspec(5, 4, height_ratios=[3,2,3,2,2])
+    axes = {'tsnr': fig.add_subplot(gs[0,0:2]), 'cnr': fig.add_subplot(gs[0,2:4]),
+            'fa': fig.add_subplot(gs[1,0:1]), 'md': fig.add_subplot(gs[1,1:2]),
+            'fa_hist': fig.add_subplot(gs[1,2:3]), 'md_hist': fig.add_subplot(gs[1,3:4]),
+            'v1_cor': fig.add_subplot(gs[2:3,0:2]), 'v1_ax': fig.add_subplot(gs[2:3,2:4]),
+            'res': fig.add_subplot(gs[3,0:2]),
+            'sig_log': fig.add_subplot(gs[3,2:3]), 'sig': fig.add_subplot(gs[3,3:4]),
+            'cohort': fig.add_subplot(gs[4,0:4])}
+    return fig, axes
+
+
+def render(m, args):
+    """Plot the report (PDF/PNG/HTML) from the computed quantities."""
+    import warnings
+    import matplotlib.pyplot as pltm
+    import pandas as pd
+    import seaborn as sns
+    import render as rd
+    from rois import COLORS
+    bval = m['bval']
+    snr = m['snr']
+    ########### Plot DTIFIT Results #############
+    print('Creating QC PDF')
+    fig, ax = rd.template('dti', _layout)
+
+    #tSNR
+    ax1 = ax['tsnr']
+    ax1.set_title('SNR b=0 s/mm$^2$', fontsize=12)
+    img = rd.image(ax1, m['tsnr_slice'].T, cmap=pltm.cm.jet, origin='lower', vmin = 0, vmax=35)
+    rd.colorbar(fig, img, ax1)
+    ax1.annotate('Mean:'+str("{:.2f}".format(snr[0]))+'+/-'+str("{:.2f}".format(snr[1])),(0, 0), c = 'w')
+
+    #CNR
+    ax2 = sns.boxplot(x=m['shell'],y=m['cnr_wm'], ax=ax['cnr'])
+    ax2.set_xlabel('b-value', fontsize = 12, labelpad=0)
+    ax2.set_ylabel('CNR', fontsize = 12)
+    ax2.tick_params(labelsize=8, labelrotation = 35, axis='x')
+    ax2.tick_params(axis='y', direction = "in", pad = -22)
+    ax2.set_title('CNR in WM per shell', fontsize = 12)
+
+    #FA MD screenshots
+    ax3 = ax['fa']
+    ax4 = ax['md']
+    rd.image(ax3, m['fa_slice'].T, cmap=pltm.cm.gray, origin='lower', vmin = 0, vmax=0.6)
+    rd.image(ax4, m['md_slice'].T, cmap=pltm.cm.gray, origin='lower', vmin = 0)
+    ax3.set_title('FA')
+    ax4.set_title('MD')
+
+    # FA Histograms
+    ax5 = ax['fa_hist']
+    for r, (counts, edges) in zip(m['hist_rois'], m['fa_hist']):
+     rd.hist(ax5, counts, edges, alpha = 0.3, ec='k', label=r, fc = COLORS[r])
+    ax5.set_xlim(0,1)
+    ax5.annotate('WM:'+str("{:.2f}".format(np.abs(m['fa_wm'][0])))+'(+/-'+str("{:.2f}".format(np.abs(m['fa_wm'][1])))+')',
+                     (0.0, ax5.get_ylim()[1]/2), fontsize = 9)
+    ax5.ticklabel_format(axis='y', style='sci', scilimits=(0, 0))
+    ax5.set_title('FA', fontsize=9)
+    # MD Histograms
+    ax6 = ax['md_hist']
+    for r, (counts, edges) in zip(m['hist_rois'], m['md_hist']):
+     rd.hist(ax6, counts, edges, alpha = 0.3, ec='k', label=r, fc = COLORS[r])
+    ax6.ticklabel_format(style='sci', axis = 'x', scilimits = (0,0))
+    ax6.set_xlim(0,m['md_max'])
+    ax6.annotate('WM:'+str("{:.2e}".format(np.abs(m['md_wm'][0])))+'(+/-'+str("{:.2e}".format(np.abs(m['md_wm'][1])))+')',
+                     (0.0001, ax6.get_ylim()[1]/2), fontsize = 9)
+    ax6.set_title('MD [s/mm$^2$]', fontsize=9)
+    ax6.ticklabel_format(axis='y', style='sci', scilimits=(0, 0))
+    ax5.legend();
+
+    # DTIFIT V1
+    ax7 = ax['v1_cor']
+    ax8 = ax['v1_ax']
+    for a, key, plane in [(ax7, 'v1_cor', 'coronal'), (ax8, 'v1_ax', 'axial')]:
+        if m[key] is None:
+            a.text(0.5, 0.5, 'V1 not available', ha='center', va='center', transform=a.transAxes)
+        else:
+            rd.image(a, m[key], origin='lower')
+        a.set_title('DTIFit V1 - '+plane)
+    rd.hide_ticks(ax1, ax3, ax4, ax7, ax8)
+
+    #DTIFIT residuals
+    ax9 = ax['res']
+    x = list(range(1,len(bval)+1,1))
+    y = abs(m['res_mean'])
+    err = m['res_std']
+    ax9.errorbar(x,y,err, linestyle = None, marker = 'o', markersize = 3, linewidth = 0.3)
+    ax9.set_xlabel('DWI Volume', fontsize = 12)
+    ax9.set_title('Residual [a.u.]', fontsize = 12)
+
+    #signal
+    ax10 = ax['sig_log']
+    ax11 = ax['sig']
+
+    # log of empty ROI signals; seaborn < 0.13 warns on use_inf_as_na
+    with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+        warnings.filterwarnings("ignore", "use_inf_as_na")
+        for i, roiname in enumerate(m['roinames']):
+            df = pd.DataFrame()
+            df['bval'] = m['shell']
+            df['Signal [-]'] = m['sig'][i]
+            df['log'] = np.log(df['Signal [-]'])
+            df['Norm. Signal [-]'] = m['sig_norm'][i]
+            df.replace([np.inf, -np.inf], np.nan, inplace=True)
+            sns.lineplot(x='bval',y='log',data=df, legend='brief', marker='o',label = roiname,  markersize = 5,
+                err_style='bars', errorbar = 'sd', color = COLORS[roiname], ax=ax10)
+            sns.lineplot(x='bval',y='Signal [-]',data=df, legend='brief', marker='o',label = roiname,
+                         markersize = 5, err_style='bars', errorbar = 'sd', color = COLORS[roiname], ax=ax11)
+    ax11.ticklabel_format(axis='y', style='sci', scilimits=(0, 0))
+    ax10.set_ylabel('[]');  ax11.set_ylabel('[]');
+    ax10.set_title('Norm. Signal [-]', fontsize = 10); ax11.set_title('Signal [-]', fontsize = 10)
+
+    ###### Saving report
+    rd.cohort_table(ax['cohort'], m.get('cohort'))
+    fig.suptitle(' QC for Subject '+str(args.subj)+' '+str(date), fontsize = 14)
+    rd.save(fig, args.pdf_output, rd.parse_formats(args.format), 'QC for Subject '+str(args.subj))
+    print('PDF saved!')
+
+
+def group_row(m, subj):
+    #storing subject data
+    return {'Sub': str(subj),
+            'Average_SNR(b<100)': m['snr'][0],
+            'Mean_FA_WM': np.abs(m['fa_wm'][0]),
+            'Mean_MD_WM': np.abs(m['md_wm'][0])}
+
+
+def run(args, inputs=None):
+    from cohortstats import print_flags
+    from groupstore import GroupStore
+    import metrics
+    from qclog import phase
+    print('Plotting DTIFIT Results')
+    with phase('dti', 'compute', args.subj):
+        m = compute(args, inputs or QCInputs())
+    if args.metrics:
+        metrics.save(m, args.metrics, 'dti', args.subj)
+    ####### Creating dataframe and save data
+    print('Creating dataframe...')
+    #appending to the group store (locked; the text table is exported by qc_reports.py)
+    print('Appending data to group QC measures...')
+    with phase('dti', 'table', args.subj):
+        m['cohort'] = GroupStore(args.txt_output).append(group_row(m, args.subj))
+    print_flags(m['cohort'])
+    with phase('dti', 'render', args.subj):
+        render(m, args)
+    return m
+
+
+def main(argv=None):
+    run(get_parser().parse_args(argv))
+
 
-parser = argparse.ArgumentParser(
-        description='Create QC summary as PDF and saves updated dataframes with qc values for single subject')
-parser.add_argument('qcdir', metavar='qcdir',type=str, 
-                        help='QC directory')
-parser.add_argument('subj', metavar='subj', help='Subj ID')
-parser.add_argument('pdf_output', metavar='pdf_output', type = str,
-                        help='File with qc plots and screenshots')
-parser.add_argument('txt_output', metavar='txt_output', type=str,
-                        help='Text file with qc params')
-parser.add_argument('wm_mask', metavar='wm_mask', type=str,
-                        help='White Matter Binary Mask')
-parser.add_argument('bvals', metavar='bvals', type=str,
-                        help='Bval file')
-parser.add_argument('data', metavar='data', type=str,
-                        help='DWI data')
-#optional args
-parser.add_argument('--gm_mask', default = None, metavar='gm_mask',type=str,
-                        help='Gray Matter Binary Mask')
-parser.add_argument('--csf_mask', default = None, metavar='csf_mask',type=str,
-                        help='Gray Matter Binary Mask')
-
-args = parser.parse_args()
-############### Directories ################
-qcdir = args.qcdir
-dtdir = qcdir+'/dtifit'
-ssdir = qcdir+'/screenshots'
-########### Loading data #############
-print('Plotting DTIFIT Results')
-wm = nib.load(args.wm_mask).get_fdata()
-if args.gm_mask:
-    gm = nib.load(args.gm_mask).get_fdata()
-if args.csf_mask:
-    csf = nib.load(args.csf_mask).get_fdata()
-fa = nib.load(dtdir+'/dtifit_FA.nii.gz').get_fdata()
-md = nib.load(dtdir+'/dtifit_MD.nii.gz').get_fdata()
-res = nib.load(dtdir+'/dtifit_residuals.nii.gz').get_fdata()
-tsnr = nib.load(qcdir+'/bzeros_snr.nii.gz').get_fdata()
-snr = np.loadtxt(qcdir+'/tsnr_orig.txt')
-cnr_wm = np.loadtxt(qcdir+'/cnrwm.txt')
-cnr_wm = np.divide(cnr_wm[:,0],cnr_wm[:,1])
-bval = np.loadtxt(args.bvals)
-data = nib.load(args.data).get_fdata()
-########### Plot DTIFIT Results #############
-print('Creating QC PDF')
-fig = pltm.figure(dpi=300, tight_layout=True)
-fig.set_size_inches(8.27, 11.69, forward=True) #A4 size
-gs = fig.add_gridspec(5, 4, height_ratios=[3,2,3,2,2])
-
-#tSNR
-ax1 = fig.add_subplot(gs[0,0:2])
-ax1.set_title('SNR b=0 s/mm$^2$', fontsize=12)
-pltm.setp(ax1.get_xticklabels(), visible=False);
-pltm.setp(ax1.get_yticklabels(), visible=False);
-pltm.tick_params(axis='both',which='both',length=0)
-y = int(tsnr.shape[1]/2)
-img = ax1.imshow(tsnr[:,y,:].T, cmap=pltm.cm.jet, interpolation='nearest', origin='lower', vmin = 0, vmax=35)
-pltm.colorbar(img)
-ax1.annotate('Mean:'+str("{:.2f}".format(snr[0]))+'+/-'+str("{:.2f}".format(snr[1])),(0, 0), c = 'w')
-
-#CNR
-ax2 = fig.add_subplot(gs[0,2:4])
-ax2 = sns.boxplot(x=bval,y=cnr_wm)
-ax2.set_xlabel('b-value', fontsize = 12, labelpad=0)
-ax2.set_ylabel('CNR', fontsize = 12)
-ax2.tick_params(labelsize=8, labelrotation = 35, axis='x')
-ax2.tick_params(axis='y', direction = "in", pad = -22)
-ax2.set_title('CNR in WM per shell', fontsize = 12)
-
-#FA MD screenshots
-ax3 = fig.add_subplot(gs[1,0:1])
-ax4 = fig.add_subplot(gs[1,1:2])
-z = int(tsnr.shape[2]/2)
-ax3.imshow(fa[:,:,z].T, cmap=pltm.cm.gray, interpolation='nearest', origin='lower', vmin = 0, vmax=0.6)
-ax3.tick_params(axis='both',which='both',length=0);
-ax4.imshow(md[:,:,z].T, cmap=pltm.cm.gray, interpolation='nearest', origin='lower', vmin = 0)
-ax3.set_title('FA')
-ax4.set_title('MD')
-pltm.setp(ax3.get_xticklabels(), visible=False); pltm.setp(ax4.get_xticklabels(), visible=False);
-pltm.setp(ax3.get_yticklabels(), visible=False); pltm.setp(ax4.get_yticklabels(), visible=False);
-ax4.tick_params(axis='both',which='both',length=0); 
-
-# FA Histograms 
-ax5 = fig.add_subplot(gs[1,2:3])
-ax5.hist(fa[wm>0], histtype='stepfilled', alpha = 0.3, ec='k', label='WM', bins = 100, color = 'b')
-if args.gm_mask:
- ax5.hist(fa[gm>0], histtype='stepfilled', alpha = 0.3, ec='k', label='GM', bins = 100, color = 'g')
-ax5.set_xlim(0,1)
-ax5.annotate('WM:'+str("{:.2f}".format(np.abs(np.mean(fa[wm>0]))))+'(+/-'+str("{:.2f}".format(np.abs(np.std(fa[wm>0]))))+')',
-                 (0.0, ax5.get_ylim()[1]/2), fontsize = 9)
-ax5.ticklabel_format(axis='y', style='sci', scilimits=(0, 0))
-ax5.set_title('FA', fontsize=9)
-# MD Histograms 
-ax6 = fig.add_subplot(gs[1,3:4])
-ax6.hist(md[wm>0], histtype='stepfilled', alpha = 0.3, ec='k', label='WM', bins = 100, color = 'b')
-if args.gm_mask:
- ax6.hist(md[gm>0], histtype='stepfilled', alpha = 0.3, ec='k', label='GM', bins = 100, color = 'g')
-ax6.ticklabel_format(style='sci', axis = 'x', scilimits = (0,0))
-ax6.set_xlim(0,md.max())
-ax6.annotate('WM:'+str("{:.2e}".format(np.abs(np.mean(md[wm>0]))))+'(+/-'+str("{:.2e}".format(np.abs(np.std(md[wm>0]))))+')',
-                 (0.0001, ax6.get_ylim()[1]/2), fontsize = 9)
-ax6.set_title('MD [s/mm$^2$]', fontsize=9)
-ax6.ticklabel_format(axis='y', style='sci', scilimits=(0, 0))
-ax5.legend(); 
-
-# DTIFIT V1
-ax7 = fig.add_subplot(gs[2:3,0:2])
-ax8 = fig.add_subplot(gs[2:3,2:4])
-ax7.imshow(Image.open(ssdir+'/dti_v1_coronal.png'), resample = False, interpolation = None, filternorm = True)
-ax7.set_title('DTIFit V1 - coronal')
-ax7.tick_params(axis='both', which='both',length=0);
-ax8.imshow(Image.open(ssdir+'/dti_v1_axial.png'), resample = False, interpolation = None, filternorm = True)
-ax8.set_title('DTIFit V1 - axial')
-pltm.setp(ax7.get_xticklabels(), visible=False); pltm.setp(ax8.get_xticklabels(), visible=False);
-pltm.setp(ax7.get_yticklabels(), visible=False); pltm.setp(ax8.get_yticklabels(), visible=False)
-ax8.tick_params(axis='both', which='both',length=0);
-
-#DTIFIT residuals
-ax9 = fig.add_subplot(gs[3,0:2])
-x = list(range(1,len(bval)+1,1))
-y = abs(np.mean(res[wm>0],0))
-err = np.std(res[wm>0],0)
-ax9.errorbar(x,y,err, linestyle = None, marker = 'o', markersize = 3, linewidth = 0.3)
-ax9.set_xlabel('DWI Volume', fontsize = 12)
-ax9.set_title('Residual [a.u.]', fontsize = 12)
-
-#signal
-ax10 = fig.add_subplot(gs[3,2:3])
-ax11 = fig.add_subplot(gs[3,3:4])
-if args.gm_mask:
-    rois = [wm,gm,csf]
-    roinames = ['WM', "GM", "CSF"]
-    colors = ['b','g','r']
-else:
-    rois = [wm]
-    roinames = ['WM']
-    colors = ['b']
-    
-data_norm = np.zeros(data.shape)
-np.seterr(divide='ignore', invalid='ignore')
-import warnings
-#temp. should behandled in seaborn 0.13
-warnings.filterwarnings("ignore", "use_inf_as_na")
-for i in range(0, data.shape[3]):
-    data_norm[:,:,:,i] = data[:,:,:,i]/data[:,:,:,0]
-for i in range(0, len(rois)):
-        r = rois[i]
-        df = pd.DataFrame()
-        df['bval'] = bval
-        df['Signal [-]'] = np.mean(data[r==1],0)
-        df['log'] = np.log(df['Signal [-]'])
-        df['Norm. Signal [-]'] = np.mean(data_norm[r==1],0)
-        df.replace([np.inf, -np.inf], np.nan, inplace=True)
-        sns.lineplot(x='bval',y='log',data=df, legend='brief', marker='o',label = roinames[i],  markersize = 5,
-            err_style='bars', errorbar = 'sd', color = colors[i], ax=ax10)
-        sns.lineplot(x='bval',y='Signal [-]',data=df, legend='brief', marker='o',label = roinames[i],  
-                     markersize = 5, err_style='bars', errorbar = 'sd', color = colors[i], ax=ax11)
-ax11.ticklabel_format(axis='y', style='sci', scilimits=(0, 0))
-ax10.set_ylabel('[]');  ax11.set_ylabel('[]');
-ax10.set_title('Norm. Signal [-]', fontsize = 10); ax11.set_title('Signal [-]', fontsize = 10)
-
-###### Saving PDF
-fig.suptitle(' QC for Subject '+str(args.subj)+' '+str(date), fontsize = 14)
-pltm.savefig(args.pdf_output, format = 'pdf')
-print('PDF saved!')
-
-####### Creating dataframe and save data
-print('Creating dataframe...')
-#storing subject data
-new_row = {'Sub': str(args.subj),
-         'Average_SNR(b<100)': snr[0],
-	     'Mean_FA_WM': np.abs(np.mean(fa[wm>0])),
-         'Mean_MD_WM': np.abs(np.mean(md[wm>0]))}
-
-#checking if dataframe exists
-if not os.path.isfile(args.txt_output):
-	print('Txt file with group QC measures not found. Creating new file...')
-	df = pd.DataFrame()
-	df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-
-else:
-	print('Txt file with group QC measures found. Appending data...')
-	df = pd.read_fwf(args.txt_output)
-	df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-    
-#### Saving Dataframe
-tfile = open(str(args.txt_output), 'w')
-tfile.write(df.to_string())
-tfile.close()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Quick-look QC on a subset of the DWI series (dwi_qa.sh --preview).
+
+Reads all b0s, a few volumes of each shell spread over the acquisition and a
+band of central slices. The brain mask is a threshold of the mean b0 and the
+WM mask a threshold of the FA of the subset tensor fit (no bet2, SynthSeg or
+FSL/MRtrix call). tSNR, WM CNR per shell, FA/MD and tensor residuals are
+summarised on a single page labelled PREVIEW, with the measures of the group
+DTI table shown against the cohort (read only, nothing is stored). The
+subset and the threshold masks make them not comparable with the full QC
+of the cohort, so the comparison is indicative only and nothing is flagged.
+The full dwi_qa.sh run removes the preview report.
+"""
+
+import argparse
+import os
+import time
+import numpy as np
+##########################
+from datetime import date
+from qcinputs import QCInputs
+date = date.today().strftime('%d%m%y')
+# volumes of each shell used by the preview (all b0s are used)
+PER_SHELL = 8
+# number of central slices
+NSLICES = 12
+# brain mask: mean b0 above this fraction of its 99th percentile
+MASK_FRAC = 0.15
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+            description='Create a one-page preview QC report from a subset of volumes and slices')
+    parser.add_argument('data', help='DWI data')
+    parser.add_argument('bvals', help='Bval file')
+    parser.add_argument('bvecs', help='Bvec file')
+    parser.add_argument('pdf_output', help='Preview report')
+    parser.add_argument('--subj', default='', help='Subj ID')
+    parser.add_argument('--group_dir', default=None,
+                        help='Group QC directory: the preview is compared with its DTI table (read only)')
+    parser.add_argument('--per_shell', default=PER_SHELL, type=int,
+                        help='Volumes per shell. Default='+str(PER_SHELL))
+    parser.add_argument('--nslices', default=NSLICES, type=int,
+                        help='Number of central slices. Default='+str(NSLICES))
+    parser.add_argument('--fa_thr', default=0.2, type=float,
+                        help='FA threshold of the WM mask. Default=0.2')
+    parser.add_argument('--format', default='pdf', type=str,
+                        help='Comma-separated report formats (pdf,png,html). Default: pdf')
+    return parser
+
+
+def select_volumes(gt, per_shell):
+    """All b0s and per_shell volumes of each shell, evenly spaced in acquisition order."""
+    vols = [np.flatnonzero(gt.b0)]
+    for s, b in enumerate(gt.shells):
+        if b == 0:
+            continue
+        idx = np.flatnonzero(gt.index == s)
+        pick = np.unique(np.round(np.linspace(0, idx.size-1, min(per_shell, idx.size))).astype(int))
+        vols.append(idx[pick])
+    return np.sort(np.concatenate(vols))
+
+
+def compute(args, inputs):
+    """Read the subset and compute the preview measures."""
+    import nibabel as nib
+    from niftiio import iter_volumes
+    from tensorfit import MIN_SIGNAL, design_matrix, tensor_maps
+    gt = inputs.gradients(args.bvals)
+    gt.check(nib.load(args.data).shape[3], args.data)
+    bvec = inputs.bvecs(args.bvecs)
+    vols = select_volumes(gt, args.per_shell)
+    b0 = gt.b0[vols]
+    if b0.sum() < 2 or (~b0).sum() < 6:
+        raise ValueError('Preview needs at least 2 b0s and 6 diffusion-weighted volumes, found '
+                         +str(b0.sum())+' and '+str((~b0).sum()))
+    nz = nib.load(args.data).shape[2]
+    z0 = max(0, nz//2-args.nslices//2)
+    z1 = min(nz, z0+args.nslices)
+    ########### Loading subset #############
+    data = np.stack([np.asarray(v[:, :, z0:z1], dtype=np.float32) for i, v in iter_volumes(args.data, vols)], -1)
+    ########### Masks and tSNR #############
+    b0s = data[..., b0]
+    b0_mean = b0s.mean(-1)
+    b0_std = b0s.std(-1, ddof=1)
+    mask = b0_mean > MASK_FRAC*np.percentile(b0_mean, 99)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tsnr = np.where(b0_std > 0, b0_mean/b0_std, 0)
+    ########### Tensor fit #############
+    X = design_matrix(gt.bvals[vols], bvec[vols])
+    sig = data[mask].astype(np.float64)
+    coef = np.linalg.pinv(X) @ np.log(np.maximum(sig, MIN_SIGNAL)).T
+    fa_v, md_v, _ = tensor_maps(coef[1:].T)
+    fa = np.zeros(mask.shape)
+    md = np.zeros(mask.shape)
+    fa[mask] = fa_v
+    md[mask] = md_v
+    wm = fa_v > args.fa_thr
+    res = sig[wm] - np.exp(X @ coef[:, wm]).T
+    ########### WM CNR per volume (as cnrwm.txt: mean/std in WM) #############
+    wm_sig = sig[wm]
+    shell = gt.volume_shells()[vols]
+    return {'vols': vols, 'nvols': gt.nvols, 'slices': (z0, z1), 'shell': shell, 'b0': b0,
+            'snr': (tsnr[mask].mean(), tsnr[mask].std()),
+            'cnr_wm': wm_sig.mean(0)/wm_sig.std(0),
+            'tsnr_slice': tsnr[:, :, (z1-z0)//2], 'fa_slice': fa[:, :, (z1-z0)//2],
+            'md_slice': md[:, :, (z1-z0)//2],
+            'fa_wm': (fa_v[wm].mean(), fa_v[wm].std()), 'md_wm': (md_v[wm].mean(), md_v[wm].std()),
+            'n_wm': int(wm.sum()),
+            'res_mean': res.mean(0), 'res_std': res.std(0)}
+
+
+def group_row(m, subj):
+    # same names as the DTI group table, for the cohort comparison only
+    return {'Sub': str(subj),
+            'Average_SNR(b<100)': m['snr'][0],
+            'Mean_FA_WM': np.abs(m['fa_wm'][0]),
+            'Mean_MD_WM': np.abs(m['md_wm'][0])}
+
+
+def cohort(row, group_dir):
+    """Comparison of the preview with the DTI group table, without storing it."""
+    from groupstore import GroupStore
+    return GroupStore(os.path.join(group_dir, 'group_dti,snr.txt')).compare(row)
+
+
+def _layout():
+    import render as rd
+    fig = rd.a4_figure(dpi=300, tight_layout=True)
+    gs = fig.add_gridspec(4, 4, height_ratios=[3,3,2,1.4])
+    return fig, {'tsnr': fig.add_subplot(gs[0,0:2]), 'cnr': fig.add_subplot(gs[0,2:4]),
+                 'fa': fig.add_subplot(gs[1,0:2]), 'md': fig.add_subplot(gs[1,2:4]),
+                 'res': fig.add_subplot(gs[2,0:4]), 'cohort': fig.add_subplot(gs[3,0:4])}
+
+
+def render(m, args):
+    """Plot the one-page preview report."""
+    import matplotlib.pyplot as pltm
+    import seaborn as sns
+    import render as rd
+    print('Creating preview PDF')
+    fig, ax = rd.template('preview', _layout)
+    snr = m['snr']
+
+    #tSNR
+    img = rd.image(ax['tsnr'], m['tsnr_slice'].T, cmap=pltm.cm.jet, origin='lower', vmin=0, vmax=35)
+    rd.colorbar(fig, img, ax['tsnr'])
+    ax['tsnr'].set_title('SNR b=0 s/mm$^2$', fontsize=12)
+    ax['tsnr'].annotate('Mean:'+str("{:.2f}".format(snr[0]))+'+/-'+str("{:.2f}".format(snr[1])), (0, 0), c='w')
+
+    #CNR per shell
+    dw = ~m['b0']
+    sns.boxplot(x=m['shell'][dw], y=m['cnr_wm'][dw], ax=ax['cnr'])
+    ax['cnr'].set_xlabel('b-value', fontsize=12, labelpad=0)
+    ax['cnr'].set_ylabel('CNR', fontsize=12)
+    ax['cnr'].set_title('CNR in WM per shell', fontsize=12)
+
+    #FA MD
+    rd.image(ax['fa'], m['fa_slice'].T, cmap=pltm.cm.gray, origin='lower', vmin=0, vmax=0.6)
+    rd.image(ax['md'], m['md_slice'].T, cmap=pltm.cm.gray, origin='lower', vmin=0)
+    ax['fa'].set_title('FA - WM: {:.2f} (+/-{:.2f})'.format(*m['fa_wm']))
+    ax['md'].set_title('MD - WM: {:.2e} (+/-{:.2e})'.format(*m['md_wm']))
+    rd.hide_ticks(ax['tsnr'], ax['fa'], ax['md'])
+
+    #residuals
+    ax['res'].errorbar(m['vols']+1, np.abs(m['res_mean']), m['res_std'], linestyle=None, marker='o',
+                       markersize=3, linewidth=0.3)
+    ax['res'].set_xlim(0, m['nvols']+1)
+    ax['res'].set_xlabel('DWI Volume', fontsize=12)
+    ax['res'].set_title('Residual in WM [a.u.]', fontsize=12)
+
+    rd.cohort_table(ax['cohort'], m.get('cohort'), flag=False,
+                    title='Cohort comparison - not comparable, indicative only (subset, threshold masks)')
+    z0, z1 = m['slices']
+    fig.suptitle('PREVIEW - QC for Subject '+str(args.subj)+' '+str(date), fontsize=14, color='r')
+    fig.text(0.5, 0.01, 'Preview on {} of {} volumes ({} b0s, up to {} per shell), slices {}-{}, threshold '
+             'masks ({} WM voxels). Replaced by the full QC report.'.format(
+                 m['vols'].size, m['nvols'], m['b0'].sum(), args.per_shell, z0, z1-1, m['n_wm']),
+             ha='center', fontsize=8, color='r')
+    rd.save(fig, args.pdf_output, rd.parse_formats(args.format), 'PREVIEW QC for Subject '+str(args.subj))
+    print('Preview PDF saved!')
+
+
+def run(args, inputs=None):
+    from qclog import phase
+    t0 = time.time()
+    with phase('preview', 'compute', args.subj):
+        m = compute(args, inputs or QCInputs())
+    if args.group_dir:
+        # indicative only: no QC decision from the preview measures
+        m['cohort'] = cohort(group_row(m, args.subj), args.group_dir)
+    with phase('preview', 'render', args.subj):
+        render(m, args)
+    print('Preview done in {:.1f}s'.format(time.time()-t0))
+    return m
+
+
+def main(argv=None):
+    run(get_parser().parse_args(argv))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,192 +4,255 @@
 #cmaffei@mgh.harvard.edu
 
 import argparse
-###############################
-import nibabel as nb
 import numpy as np
-import matplotlib.pyplot as pltm
-import pandas as pd
-import seaborn as sns
 ################################
-import os.path
 from datetime import date
-from PIL import Image
+from qcinputs import QCInputs
 date = date.today().strftime('%d%m%y')
+# heavy libraries (matplotlib, seaborn) are imported by the functions
+# that need them
 
-parser = argparse.ArgumentParser(
-        description='Create Motion QC summary from eddy outputs as PDF and saves updated dataframes with qc values for single subject')
-parser.add_argument('s2v_file', metavar='s2v',type=str, 
-			help='File with motion over time information')
-parser.add_argument('rms_file', metavar='rms', type=str,
-			help='File with volume to volume motion information')
-parser.add_argument('res_rms_file', metavar='res_rms', type=str, 
-			help='File with volume to volume restricted motion information')
-parser.add_argument('params_file', metavar='params', type=str,
-			help='File with motion and EC parameters information')
-parser.add_argument('nslices', metavar='nslices',type=int, help='Number of slices')
-parser.add_argument('bval_file', metavar='bval', help='Bval file')
-parser.add_argument('subj', metavar='subj', help='Subj ID')
-parser.add_argument('pdf_output', metavar='pdf_output', type = str,
-			help='File with motion plots')
-parser.add_argument('txt_output', metavar='txt_output', type=str,
-			help='Text file with qc motion params')
-args = parser.parse_args()
-
-#loading rms files
-print('Loading files...')
-rms_abs = np.loadtxt(args.rms_file)[:,0]
-rms_rel = np.loadtxt(args.rms_file)[:,1]
-rms_re_abs = np.loadtxt(args.res_rms_file)[:,0]
-rms_re_rel = np.loadtxt(args.res_rms_file)[:,1]
-
-#loading bval
-bval = np.loadtxt(args.bval_file)
-
-#loading sv2 file and computing std
-s2v = np.genfromtxt(args.s2v_file, dtype=float)
-s2v[:,3:6] = np.rad2deg(s2v[:,3:6])
-ex_check = np.arange(0,args.nslices)
-s2v_var = np.full((bval.size,6), -1.0)
-for i in np.arange(0, bval.size):
-    tmp = s2v[i*args.nslices:(i+1)*args.nslices]
-    s2v_var[i] = np.var(tmp[ex_check], ddof=1, axis=0)
-
-#store rotations and translations in dataframe for visualization
-df = pd.DataFrame()
-df['x'] =s2v_var[:,0]
-df['y'] = s2v_var[:,1]
-df['z'] = s2v_var[:,2]
-df_s2v_tr = df.melt(var_name = 'Axis', value_name = 'Translation')
-df = pd.DataFrame()
-df['x'] = np.rad2deg(s2v_var[:,3])
-df['y'] = np.rad2deg(s2v_var[:,4])
-df['z'] = np.rad2deg(s2v_var[:,5])
-df_s2v_rot = df.melt(var_name = 'Axis', value_name = 'Rotation')
-    
-#loading params file and temporarily store them in dataframe for visualization
-params = np.loadtxt(args.params_file)
-df = pd.DataFrame()
-df['x'] = params[:,0]
-df['y'] = params[:,1]
-df['z'] = params[:,2]
-df_tr = df.melt(var_name = 'Axis', value_name = 'Translation')
-df = pd.DataFrame()
-df['x'] = params[:,3]
-df['y'] = params[:,4]
-df['z'] = params[:,5]
-df_rot = df.melt(var_name = 'Axis', value_name = 'Rotation')
-
-#Creating motion dataframe and save data
-print('Creating dataframe...')
-mean_params = np.mean(params[:,0:6], axis = 0)
-mean_s2v_var = np.mean(s2v_var[:,0:6], axis = 0)
-
-new_row = {'Sub': str(args.subj),
-         'Mean_Vol2Vol_Translations(x)': mean_params[0],
-         'Mean_Vol2Vol_Translations(y)': mean_params[0],
-         'Mean_Vol2Vol_Translations(z)': mean_params[2],
-         'Mean_Vol2Vol_Rotations(x)': mean_params[3],
-         'Mean_Vol2Vol_Rotations(y)': mean_params[4],
-         'Mean_Vol2Vol_Rotations(z)': mean_params[5],
-         'Average_Absolute_Motion': np.mean(rms_abs),
-         'Average_Relative_Motion': np.mean(rms_rel),
-         'Average_Absolute_Restricted_Motion': np.mean(rms_re_abs),
-	 'Average_Relative_Restricted_Motion': np.mean(rms_re_rel)}
-
-#checking if dataframe exists
-if not os.path.isfile(args.txt_output):
-        print('Txt file with group QC measures not found. Creating new file...')
-        df = pd.DataFrame()
-        df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-else:
-        print('Txt file with group QC measures found. Appending data...')
-        df = pd.read_fwf(args.txt_output)
-        df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-
-tfile = open(str(args.txt_output), 'w')
-tfile.write(df.to_string())
-tfile.close()
-
-# Prepare figure
-print('Creating QC motion PDF')
-fig = pltm.figure(constrained_layout =True, figsize=(8.27,11.69))# Standard portrait A4 sizes
-gs = fig.add_gridspec(5,4)
-
-vols = len(bval)
-ax1= fig.add_subplot(gs[0,:-1])
-ax1.plot(np.sqrt(s2v_var[:,0]), 'r', linewidth=2, label="x")
-ax1.plot(np.sqrt(s2v_var[:,1]), 'g', linewidth=2, label="y")
-ax1.plot(np.sqrt(s2v_var[:,2]), 'b', linewidth=2, label="z")
-ax1.set_xbound(1, bval.size)
-ax1.set_xlabel("Volumes")
-ax1.set_ylabel("Std translation [mm]")
-ax1.set_xlim(0,vols)
-ax1.set_title("Eddy estimated within volume translations (mm)")
-ax1.legend(loc='best', frameon=True, framealpha=0.5)
-ax1.set_ylim(bottom = 0)
-
-ax2 = fig.add_subplot(gs[1,:-1])
-ax2.plot(np.sqrt(s2v_var[:,3]), 'r', linewidth=2, label="x")
-ax2.plot(np.sqrt(s2v_var[:,4]), 'g', linewidth=2, label="y")
-ax2.plot(np.sqrt(s2v_var[:,5]), 'b', linewidth=2, label="z")
-ax2.set_xbound(1, bval.size)
-ax2.set_xlabel("Volumes")
-ax2.set_ylabel("Std rotation [deg]")
-ax2.set_xlim(0,vols)
-ax2.set_title("Eddy estimated within volume rotations (deg)")
-ax2.legend(loc='best', frameon=True, framealpha=0.5)
-ax2.set_ylim(bottom = 0)
-
-ax3 = fig.add_subplot(gs[0:1,-1])
-sb = sns.violinplot(x='Axis', y='Translation', data = df_tr, ax = ax3, cut = 0)
-ax4 = fig.add_subplot(gs[1:2,-1])
-sb = sns.violinplot(x='Axis', y='Rotation', data = df_rot, ax = ax4, cut = 0)
-
-ax5 = fig.add_subplot(gs[2,:-1])
-ax5.plot(params[:,0], 'r', linewidth=2, label="x")
-ax5.plot(params[:,1], 'g', linewidth=2, label="y")
-ax5.plot(params[:,2], 'b', linewidth=2, label="z")
-ax5.legend(loc='best', frameon=True, framealpha=0.5)
-ax5.set_xlabel("Volumes")
-ax5.set_ylabel("Translation [mm]")
-ax5.set_xlim(0,vols)
-ax5.set_title("Eddy estimated volume to volume translations (mm)")
-
-ax6 = fig.add_subplot(gs[3,:-1])
-ax6.plot(params[:,3], 'r', linewidth=2, label="x")
-ax6.plot(params[:,4], 'g', linewidth=2, label="y")
-ax6.plot(params[:,5], 'b', linewidth=2, label="z")
-ax6.legend(loc='best', frameon=True, framealpha=0.5)
-ax6.set_xlabel("Volumes")
-ax6.set_ylabel("Rotation [deg]")
-ax6.set_xlim(0,vols)
-ax6.set_title("Eddy estimated volume to volume rotations (deg)")
-
-ax7 = fig.add_subplot(gs[2:3,-1])
-sb = sns.violinplot(x='Axis', y='Translation', data = df_tr, ax = ax7, cut = 0)
-ax8 = fig.add_subplot(gs[3:4,-1])
-sb = sns.violinplot(x='Axis',y= 'Rotation', data = df_rot, ax = ax8, cut = 0)
-
-ax9 = fig.add_subplot(gs[4,:-1])
-ax9.plot(rms_abs, label = 'Absolute ('+f"{rms_abs.mean():.3}"+')')
-ax9.plot(rms_rel, label= 'Relative ('+f"{rms_rel.mean():.2}"+')')
-ax9.set_xlabel('Volumes', fontsize = 10)
-ax9.set_ylabel('Displacement [mm]', fontsize =10)
-ax9.set_xlim(0,vols)
-ax9.legend(fontsize = 14)
-
-df = pd.DataFrame()
-df['Rel.'] = rms_re_abs
-df['Abs.'] = rms_re_rel
-df_res = df.melt(var_name = 'Ax', value_name = 'Displacement [mm]')
-
-ax10 = fig.add_subplot(gs[4,3:4])
-sb = sns.violinplot(x='Ax', y='Displacement [mm]',  data = df_res, ax = ax10, cut = 0)
-sb.set_xlabel(' ')
-sb.set_title('Restricted Motion')
-
-fig.suptitle(' Motion QC for Subject '+str(args.subj)+' '+str(date), fontsize = 12)
-#save pdf
-pltm.savefig(args.pdf_output, format = 'pdf')
-print('QC motion PDF saved!')
 
+def get_parser():
+    parser = argparse.ArgumentParser(
+            description='Create Motion QC summary from eddy outputs as PDF and saves updated dataframes with qc values for single subject')
+    parser.add_argument('s2v_file', metavar='s2v',type=str,
+    			help='File with motion over time information')
+    parser.add_argument('rms_file', metavar='rms', type=str,
+    			help='File with volume to volume motion information')
+    parser.add_argument('res_rms_file', metavar='res_rms', type=str,
+    			help='File with volume to volume restricted motion information')
+    parser.add_argument('params_file', metavar='params', type=str,
+    			help='File with motion and EC parameters information')
+    parser.add_argument('nslices', metavar='nslices',type=int, help='Number of slices')
+    parser.add_argument('bval_file', metavar='bval', help='Bval file')
+    parser.add_argument('subj', metavar='subj', help='Subj ID')
+    parser.add_argument('pdf_output', metavar='pdf_output', type = str,
+    			help='File with motion plots')
+    parser.add_argument('txt_output', metavar='txt_output', type=str,
+    			help='Text file with qc motion params')
+    #optional args
+    parser.add_argument('--cache_dir', default = None, metavar='cache_dir', type=str,
+    			help='Directory for binary copies of the parsed eddy text files')
+    parser.add_argument('--mb_factor', default = 1, metavar='mb_factor', type=int,
+    			help='Multiband factor: slices s and s+nslices/mb are excited together')
+    parser.add_argument('--slspec', default = None, metavar='slspec', type=str,
+    			help='eddy slspec file (one row of slice indices per excitation). Overrides --mb_factor')
+    parser.add_argument('--metrics', default = None, metavar='metrics', type=str,
+    			help='Also write the computed metrics to <metrics>.npz/.json (render_reports.py)')
+    parser.add_argument('--format', default = 'pdf', metavar='format', type=str,
+    			help='Comma-separated report formats (pdf,png,html). Default: pdf')
+    return parser
+
+
+def excitation_groups(nslices, mb_factor=1, slspec=None):
+    """Excitation group of each slice, None for single band without slspec."""
+    if slspec is not None:
+        from eddyio import read_table
+        spec = read_table(slspec).astype(int)
+        if spec.min() < 0 or spec.max() >= nslices:
+            raise ValueError('slspec '+slspec+' has slice indices outside 0-'+str(nslices-1))
+        groups = np.full(nslices, -1)
+        groups[spec] = np.arange(spec.shape[0])[:, None]
+        if (groups < 0).any():
+            raise ValueError('slspec '+slspec+' does not list all '+str(nslices)+' slices')
+        return groups
+    if mb_factor > 1:
+        if nslices % mb_factor:
+            raise ValueError('nslices ('+str(nslices)+') is not a multiple of the MB factor ('+str(mb_factor)+')')
+        return np.arange(nslices) % (nslices//mb_factor)
+    return None
+
+
+def s2v_variance(s2v, nvols, nslices, groups=None):
+    """Within-volume variance of the 6 s2v parameters, shape (nvols, 6).
+
+    s2v has nvols*nslices rows. With excitation groups, the slices excited
+    together are averaged first and the variance is taken across groups.
+    """
+    mot = s2v[:nvols*nslices].reshape(nvols, nslices, s2v.shape[1])
+    if groups is not None:
+        onehot = np.zeros((groups.max()+1, nslices))
+        onehot[groups, np.arange(nslices)] = 1
+        onehot /= onehot.sum(axis=1, keepdims=True)
+        mot = np.einsum('gs,vsk->vgk', onehot, mot)
+    return np.var(mot, ddof=1, axis=1)
+
+
+def compute(args, inputs):
+    """Load eddy motion outputs and compute the motion summaries."""
+    from eddyio import read_table
+    #loading rms files (each file is parsed once)
+    print('Loading files...')
+    rms = read_table(args.rms_file, cache_dir=args.cache_dir)
+    rms_re = read_table(args.res_rms_file, cache_dir=args.cache_dir)
+    rms_abs = rms[:,0]
+    rms_rel = rms[:,1]
+    rms_re_abs = rms_re[:,0]
+    rms_re_rel = rms_re[:,1]
+
+    #loading bval
+    bval = inputs.bvals(args.bval_file)
+
+    #loading sv2 file and computing std (over excitation groups for SMS data)
+    s2v = read_table(args.s2v_file, cache_dir=args.cache_dir).copy()
+    s2v[:,3:6] = np.rad2deg(s2v[:,3:6])
+    groups = excitation_groups(args.nslices, args.mb_factor, args.slspec)
+    s2v_var = s2v_variance(s2v, bval.size, args.nslices, groups)
+
+    #loading params file
+    params = read_table(args.params_file, cache_dir=args.cache_dir)
+    return {'bval': bval, 'rms_abs': rms_abs, 'rms_rel': rms_rel,
+            'rms_re_abs': rms_re_abs, 'rms_re_rel': rms_re_rel,
+            's2v_var': s2v_var, 'params': params}
+
+
+def group_row(m, subj):
+    mean_params = np.mean(m['params'][:,0:6], axis = 0)
+    return {'Sub': str(subj),
+            'Mean_Vol2Vol_Translations(x)': mean_params[0],
+            'Mean_Vol2Vol_Translations(y)': mean_params[0],
+            'Mean_Vol2Vol_Translations(z)': mean_params[2],
+            'Mean_Vol2Vol_Rotations(x)': mean_params[3],
+            'Mean_Vol2Vol_Rotations(y)': mean_params[4],
+            'Mean_Vol2Vol_Rotations(z)': mean_params[5],
+            'Average_Absolute_Motion': np.mean(m['rms_abs']),
+            'Average_Relative_Motion': np.mean(m['rms_rel']),
+            'Average_Absolute_Restricted_Motion': np.mean(m['rms_re_abs']),
+            'Average_Relative_Restricted_Motion': np.mean(m['rms_re_rel'])}
+
+
+def _violins(ax, columns, labels, ylabel, xlabel='Axis'):
+    import seaborn as sns
+    sb = sns.violinplot(data=list(columns), ax=ax, cut=0)
+    sb.set_xticks(np.arange(len(labels)))
+    sb.set_xticklabels(labels)
+    sb.set_xlabel(xlabel)
+    sb.set_ylabel(ylabel)
+    return sb
+
+
+def _layout():
+    import render as rd
+    fig = rd.a4_figure(constrained_layout =True)
+    gs = fig.add_gridspec(6,4, height_ratios=[1,1,1,1,1,1.4])
+    axes = {'s2v_tr': fig.add_subplot(gs[0,:-1]), 's2v_rot': fig.add_subplot(gs[1,:-1]),
+            's2v_tr_v': fig.add_subplot(gs[0:1,-1]), 's2v_rot_v': fig.add_subplot(gs[1:2,-1]),
+            'tr': fig.add_subplot(gs[2,:-1]), 'rot': fig.add_subplot(gs[3,:-1]),
+            'tr_v': fig.add_subplot(gs[2:3,-1]), 'rot_v': fig.add_subplot(gs[3:4,-1]),
+            'rms': fig.add_subplot(gs[4,:-1]), 'rms_re_v': fig.add_subplot(gs[4,3:4]),
+            'cohort': fig.add_subplot(gs[5,:])}
+    return fig, axes
+
+
+def render(m, args):
+    """Plot the motion report (PDF/PNG/HTML) from the computed quantities."""
+    import render as rd
+    bval = m['bval']
+    s2v_var = m['s2v_var']
+    params = m['params']
+    rms_abs = m['rms_abs']
+    rms_rel = m['rms_rel']
+    axes = ['x', 'y', 'z']
+
+    # Prepare figure
+    print('Creating QC motion PDF')
+    fig, ax = rd.template('motion', _layout)
+
+    vols = len(bval)
+    ax1 = ax['s2v_tr']
+    ax1.plot(np.sqrt(s2v_var[:,0]), 'r', linewidth=2, label="x")
+    ax1.plot(np.sqrt(s2v_var[:,1]), 'g', linewidth=2, label="y")
+    ax1.plot(np.sqrt(s2v_var[:,2]), 'b', linewidth=2, label="z")
+    ax1.set_xbound(1, bval.size)
+    ax1.set_xlabel("Volumes")
+    ax1.set_ylabel("Std translation [mm]")
+    ax1.set_xlim(0,vols)
+    ax1.set_title("Eddy estimated within volume translations (mm)")
+    ax1.legend(loc='best', frameon=True, framealpha=0.5)
+    ax1.set_ylim(bottom = 0)
+
+    ax2 = ax['s2v_rot']
+    ax2.plot(np.sqrt(s2v_var[:,3]), 'r', linewidth=2, label="x")
+    ax2.plot(np.sqrt(s2v_var[:,4]), 'g', linewidth=2, label="y")
+    ax2.plot(np.sqrt(s2v_var[:,5]), 'b', linewidth=2, label="z")
+    ax2.set_xbound(1, bval.size)
+    ax2.set_xlabel("Volumes")
+    ax2.set_ylabel("Std rotation [deg]")
+    ax2.set_xlim(0,vols)
+    ax2.set_title("Eddy estimated within volume rotations (deg)")
+    ax2.legend(loc='best', frameon=True, framealpha=0.5)
+    ax2.set_ylim(bottom = 0)
+
+    _violins(ax['s2v_tr_v'], params[:,0:3].T, axes, 'Translation')
+    _violins(ax['s2v_rot_v'], params[:,3:6].T, axes, 'Rotation')
+
+    ax5 = ax['tr']
+    ax5.plot(params[:,0], 'r', linewidth=2, label="x")
+    ax5.plot(params[:,1], 'g', linewidth=2, label="y")
+    ax5.plot(params[:,2], 'b', linewidth=2, label="z")
+    ax5.legend(loc='best', frameon=True, framealpha=0.5)
+    ax5.set_xlabel("Volumes")
+    ax5.set_ylabel("Translation [mm]")
+    ax5.set_xlim(0,vols)
+    ax5.set_title("Eddy estimated volume to volume translations (mm)")
+
+    ax6 = ax['rot']
+    ax6.plot(params[:,3], 'r', linewidth=2, label="x")
+    ax6.plot(params[:,4], 'g', linewidth=2, label="y")
+    ax6.plot(params[:,5], 'b', linewidth=2, label="z")
+    ax6.legend(loc='best', frameon=True, framealpha=0.5)
+    ax6.set_xlabel("Volumes")
+    ax6.set_ylabel("Rotation [deg]")
+    ax6.set_xlim(0,vols)
+    ax6.set_title("Eddy estimated volume to volume rotations (deg)")
+
+    _violins(ax['tr_v'], params[:,0:3].T, axes, 'Translation')
+    _violins(ax['rot_v'], params[:,3:6].T, axes, 'Rotation')
+
+    ax9 = ax['rms']
+    ax9.plot(rms_abs, label = 'Absolute ('+f"{rms_abs.mean():.3}"+')')
+    ax9.plot(rms_rel, label= 'Relative ('+f"{rms_rel.mean():.2}"+')')
+    ax9.set_xlabel('Volumes', fontsize = 10)
+    ax9.set_ylabel('Displacement [mm]', fontsize =10)
+    ax9.set_xlim(0,vols)
+    ax9.legend(fontsize = 14)
+
+    sb = _violins(ax['rms_re_v'], [m['rms_re_abs'], m['rms_re_rel']], ['Rel.', 'Abs.'],
+                  'Displacement [mm]', xlabel=' ')
+    sb.set_title('Restricted Motion')
+
+    rd.cohort_table(ax['cohort'], m.get('cohort'))
+    fig.suptitle(' Motion QC for Subject '+str(args.subj)+' '+str(date), fontsize = 12)
+    #save report
+    rd.save(fig, args.pdf_output, rd.parse_formats(args.format), 'Motion QC for Subject '+str(args.subj))
+    print('QC motion PDF saved!')
+
+
+def run(args, inputs=None):
+    from cohortstats import print_flags
+    from groupstore import GroupStore
+    import metrics
+    from qclog import phase
+    with phase('motion', 'compute', args.subj):
+        m = compute(args, inputs or QCInputs())
+    if args.metrics:
+        metrics.save(m, args.metrics, 'motion', args.subj)
+    #Creating motion dataframe and save data
+    print('Creating dataframe...')
+    #appending to the group store (locked; the text table is exported by qc_reports.py)
+    print('Appending data to group QC measures...')
+    with phase('motion', 'table', args.subj):
+        m['cohort'] = GroupStore(args.txt_output).append(group_row(m, args.subj))
+    print_flags(m['cohort'])
+    with phase('motion', 'render', args.subj):
+        render(m, args)
+    return m
+
+
+def main(argv=None):
+    run(get_parser().parse_args(argv))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,114 +4,224 @@
 #cmaffei@mgh.harvard.edu
 
 import argparse
-
-import nibabel as nb
 import numpy as np
-import matplotlib.pyplot as pltm
-import pandas as pd
-import seaborn as sns
 ############################
-import os.path
 from datetime import date
-from PIL import Image
+from qcinputs import QCInputs
 ############################
 date = date.today().strftime('%d%m%y')
-
-parser = argparse.ArgumentParser(
-        description='Create QC summary as PDF and saves updated dataframes with qc values for single subject')
-parser.add_argument('ol_file', metavar='ol', type=str, 
-                        help='Eddy File with information on total outliers ')
-parser.add_argument('ol_std_file', metavar='ol_std', type=str,
-                        help='Eddy File: number of std off the mean difference between observation and predictions')
-parser.add_argument('params_file', metavar='params', type=str,
-                        help='Eddy file with motion and EC parameters information')
-parser.add_argument('bval_file', metavar='bval', help='Bval file')
-parser.add_argument('mask_file', metavar='mask', help='Binary brain mask')
-parser.add_argument('subj', metavar='subj', help='Subj ID')
-parser.add_argument('pdf_output', metavar='pdf_output', type = str,
-                        help='File with qc plots and screenshots')
-parser.add_argument('txt_output', metavar='txt_output', type=str,
-                        help='Text file with qc params')
-#optional args
-parser.add_argument('--cnr_eddy', default = None, metavar='cnr_eddy_file',type=str,
-                        help='File with snr information after eddy')
-parser.add_argument('--eddy_res', default = None, metavar='snr_img', type=str,
-                        help='Eddy output residuals file')
-
-args = parser.parse_args()
-
-######### Load files  ########
-print('Loading files...')
-bval = np.loadtxt(args.bval_file)
-ol = np.genfromtxt(args.ol_file,dtype=None, delimiter=" ", skip_header=1)
-ol_std = np.genfromtxt(args.ol_std_file,dtype=float, delimiter=" ", skip_header=1)
-params = np.loadtxt(args.params_file)
-mask = nb.load(args.mask_file).get_fdata()
-tot_ol = 100*np.count_nonzero(ol)/((bval > 100).sum()*ol.shape[1])
-std_ec = np.std(params[:,6:9], axis = 0)
-indb0 = bval < 50
-if args.eddy_res:
-    res = nb.load(args.eddy_res).get_fdata()
-
-#Create figure
-print('Creating PDF with QC output...')
-fig = pltm.figure(dpi=300, tight_layout=True)
-fig.set_size_inches(8.27, 11.69, forward=True) #A4 size
-gs = fig.add_gridspec(5, 4, height_ratios=[2,2,3,2,2]) 
-
-nvols = res.shape[3]
-#Eddy outliers
-ax1 = fig.add_subplot(gs[0,0:2])
-ax1.plot(0.5+np.arange(0, nvols), 100*np.sum(ol, axis=1)/ol.shape[1], color = 'r')
-ax1.set_xlabel('DWI Volume', fontsize = 11)
-ax1.set_ylabel("% outliers",fontsize = 11)
-ax1.set_ylim([0, 2+np.max(100*np.sum(ol, axis=1)/ol.shape[1])])
-ax1.set_title('% Outliers per volume', fontsize = 12)
-ax1.annotate('Tot OL='+str(tot_ol), xy = (0,1), fontsize=12);
-
-ax2 = fig.add_subplot(gs[0,2:4]) 
-sns.heatmap(np.transpose(ol_std), ax=ax2,  
-            cbar_kws={"orientation": "vertical", "label": "No. std."}, 
-            vmin=-4, vmax=4, xticklabels=int(bval.size/10), yticklabels=10, cmap='RdBu_r')
-ax2.set_title('Outliers (Std off the mean slice diff)', fontsize=14)
-ax2.set_ylabel("Slice", fontsize = 11)
-ax2.set_xlabel("Volume", fontsize = 11)
-
-# gs.tight_layout(fig,h_pad=0,w_pad=0)
-fig.suptitle(' QC for Subject '+str(args.subj)+' '+str(date), fontsize = 18)
-pltm.savefig(args.pdf_output, format = 'pdf')
-print('PDF saved!')
-
-####### Creating dataframe and save data
-print('Creating dataframe...')
-#storing subject data
-new_row = {'Sub': str(args.subj),
-	 'EC_LinearTerm(x)(std)': std_ec[0],
-         'EC_LinearTerm(y)(std)': std_ec[1],
-         'EC_LinearTerm(z)(std)': std_ec[2],
-         'Total_Outliers': tot_ol}
-
-#checking if dataframe exists
-if not os.path.isfile(args.txt_output):
-	print('Txt file with group QC measures not found. Creating new file...')
-	df = pd.DataFrame()
-	df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-else:
-	print('Txt file with group QC measures found. Appending data...')
-	df = pd.read_fwf(args.txt_output)
-	df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-
-# if args.cnr_eddy:
-# 	snr_eddy_mean = np.loadtxt(args.cnr_eddy)[:,0]
-# 	snr_eddy_std = np.loadtxt(args.cnr_eddy)[:,1]
-# 	df['Average_SNR (b<100)'] = snr_eddy_mean[0]
-# if args.eddy_res:
-#     res_sq = np.square(res)
-#     msres = abs(np.mean(res_sq[mask>0],0))
-#     df['Eddy_Residuals'] = msres
-
-tfile = open(str(args.txt_output), 'w')
-tfile.write(df.to_string())
-tfile.close()
-
-
+# heavy libraries (nibabel, matplotlib) are imported by the
+# functions that need them
+# percentiles of the CNR maps drawn as boxes (whiskers at 5-95%)
+CNR_PCT = (5, 25, 50, 75, 95)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+            description='Create QC summary as PDF and saves updated dataframes with qc values for single subject')
+    parser.add_argument('ol_file', metavar='ol', type=str,
+                            help='Eddy File with information on total outliers ')
+    parser.add_argument('ol_std_file', metavar='ol_std', type=str,
+                            help='Eddy File: number of std off the mean difference between observation and predictions')
+    parser.add_argument('params_file', metavar='params', type=str,
+                            help='Eddy file with motion and EC parameters information')
+    parser.add_argument('bval_file', metavar='bval', help='Bval file')
+    parser.add_argument('mask_file', metavar='mask', help='Binary brain mask')
+    parser.add_argument('subj', metavar='subj', help='Subj ID')
+    parser.add_argument('pdf_output', metavar='pdf_output', type = str,
+                            help='File with qc plots and screenshots')
+    parser.add_argument('txt_output', metavar='txt_output', type=str,
+                            help='Text file with qc params')
+    #optional args
+    parser.add_argument('--cnr_maps', default = None, metavar='cnr_maps', type=str,
+                            help='Eddy output CNR maps (tSNR of the b0s, then one CNR map per shell)')
+    parser.add_argument('--wm_mask', default = None, metavar='wm_mask', type=str,
+                            help='Binary WM mask for the CNR statistics')
+    parser.add_argument('--eddy_res', default = None, metavar='snr_img', type=str,
+                            help='Eddy output residuals file')
+    parser.add_argument('--cache_dir', default = None, metavar='cache_dir', type=str,
+                            help='Directory for binary copies of the parsed eddy text files')
+    parser.add_argument('--metrics', default = None, metavar='metrics', type=str,
+                            help='Also write the computed metrics to <metrics>.npz/.json (render_reports.py)')
+    parser.add_argument('--format', default = 'pdf', metavar='format', type=str,
+                            help='Comma-separated report formats (pdf,png,html). Default: pdf')
+    return parser
+
+
+def compute(args, inputs):
+    """Load eddy outlier outputs and compute the outlier summaries."""
+    from eddyio import read_table, read_outlier_map
+    from niftiio import n_volumes, roi_mean_square, roi_volume_summary
+    ######### Load files  ########
+    print('Loading files...')
+    gt = inputs.gradients(args.bval_file)
+    bval = gt.bvals
+    ol = read_outlier_map(args.ol_file, args.cache_dir)
+    ol_std = read_outlier_map(args.ol_std_file, args.cache_dir)
+    params = read_table(args.params_file, cache_dir=args.cache_dir)
+    mask = inputs.mask(args.mask_file)
+    tot_ol = 100*np.count_nonzero(ol)/((~gt.b0).sum()*ol.shape[1])
+    std_ec = np.std(params[:,6:9], axis = 0)
+    nvols = bval.size
+    res_ms = None
+    if args.eddy_res:
+        if n_volumes(args.eddy_res) != nvols:
+            raise ValueError(args.eddy_res+' has '+str(n_volumes(args.eddy_res))+' volumes, '
+                             +str(nvols)+' b-values')
+        # mean squared residual in the brain, one volume at a time
+        res_ms = roi_mean_square(args.eddy_res, [mask])[0]
+    cnr = None
+    if args.cnr_maps:
+        # one volume per shell: tSNR of the b0s, then CNR of each shell
+        regions = ['Brain'] + (['WM'] if args.wm_mask else [])
+        masks = [mask] + ([inputs.mask(args.wm_mask)] if args.wm_mask else [])
+        mean, std, pct = roi_volume_summary(args.cnr_maps, masks, CNR_PCT)
+        cnr = {'regions': regions, 'shells': cnr_shells(gt, mean.shape[1]),
+               'mean': mean, 'std': std, 'pct': pct}
+    return {'bval': bval, 'ol': ol, 'ol_std': ol_std, 'tot_ol': tot_ol,
+            'std_ec': std_ec, 'nvols': nvols, 'res_ms': res_ms, 'cnr': cnr}
+
+
+def cnr_shells(gt, nmaps):
+    """b-value labels of the eddy CNR maps (gradient table shells, b0 first)."""
+    if gt.shells.size != nmaps:
+        print('WARNING: '+str(nmaps)+' CNR maps for '+str(gt.shells.size)+' shells, maps labelled by index')
+        return ['map'+str(i) for i in range(nmaps)]
+    return gt.labels
+
+
+def _layout():
+    import render as rd
+    fig = rd.a4_figure(dpi=300, tight_layout=True)
+    gs = fig.add_gridspec(5, 4, height_ratios=[2,2,3,2,2])
+    return fig, {'ol': fig.add_subplot(gs[0,0:2]), 'ol_std': fig.add_subplot(gs[0,2:4]),
+                 'res': fig.add_subplot(gs[1,0:4]), 'cnr': fig.add_subplot(gs[2,0:4]),
+                 'cohort': fig.add_subplot(gs[3:5,0:4])}
+
+
+def render(m, args):
+    """Plot the outlier report (PDF/PNG/HTML) from the computed quantities."""
+    import render as rd
+    bval = m['bval']
+    ol = m['ol']
+    nvols = m['nvols']
+    #Create figure
+    print('Creating PDF with QC output...')
+    fig, ax = rd.template('outliers', _layout)
+
+    #Eddy outliers
+    ax1 = ax['ol']
+    ax1.plot(0.5+np.arange(0, nvols), 100*np.sum(ol, axis=1)/ol.shape[1], color = 'r')
+    ax1.set_xlabel('DWI Volume', fontsize = 11)
+    ax1.set_ylabel("% outliers",fontsize = 11)
+    ax1.set_ylim([0, 2+np.max(100*np.sum(ol, axis=1)/ol.shape[1])])
+    ax1.set_title('% Outliers per volume', fontsize = 12)
+    ax1.annotate('Tot OL='+str(m['tot_ol']), xy = (0,1), fontsize=12);
+
+    ax2 = ax['ol_std']
+    rd.heatmap(fig, ax2, np.transpose(m['ol_std']), vmin=-4, vmax=4, cmap='RdBu_r',
+               cbar_label='No. std.', xstep=int(bval.size/10), ystep=10)
+    ax2.set_title('Outliers (Std off the mean slice diff)', fontsize=14)
+    ax2.set_ylabel("Slice", fontsize = 11)
+    ax2.set_xlabel("Volume", fontsize = 11)
+
+    #Eddy residuals
+    ax3 = ax['res']
+    if m['res_ms'] is None:
+        ax3.set_axis_off()
+    else:
+        ax3.set_axis_on()
+        ax3.plot(np.arange(0, nvols), m['res_ms'], marker='o', markersize=3, linewidth=0.5)
+        ax3.set_xlim(-0.5, nvols-0.5)
+        ax3.set_xlabel('DWI Volume', fontsize = 11)
+        ax3.set_ylabel('Mean squared residual', fontsize = 11)
+        ax3.set_title('Eddy residuals in brain mask', fontsize = 12)
+
+    #Eddy CNR maps
+    ax4 = ax['cnr']
+    cnr = m['cnr']
+    if cnr is None:
+        ax4.set_axis_off()
+    else:
+        ax4.set_axis_on()
+        _cnr_boxes(ax4, cnr)
+
+    rd.cohort_table(ax['cohort'], m.get('cohort'))
+    # gs.tight_layout(fig,h_pad=0,w_pad=0)
+    fig.suptitle(' QC for Subject '+str(args.subj)+' '+str(date), fontsize = 18)
+    rd.save(fig, args.pdf_output, rd.parse_formats(args.format), 'QC for Subject '+str(args.subj))
+    print('PDF saved!')
+
+
+def _cnr_boxes(ax, cnr):
+    """Boxes of the CNR distribution per shell and region from the precomputed percentiles."""
+    from rois import COLORS
+    nreg = len(cnr['regions'])
+    width = 0.8/nreg
+    for r, region in enumerate(cnr['regions']):
+        stats = [{'whislo': p[0], 'q1': p[1], 'med': p[2], 'q3': p[3], 'whishi': p[4],
+                  'mean': mu, 'fliers': []} for p, mu in zip(cnr['pct'][r], cnr['mean'][r])]
+        pos = np.arange(len(stats)) + (r-(nreg-1)/2)*width
+        art = ax.bxp(stats, positions=pos, widths=0.9*width, showmeans=True, patch_artist=True,
+                     manage_ticks=False)
+        for box in art['boxes']:
+            box.set_facecolor(COLORS.get(region, 'lightgray'))
+            box.set_alpha(0.6)
+        art['boxes'][0].set_label(region)
+    ax.set_xticks(np.arange(len(cnr['shells'])))
+    ax.set_xticklabels(cnr['shells'])
+    ax.set_ylabel('tSNR (b=0) / CNR', fontsize = 11)
+    ax.set_title('Eddy CNR maps per shell (whiskers 5-95%)', fontsize = 12)
+    ax.legend(fontsize = 9)
+
+
+def group_row(m, subj):
+    #storing subject data
+    std_ec = m['std_ec']
+    row = {'Sub': str(subj),
+            'EC_LinearTerm(x)(std)': std_ec[0],
+            'EC_LinearTerm(y)(std)': std_ec[1],
+            'EC_LinearTerm(z)(std)': std_ec[2],
+            'Total_Outliers': m['tot_ol']}
+    if m['res_ms'] is not None:
+        row['Eddy_Residuals'] = np.mean(m['res_ms'])
+        row['Eddy_Residuals(max)'] = np.max(m['res_ms'])
+    cnr = m['cnr']
+    if cnr is not None:
+        for r, region in enumerate(cnr['regions']):
+            suffix = '' if region == 'Brain' else '_'+region
+            for s, shell in enumerate(cnr['shells']):
+                # the first map is the tSNR of the b0s
+                name = 'SNR'+suffix+'(b<100)' if s == 0 else 'CNR'+suffix+'('+shell+')'
+                row[name+'(mean)'] = cnr['mean'][r, s]
+                row[name+'(p5)'] = cnr['pct'][r, s, 0]
+    return row
+
+
+def run(args, inputs=None):
+    from cohortstats import print_flags
+    from groupstore import GroupStore
+    import metrics
+    from qclog import phase
+    with phase('outliers', 'compute', args.subj):
+        m = compute(args, inputs or QCInputs())
+    if args.metrics:
+        metrics.save(m, args.metrics, 'outliers', args.subj)
+    ####### Creating dataframe and save data
+    print('Creating dataframe...')
+    #appending to the group store (locked; the text table is exported by qc_reports.py)
+    print('Appending data to group QC measures...')
+    with phase('outliers', 'table', args.subj):
+        m['cohort'] = GroupStore(args.txt_output).append(group_row(m, args.subj))
+    print_flags(m['cohort'])
+    with phase('outliers', 'render', args.subj):
+        render(m, args)
+    return m
+
+
+def main(argv=None):
+    run(get_parser().parse_args(argv))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Produce all QC reports of a subject in a single process.
+
+Runs the DTIFIT/SNR report (noeddyqc.py) and, when an eddy folder is given,
+the motion (qc_motion.py) and outlier (qc_ol.py) reports. The bval file,
+brain mask and tissue masks are parsed once and shared, and each report
+imports its plotting libraries only when it runs. The computed metrics of
+each report are kept in <qcdir>/metrics (metrics.py), from which
+render_reports.py rebuilds the reports without the imaging data.
+"""
+
+import argparse
+import glob
+import os
+import sys
+
+from qcinputs import QCInputs
+
+GROUP_FILES = {'dti': 'group_dti,snr.txt', 'motion': 'group_motion.txt',
+               'outliers': 'group_eddyoutliers.txt'}
+PDF_FILES = {'dti': 'qc.pdf', 'motion': 'qc_motion.pdf', 'outliers': 'qc_outliers.pdf'}
+# metrics artifacts: <metrics_dir>/<report>.npz and .json
+METRICS_DIR = 'metrics'
+
+
+def eddy_file(eddy_dir, suffix):
+    """First eddy output with the given suffix, None if missing."""
+    files = sorted(glob.glob(os.path.join(eddy_dir, '*'+suffix)))
+    return files[0] if files else None
+
+
+def report_module(name):
+    if name == 'dti':
+        import noeddyqc as report
+    elif name == 'motion':
+        import qc_motion as report
+    else:
+        import qc_ol as report
+    return report
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+            description='Create all QC PDFs and update the group QC tables for a single subject')
+    parser.add_argument('qcdir', help='QC directory (dwi_qa.sh output directory)')
+    parser.add_argument('subj', help='Subj ID')
+    parser.add_argument('bvals', help='Bval file')
+    parser.add_argument('data', help='DWI data')
+    parser.add_argument('--bvecs', default=None, help='Bvec file')
+    parser.add_argument('--mask', default=None, help='Brain mask. Default: <qcdir>/lowb_brain_mask.nii.gz')
+    parser.add_argument('--wm_mask', default=None, help='WM mask. Default: <qcdir>/wm_mask.nii.gz')
+    parser.add_argument('--gm_mask', default=None, help='Gray Matter Binary Mask')
+    parser.add_argument('--csf_mask', default=None, help='CSF Binary Mask')
+    parser.add_argument('--eddy_dir', default=None, help='Eddy output folder (motion and outlier reports)')
+    parser.add_argument('--nslices', type=int, default=None, help='Number of slices. Default: from the data header')
+    parser.add_argument('--mb_factor', type=int, default=None, help='Multiband factor (motion report)')
+    parser.add_argument('--slspec', default=None, help='eddy slspec file (motion report)')
+    parser.add_argument('--pdfdir', default=None, help='Report directory. Default: <qcdir>/reports')
+    parser.add_argument('--group_dir', default=None, help='Group QC directory. Default: report directory')
+    parser.add_argument('--cache_dir', default=None,
+                        help='Directory for binary copies of the parsed eddy text files. Default: <qcdir>/eddy_cache')
+    parser.add_argument('--metrics_dir', default=None,
+                        help='Directory of the per-report metrics (npz/json). Default: <qcdir>/metrics')
+    parser.add_argument('--format', default='pdf',
+                        help='Comma-separated report formats (pdf,png,html). Default: pdf')
+    parser.add_argument('--reports', default='dti,motion,outliers',
+                        help='Comma-separated reports to create. Default: dti,motion,outliers')
+    return parser
+
+
+def report_args(args):
+    """Command lines of the single-report scripts, by report name."""
+    pdfdir = args.pdfdir or os.path.join(args.qcdir, 'reports')
+    grpdir = args.group_dir or pdfdir
+    mask = args.mask or os.path.join(args.qcdir, 'lowb_brain_mask.nii.gz')
+    wm = args.wm_mask or os.path.join(args.qcdir, 'wm_mask.nii.gz')
+    cache = args.cache_dir or os.path.join(args.qcdir, 'eddy_cache')
+    pdf = {k: os.path.join(pdfdir, v) for k, v in PDF_FILES.items()}
+    grp = {k: os.path.join(grpdir, v) for k, v in GROUP_FILES.items()}
+    wanted = args.reports.split(',')
+    out = {}
+    if 'dti' in wanted:
+        argv = [args.qcdir, args.subj, pdf['dti'], grp['dti'], wm, args.bvals, args.data]
+        for opt in ['gm_mask', 'csf_mask', 'bvecs']:
+            if getattr(args, opt):
+                argv += ['--'+opt, getattr(args, opt)]
+        out['dti'] = argv
+    if not args.eddy_dir:
+        return out
+    params = eddy_file(args.eddy_dir, '.eddy_parameters')
+    if 'motion' in wanted:
+        nslices = args.nslices
+        if nslices is None:
+            import nibabel as nib
+            nslices = nib.load(args.data).shape[2]
+        out['motion'] = [eddy_file(args.eddy_dir, '.eddy_movement_over_time'),
+                         eddy_file(args.eddy_dir, '.eddy_movement_rms'),
+                         eddy_file(args.eddy_dir, '.eddy_restricted_movement_rms'),
+                         params, str(nslices), args.bvals, args.subj, pdf['motion'], grp['motion'],
+                         '--cache_dir', cache]
+        for opt in ['mb_factor', 'slspec']:
+            if getattr(args, opt):
+                out['motion'] += ['--'+opt, str(getattr(args, opt))]
+    if 'outliers' in wanted:
+        argv = [eddy_file(args.eddy_dir, '.eddy_outlier_map'),
+                eddy_file(args.eddy_dir, '.eddy_outlier_n_stdev_map'),
+                params, args.bvals, mask, args.subj, pdf['outliers'], grp['outliers'],
+                '--cache_dir', cache]
+        res = eddy_file(args.eddy_dir, '.eddy_residuals.nii.gz')
+        if res:
+            argv += ['--eddy_res', res]
+        cnr = eddy_file(args.eddy_dir, '.eddy_cnr_maps.nii.gz')
+        if cnr:
+            argv += ['--cnr_maps', cnr, '--wm_mask', wm]
+        out['outliers'] = argv
+    return out
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    inputs = QCInputs()
+    runs = report_args(args)
+    pdfdir = args.pdfdir or os.path.join(args.qcdir, 'reports')
+    grpdir = args.group_dir or pdfdir
+    metrics_dir = args.metrics_dir or os.path.join(args.qcdir, METRICS_DIR)
+    for d in (pdfdir, grpdir, metrics_dir):
+        os.makedirs(d, exist_ok=True)
+    done = []
+    for name, rargv in runs.items():
+        rargv += ['--format', args.format, '--metrics', os.path.join(metrics_dir, name)]
+        if None in rargv:
+            print('WARNING: missing eddy outputs, skipping', name, 'report')
+            continue
+        report = report_module(name)
+        report.run(report.get_parser().parse_args(rargv), inputs)
+        done.append(name)
+    # text tables once per subject, outside the group store lock
+    from groupstore import EXPORT_ENV, GroupStore
+    if done and os.environ.get(EXPORT_ENV) != '0':
+        for name in done:
+            GroupStore(os.path.join(grpdir, GROUP_FILES[name])).export()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
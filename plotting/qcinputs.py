@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Inputs shared by the QC reports.
+
+When several reports run in the same process (qc_reports.py) the gradient
+table (with its shells), brain mask and tissue ROIs are parsed once and
+handed to every report.
+"""
+
+
+class QCInputs:
+
+    def __init__(self):
+        self._cache = {}
+
+    def _get(self, key, func):
+        if key not in self._cache:
+            self._cache[key] = func()
+        return self._cache[key]
+
+    def bvals(self, path):
+        from gradients import read_bvals
+        return self._get(('bvals', path), lambda: read_bvals(path))
+
+    def bvecs(self, path):
+        from gradients import read_bvecs
+        return self._get(('bvecs', path), lambda: read_bvecs(path))
+
+    def gradients(self, bvals):
+        """Gradient table of the bval file: per-volume shell assignment."""
+        from gradients import GradientTable
+        return self._get(('gradients', bvals), lambda: GradientTable(self.bvals(bvals)))
+
+    def mask(self, path):
+        from niftiio import load_mask
+        return self._get(('mask', path), lambda: load_mask(path))
+
+    def rois(self, wm_mask, gm_mask=None, csf_mask=None):
+        """Tissue ROI registry for the given WM/GM/CSF masks."""
+        def build():
+            from rois import RoiRegistry
+            rois = RoiRegistry()
+            rois.add('WM', self.mask(wm_mask))
+            if gm_mask:
+                rois.add('GM', self.mask(gm_mask))
+            if csf_mask:
+                rois.add('CSF', self.mask(csf_mask))
+            return rois
+        return self._get(('rois', wm_mask, gm_mask, csf_mask), build)
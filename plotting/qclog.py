@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Timing records of the QC stages and report phases.
+
+dwi_qa.sh appends one JSON line per command and per stage to
+<outdir>/stage_times.jsonl (utils/stages.sh). The reports add one line per
+internal phase (compute, render, table) to the file named by DWIQAC_TIMELOG,
+with wall time, user/sys CPU time and the peak RSS of the process; nothing
+is written when the variable is unset.
+
+    python plotting/qclog.py summary cohort_qa/*/stage_times.jsonl
+aggregates the records of a cohort per stage and phase.
+"""
+
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+ENV = 'DWIQAC_TIMELOG'
+
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss//1024 if sys.platform == 'darwin' else rss
+
+
+def write(record, path=None):
+    """Append a record to the timing log (a single write, safe with other writers)."""
+    path = path or os.environ.get(ENV)
+    if not path:
+        return
+    with open(path, 'a') as f:
+        f.write(json.dumps(record)+'\n')
+
+
+@contextmanager
+def phase(report, name, subj=None):
+    """Time the enclosed block as phase report.name."""
+    if not os.environ.get(ENV):
+        yield
+        return
+    start, t0, r0 = time.time(), time.perf_counter(), resource.getrusage(resource.RUSAGE_SELF)
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        r1 = resource.getrusage(resource.RUSAGE_SELF)
+        record = {'type': 'phase', 'stage': os.environ.get('DWIQAC_STAGE', ''),
+                  'subj': subj or os.environ.get('DWIQAC_SUBJ'),
+                  'phase': report+'.'+name, 'start': round(start, 3),
+                  'wall_s': round(time.perf_counter()-t0, 3),
+                  'user_s': round(r1.ru_utime-r0.ru_utime, 3),
+                  'sys_s': round(r1.ru_stime-r0.ru_stime, 3),
+                  'max_rss_kb': peak_rss_kb()}
+        if error:
+            record['error'] = error
+        write(record)
+
+
+def read(paths):
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def summary(records):
+    """Per stage/phase: runs, subjects, median/mean/max wall time and max RSS."""
+    import numpy as np
+    groups = {}
+    rss = {}
+    for r in records:
+        if r['type'] == 'cmd':
+            # peak memory of a stage is that of its largest command
+            if r.get('max_rss_kb') is not None:
+                rss[r['stage']] = max(rss.get(r['stage'], 0), r['max_rss_kb'])
+            continue
+        if r['type'] == 'stage':
+            key = r['stage']
+        elif r['type'] == 'phase':
+            key = r['stage']+':'+r['phase'] if r['stage'] else r['phase']
+            rss[key] = max(rss.get(key, 0), r['max_rss_kb'])
+        else:
+            continue
+        g = groups.setdefault(key, {'wall': [], 'subj': set()})
+        g['wall'].append(r['wall_s'])
+        g['subj'].add(r.get('subj'))
+    rows = []
+    for key, g in groups.items():
+        wall = np.array(g['wall'])
+        rows.append({'name': key, 'runs': wall.size, 'subjects': len(g['subj']),
+                     'median_s': np.median(wall), 'mean_s': wall.mean(), 'max_s': wall.max(),
+                     'total_s': wall.sum(), 'max_rss_mb': rss.get(key, 0)/1024 or None})
+    return sorted(rows, key=lambda r: -r['total_s'])
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Summarise dwi_qa.sh stage timing records')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('summary', help='Aggregate stage_times.jsonl files per stage and report phase')
+    p.add_argument('files', nargs='+', help='stage_times.jsonl files')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    rows = summary(read(args.files))
+    print('{:<32} {:>5} {:>5} {:>10} {:>10} {:>10} {:>11} {:>10}'.format(
+        'stage/phase', 'runs', 'subj', 'median[s]', 'mean[s]', 'max[s]', 'total[s]', 'rss[MB]'))
+    for r in rows:
+        rss = '-' if r['max_rss_mb'] is None else '{:.1f}'.format(r['max_rss_mb'])
+        print('{name:<32} {runs:>5} {subjects:>5} {median_s:>10.2f} {mean_s:>10.2f} {max_s:>10.2f} '
+              '{total_s:>11.1f} '.format(**r)+'{:>10}'.format(rss))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
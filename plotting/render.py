@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Figure helpers shared by the QC reports.
+
+Dense panels (slice images, heatmaps, voxel histograms) are rasterized inside
+the vector PDF, so a report holds a few small bitmaps instead of one vector
+patch per voxel or matrix cell. Figures are built once per report layout
+and cleared for the next subject, and can be saved as PDF, PNG or a
+self-contained HTML page (PNG embedded as base64).
+"""
+
+import base64
+import io
+import os
+
+import numpy as np
+
+FORMATS = ('pdf', 'png', 'html')
+# resolution of the rasterized panels in the PDF and of the PNG/HTML pages
+RASTER_DPI = 150
+# FA shown at full brightness in the direction-encoded colour slices
+DEC_FA_MAX = 0.7
+
+_TEMPLATES = {}
+
+
+def template(key, build):
+    """Figure and axes of a report layout, built once and cleared on reuse.
+
+    build() returns (fig, axes). On reuse every axes of the figure, including
+    colorbars, is cleared and the layout computed when the first report was
+    saved is kept, so tight/constrained layout does not run again.
+    """
+    if key in _TEMPLATES:
+        fig, axes = _TEMPLATES[key]
+        fig.set_layout_engine('none')
+        for ax in fig.axes:
+            ax.clear()
+        return fig, axes
+    fig, axes = build()
+    _TEMPLATES[key] = (fig, axes)
+    return fig, axes
+
+
+def a4_figure(**kwargs):
+    """A4 portrait figure that is not registered with pyplot."""
+    from matplotlib.figure import Figure
+    return Figure(figsize=(8.27, 11.69), **kwargs)
+
+
+def hide_ticks(*axes):
+    for ax in axes:
+        ax.tick_params(axis='both', which='both', length=0, labelbottom=False, labelleft=False)
+
+
+def image(ax, data, **kwargs):
+    """Rasterized image of a 2D slice (array or RGB picture)."""
+    kwargs.setdefault('interpolation', 'nearest')
+    return ax.imshow(data, rasterized=True, **kwargs)
+
+
+def dec_slices(fa, v1, axis, indices, crop=True):
+    """Direction-encoded colour slices of a tensor fit, modulated by FA.
+
+    RGB is |V1| (x red, y green, z blue) scaled by FA/DEC_FA_MAX, for all
+    the slices at indices along axis (0 sagittal, 1 coronal, 2 axial) at
+    once. Returns (nslices, rows, cols, 3) floats in [0, 1], oriented as the
+    other slices for image(..., origin='lower') and cropped to the nonzero
+    FA of the slices when crop is set.
+    """
+    indices = np.atleast_1d(indices)
+    fa = np.take(np.asarray(fa, dtype=np.float32), indices, axis=axis)
+    v1 = np.take(np.asarray(v1, dtype=np.float32), indices, axis=axis)
+    rgb = np.abs(v1)*np.clip(fa/DEC_FA_MAX, 0, 1)[..., None]
+    # slice first, then the second in-plane axis as rows
+    rgb = np.clip(np.nan_to_num(np.moveaxis(rgb, axis, 0).transpose(0, 2, 1, 3)), 0, 1)
+    keep = rgb.any(axis=(0, 3))
+    if crop and keep.any():
+        rows = np.flatnonzero(keep.any(1))
+        cols = np.flatnonzero(keep.any(0))
+        rgb = rgb[:, rows[0]:rows[-1]+1, cols[0]:cols[-1]+1]
+    return rgb
+
+
+def colorbar(fig, img, ax, **kwargs):
+    """Colorbar next to ax, drawn in the same colorbar axes when the figure is reused."""
+    cax = getattr(ax, '_qc_cax', None)
+    if cax is not None:
+        return fig.colorbar(img, cax=cax, **kwargs)
+    cb = fig.colorbar(img, ax=ax, **kwargs)
+    ax._qc_cax = cb.ax
+    return cb
+
+
+def heatmap(fig, ax, data, vmin=None, vmax=None, cmap=None, cbar_label=None,
+            xstep=10, ystep=10):
+    """Matrix as one rasterized image, row 0 at the top (as seaborn.heatmap).
+
+    Ticks are placed at the cell centres every xstep/ystep cells (no ticks
+    for a step <= 0).
+    """
+    img = ax.imshow(data, vmin=vmin, vmax=vmax, cmap=cmap, aspect='auto',
+                    interpolation='nearest', origin='upper', rasterized=True)
+    colorbar(fig, img, ax, label=cbar_label)
+    for step, n, set_ticks, set_labels in [(xstep, data.shape[1], ax.set_xticks, ax.set_xticklabels),
+                                           (ystep, data.shape[0], ax.set_yticks, ax.set_yticklabels)]:
+        ticks = np.arange(0, n, step) if step > 0 else []
+        set_ticks(ticks)
+        set_labels([str(t) for t in ticks])
+    return img
+
+
+def hist(ax, counts, edges, **kwargs):
+    """Filled step histogram from precomputed counts, rasterized."""
+    return ax.stairs(counts, edges, fill=True, rasterized=True, **kwargs)
+
+
+def cohort_table(ax, cohort, fontsize=7, flag=True, title=None):
+    """Table of the subject's measures against the cohort, flagged rows in red.
+
+    cohort is the comparison returned by GroupStore.append. With flag=False
+    the z-scores are shown without QC decision, under the given title.
+    """
+    ax.set_axis_off()
+    if not cohort:
+        return None
+    from cohortstats import MIN_COHORT, PERCENTILES, Z_FLAG
+    lo, hi = PERCENTILES[0], PERCENTILES[-1]
+    fmt = '{:.4g}'.format
+    rows, colors = [], []
+    for name, c in cohort.items():
+        p = c['percentiles']
+        band = '-' if p[lo] is None else fmt(p[lo])+' - '+fmt(p[hi])
+        decision = c['decision'] if flag else None
+        z = '-' if c['decision'] is None else '{:+.2f}'.format(c['z'])
+        rows.append([name, fmt(c['value']), str(c['n']), fmt(c['mean'])+' +/- '+fmt(c['std']),
+                     band, z, (decision or '-').upper()])
+        colors.append(['#f4c7c3' if decision == 'flag' else 'w']*7)
+    # the table fills the width of the axes, and its height up to 12 rows
+    height = min(1.0, (len(rows)+1)/12)
+    table = ax.table(cellText=rows, cellColours=colors, bbox=[0, 1-height, 1, height], cellLoc='center',
+                     colWidths=[0.34, 0.1, 0.05, 0.19, 0.19, 0.07, 0.06],
+                     colLabels=['Measure', 'Value', 'n', 'Cohort mean +/- SD', 'P'+str(lo)+' - P'+str(hi),
+                                'z', 'QC'])
+    table.auto_set_font_size(False)
+    table.set_fontsize(fontsize)
+    if title is None:
+        title = 'Cohort comparison (flag: |z| > '+str(Z_FLAG)+', n >= '+str(MIN_COHORT)+')'
+    ax.set_title(title, fontsize=fontsize+3)
+    return table
+
+
+def output_paths(path, formats):
+    """Output file for each format, replacing the extension of path."""
+    base = os.path.splitext(path)[0]
+    return {f: base+'.'+f for f in formats}
+
+
+def parse_formats(value):
+    formats = [f for f in value.split(',') if f]
+    bad = [f for f in formats if f not in FORMATS]
+    if bad:
+        raise ValueError('unknown report format(s) '+','.join(bad)+', use '+','.join(FORMATS))
+    return formats
+
+
+def save(fig, path, formats=('pdf',), title=''):
+    """Save the figure in the given formats next to path."""
+    save_pages([fig], path, formats, title)
+
+
+def save_pages(figs, path, formats=('pdf',), title=''):
+    """Save figures as one multi-page PDF, one PNG per page and one HTML page.
+
+    The PNG pages are named <name>_p<N>.png when there are several.
+    """
+    pngs = []
+    if set(formats) - {'pdf'}:
+        for fig in figs:
+            buf = io.BytesIO()
+            fig.savefig(buf, format='png', dpi=RASTER_DPI)
+            pngs.append(buf.getvalue())
+    for fmt, out in output_paths(path, formats).items():
+        if fmt == 'pdf':
+            if len(figs) == 1:
+                figs[0].savefig(out, format='pdf', dpi=RASTER_DPI)
+                continue
+            from matplotlib.backends.backend_pdf import PdfPages
+            with PdfPages(out) as pdf:
+                for fig in figs:
+                    pdf.savefig(fig, dpi=RASTER_DPI)
+        elif fmt == 'png':
+            for n, png in enumerate(pngs):
+                name = out if len(pngs) == 1 else os.path.splitext(out)[0]+'_p'+str(n+1)+'.png'
+                with open(name, 'wb') as f:
+                    f.write(png)
+        else:
+            with open(out, 'w') as f:
+                f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>'+title+'</title></head>\n<body>')
+                for png in pngs:
+                    f.write('<img style="max-width:100%" alt="'+title+'" src="data:image/png;base64,'
+                            + base64.b64encode(png).decode('ascii')+'">\n')
+                f.write('</body></html>\n')
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Rebuild the QC reports of one or more subjects from their metrics.
+
+Reads <qcdir>/metrics/<report>.npz/.json written by qc_reports.py (see
+metrics.py) and renders the reports again, e.g. after a change of layout,
+colormap or format. The imaging data and eddy outputs are not read and the
+group tables are not modified: the cohort comparison is read from them.
+All subjects are rendered in one process, re-using the report figures.
+
+    python plotting/render_reports.py cohort_qa/*/ --format pdf,html
+"""
+
+import argparse
+import os
+import sys
+
+from qc_reports import GROUP_FILES, METRICS_DIR, PDF_FILES, report_module
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+            description='Render the QC reports from the stored per-subject metrics')
+    parser.add_argument('qcdirs', nargs='+', help='QC directories (dwi_qa.sh output directories)')
+    parser.add_argument('--pdfdir', default=None, help='Report directory. Default: <qcdir>/reports')
+    parser.add_argument('--group_dir', default=None,
+                        help='Group QC directory for the cohort comparison. Default: report directory')
+    parser.add_argument('--format', default='pdf',
+                        help='Comma-separated report formats (pdf,png,html). Default: pdf')
+    parser.add_argument('--reports', default='dti,motion,outliers',
+                        help='Comma-separated reports to render. Default: dti,motion,outliers')
+    return parser
+
+
+def render_report(qcdir, name, args):
+    """Render one report of a QC directory from its metrics, False if there are none."""
+    import metrics
+    from groupstore import GroupStore
+    from qclog import phase
+    prefix = os.path.join(qcdir, METRICS_DIR, name)
+    if not os.path.isfile(prefix+'.json'):
+        print('WARNING: no', name, 'metrics in', qcdir)
+        return False
+    m, head = metrics.load(prefix, name)
+    report = report_module(name)
+    pdfdir = args.pdfdir or os.path.join(qcdir, 'reports')
+    grpdir = args.group_dir or pdfdir
+    m['cohort'] = GroupStore(os.path.join(grpdir, GROUP_FILES[name])).compare(
+            report.group_row(m, head['subj']))
+    os.makedirs(pdfdir, exist_ok=True)
+    rargs = argparse.Namespace(subj=head['subj'], pdf_output=os.path.join(pdfdir, PDF_FILES[name]),
+                               format=args.format)
+    with phase(name, 'render', head['subj']):
+        report.render(m, rargs)
+    return True
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    failed = 0
+    for qcdir in args.qcdirs:
+        for name in args.reports.split(','):
+            try:
+                render_report(qcdir, name, args)
+            except (OSError, ValueError) as e:
+                print('ERROR: '+qcdir+' '+name+': '+str(e))
+                failed += 1
+    if failed:
+        print(str(failed)+' reports failed')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Tissue ROI registry shared by the QC reports.
+
+Masks are loaded once and kept as flat voxel indices. Tissue statistics of
+3D maps (mean, std, histogram counts) are computed on first request and
+cached, so plots and the group dataframe read the same numbers.
+"""
+
+import numpy as np
+from niftiio import load_mask, flat_indices
+
+# plotting colour of each tissue
+COLORS = {'WM': 'b', 'GM': 'g', 'CSF': 'r'}
+
+
+class RoiRegistry:
+
+    def __init__(self):
+        self.index = {}
+        self._maps = {}
+        self._cache = {}
+
+    def add(self, name, mask):
+        """Register a tissue from a mask file or a boolean volume."""
+        if isinstance(mask, str):
+            mask = load_mask(mask)
+        self.index[name] = flat_indices(mask)
+
+    def add_map(self, name, data):
+        """Register a 3D map (e.g. FA, MD) that tissue statistics are taken from."""
+        self._maps[name] = np.asarray(data).ravel(order='F')
+        self._cache = {k: v for k, v in self._cache.items() if k[1] != name}
+
+    @property
+    def names(self):
+        return list(self.index)
+
+    def indices(self, names=None):
+        """Flat voxel indices of the requested tissues (all by default)."""
+        return [self.index[n] for n in (names or self.names)]
+
+    def _cached(self, key, func):
+        if key not in self._cache:
+            self._cache[key] = func()
+        return self._cache[key]
+
+    def values(self, mapname, roi):
+        return self._cached(('values', mapname, roi),
+                            lambda: self._maps[mapname][self.index[roi]].astype(np.float64))
+
+    def mean(self, mapname, roi):
+        return self._cached(('mean', mapname, roi), lambda: np.mean(self.values(mapname, roi)))
+
+    def std(self, mapname, roi):
+        return self._cached(('std', mapname, roi), lambda: np.std(self.values(mapname, roi)))
+
+    def hist(self, mapname, roi, bins=100):
+        """Histogram (counts, edges) of a map within a tissue."""
+        return self._cached(('hist', mapname, roi, bins),
+                            lambda: np.histogram(self.values(mapname, roi), bins=bins))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Slice snapshots of the QC maps for visual inspection (no display needed).
+
+Writes to <qcdir>/screenshots the views previously taken with freeview:
+    tsnr.png             b0 tSNR, coronal (0-35)
+    dti_v1_coronal.png   V1 in direction-encoded colour, coronal
+    dti_v1_axial.png     V1 in direction-encoded colour, axial
+    dti_fa_coronal.png   FA, coronal
+    dti_md_coronal.png   MD, coronal
+    brain_mask.png       low-b brain with the brain mask outline, coronal
+    lowb_orig.png        low-b brain, axial
+    topup_unwarp.png     topup unwarped b0s, axial (when eddy used topup)
+Slices are the centre of the volume. Missing maps are skipped.
+
+Usage: screenshots.py qcdir [--eddy_dir eddy]
+"""
+
+import argparse
+import glob
+import os
+import sys
+
+import numpy as np
+
+# size of one snapshot (inches), saved at render.RASTER_DPI
+SIZE = (4, 4)
+
+
+def topup_unwarp(eddy_dir):
+    """topup unwarped b0s named in the eddy command line, None if not found."""
+    cmds = sorted(glob.glob(os.path.join(eddy_dir, '*.eddy_command_txt')))
+    if not cmds:
+        return None
+    with open(cmds[0]) as f:
+        words = f.read().split()
+    base = [w.split('=', 1)[1] for w in words if w.startswith('--topup=')]
+    if not base:
+        return None
+    for path in [base[0]+'_b0_unwarp.nii.gz', os.path.join(eddy_dir, base[0]+'_b0_unwarp.nii.gz')]:
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def _central(data, axis):
+    return np.take(data, data.shape[axis]//2, axis=axis).T
+
+
+def snapshot(path, data, title, colorbar=False, contour=None, **kwargs):
+    """Save one slice (2D map or RGB) as a PNG."""
+    from matplotlib.figure import Figure
+    import render as rd
+    fig = Figure(figsize=SIZE)
+    ax = fig.add_subplot()
+    img = rd.image(ax, data, origin='lower', **kwargs)
+    if contour is not None:
+        ax.contour(contour, levels=[0.5], colors='r', linewidths=0.8, origin='lower')
+    if colorbar:
+        rd.colorbar(fig, img, ax)
+    ax.set_title(title)
+    rd.hide_ticks(ax)
+    fig.savefig(path, dpi=rd.RASTER_DPI, bbox_inches='tight')
+    print('Saved', path)
+
+
+def take(qcdir, eddy_dir=None):
+    """Write the snapshots of a QC directory, returns the files written."""
+    from niftiio import load_map
+    from render import dec_slices
+    outdir = os.path.join(qcdir, 'screenshots')
+    os.makedirs(outdir, exist_ok=True)
+    dtdir = os.path.join(qcdir, 'dtifit')
+    maps = {}
+    for key, name in [('tsnr', 'bzeros_snr.nii.gz'), ('lowb', 'lowb_brain.nii.gz'),
+                      ('mask', 'lowb_brain_mask.nii.gz'), ('fa', 'dtifit/dtifit_FA.nii.gz'),
+                      ('md', 'dtifit/dtifit_MD.nii.gz'), ('v1', 'dtifit/dtifit_V1.nii.gz')]:
+        path = os.path.join(qcdir, name)
+        if os.path.isfile(path):
+            maps[key] = load_map(path)
+        else:
+            print('WARNING: '+path+' not found, snapshot skipped')
+    written = []
+
+    def save(name, *args, **kwargs):
+        path = os.path.join(outdir, name)
+        snapshot(path, *args, **kwargs)
+        written.append(path)
+
+    if 'tsnr' in maps:
+        save('tsnr.png', _central(maps['tsnr'], 1), 'SNR', colorbar=True, cmap='jet', vmin=0, vmax=35)
+    if 'fa' in maps and 'v1' in maps:
+        fa, v1 = maps['fa'], maps['v1']
+        save('dti_v1_coronal.png', dec_slices(fa, v1, 1, fa.shape[1]//2)[0], 'V1 - coronal')
+        save('dti_v1_axial.png', dec_slices(fa, v1, 2, fa.shape[2]//2)[0], 'V1 - axial')
+    if 'fa' in maps:
+        save('dti_fa_coronal.png', _central(maps['fa'], 1), 'FA', cmap='gray', vmin=0, vmax=1)
+    if 'md' in maps:
+        save('dti_md_coronal.png', _central(maps['md'], 1), 'MD', cmap='gray', vmin=0)
+    if 'lowb' in maps:
+        lowb = _central(maps['lowb'], 1)
+        mask = _central(maps['mask'], 1) > 0 if 'mask' in maps else None
+        save('brain_mask.png', lowb, 'Brain mask', contour=mask, cmap='gray', vmin=0)
+        save('lowb_orig.png', _central(maps['lowb'], 2), 'Low-b brain', cmap='gray', vmin=0)
+    unwarp = topup_unwarp(eddy_dir) if eddy_dir else None
+    if unwarp:
+        b0 = load_map(unwarp)
+        if b0.ndim > 3:
+            b0 = b0[..., 0]
+        save('topup_unwarp.png', _central(b0, 2), 'topup unwarped b0', cmap='gray', vmin=0)
+    return written
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Save slice snapshots of the QC maps as PNG')
+    parser.add_argument('qcdir', help='QC directory (dwi_qa.sh output directory)')
+    parser.add_argument('--eddy_dir', default=None, help='Eddy output folder (topup unwarped b0s)')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    take(args.qcdir, args.eddy_dir)
+    print('Screenshots Done')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
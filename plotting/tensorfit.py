@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Diffusion tensor fit and residuals, in process.
+
+Replaces the dtifit --save_tensor -> dtigen -> fslmaths -sub chain. The fit
+is the same linear least-squares fit of log signal as dtifit, restricted to
+the brain mask. Since the least-squares solution is linear in the log
+signal, the coefficients are accumulated while streaming the series one
+volume at a time (memory: 7 values per brain voxel); eigen-decomposition is
+then done in voxel chunks. Residuals are summarised per volume in a second
+streaming pass and the 4D prediction/residual images are never written
+unless asked (--save_residuals).
+
+Outputs use the dtifit names: <out>_FA, _MD, _V1, _S0, _tensor (.nii.gz).
+"""
+
+import argparse
+
+import numpy as np
+import nibabel as nib
+from niftiio import iter_volumes, n_volumes, load_mask, load_map, flat_indices, VolumeWriter
+import gradients
+
+# signals are floored before taking the log
+MIN_SIGNAL = 1e-4
+
+
+def design_matrix(bval, bvec):
+    """Design matrix of log(S) = log(S0) - b g'Dg.
+
+    Columns: log(S0), Dxx, Dxy, Dxz, Dyy, Dyz, Dzz (dtifit tensor order).
+    """
+    bval = np.ravel(bval)
+    gx, gy, gz = np.asarray(bvec, dtype=np.float64).T
+    return np.column_stack([np.ones_like(bval), -bval*gx*gx, -2*bval*gx*gy, -2*bval*gx*gz,
+                            -bval*gy*gy, -2*bval*gy*gz, -bval*gz*gz])
+
+
+def _tensor_matrices(t):
+    """(n, 6) tensor components -> (n, 3, 3) symmetric matrices."""
+    xx, xy, xz, yy, yz, zz = t.T
+    return np.stack([np.stack([xx, xy, xz], -1),
+                     np.stack([xy, yy, yz], -1),
+                     np.stack([xz, yz, zz], -1)], -2)
+
+
+def fit(data, bval, bvec, mask, chunk=100000):
+    """Fit the tensor in the brain mask.
+
+    Returns a dict of flat brain-voxel arrays: index, S0, tensor (n, 6),
+    FA, MD, V1 (n, 3).
+    """
+    X = design_matrix(bval, bvec)
+    pinv = np.linalg.pinv(X)
+    idx = flat_indices(mask)
+    coef = np.zeros((X.shape[1], idx.size))
+    for i, vol in iter_volumes(data):
+        s = np.asarray(vol).ravel(order='F')[idx].astype(np.float64)
+        coef += np.outer(pinv[:, i], np.log(np.maximum(s, MIN_SIGNAL)))
+
+    tensor = coef[1:].T
+    fa, md, v1 = tensor_maps(tensor, chunk)
+    return {'index': idx, 'S0': np.exp(coef[0]), 'tensor': tensor, 'FA': fa, 'MD': md, 'V1': v1}
+
+
+def tensor_maps(tensor, chunk=100000):
+    """FA, MD and V1 of (n, 6) tensors, eigen-decomposed in voxel chunks."""
+    n = tensor.shape[0]
+    fa = np.zeros(n)
+    md = np.zeros(n)
+    v1 = np.zeros((n, 3))
+    for c in range(0, n, chunk):
+        sl = slice(c, c+chunk)
+        evals, evecs = np.linalg.eigh(_tensor_matrices(tensor[sl]))
+        md[sl] = evals.mean(axis=1)
+        num = ((evals - md[sl, None])**2).sum(axis=1)
+        den = (evals**2).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fa[sl] = np.where(den > 0, np.sqrt(1.5*num/den), 0)
+        v1[sl] = evecs[:, :, -1]
+    return fa, md, v1
+
+
+def save(result, ref_img, out):
+    """Write the fit as 3D/4D maps named like dtifit outputs."""
+    shape = ref_img.shape[:3]
+    nvox = int(np.prod(shape))
+
+    def to_volume(values):
+        values = values.reshape(values.shape[0], -1)
+        vol = np.zeros((nvox, values.shape[1]), dtype=np.float32)
+        vol[result['index']] = values
+        vol = vol.reshape(shape+(values.shape[1],), order='F')
+        return vol[..., 0] if values.shape[1] == 1 else vol
+
+    hdr = ref_img.header.copy()
+    for name in ['FA', 'MD', 'S0', 'V1', 'tensor']:
+        img = nib.Nifti1Image(to_volume(result[name]), ref_img.affine, hdr)
+        img.set_data_dtype(np.float32)
+        nib.save(img, out+'_'+name+'.nii.gz')
+
+
+def residual_stats(data, s0, tensor, bval, bvec, rois_idx, save_residuals=None):
+    """Per-volume mean and std of data - tensor prediction in each ROI.
+
+    s0 (3D) and tensor (4D, 6 components) are the saved fit maps; voxels
+    outside the fit mask are predicted as 0, as dtigen -m does.
+    Returns two arrays of shape (len(rois_idx), nvols).
+    """
+    X = design_matrix(bval, bvec)
+    nvols = n_volumes(data)
+    s0 = np.asarray(s0).ravel(order='F')
+    tensor = np.asarray(tensor).reshape(-1, 6, order='F')
+    allidx = np.concatenate(rois_idx)
+    bounds = np.cumsum([0]+[r.size for r in rois_idx])
+    roi_s0 = s0[allidx].astype(np.float64)
+    roi_t = tensor[allidx].astype(np.float64)
+    mean = np.full((len(rois_idx), nvols), np.nan)
+    std = np.full((len(rois_idx), nvols), np.nan)
+    writer = None
+    if save_residuals:
+        ref = nib.load(data)
+        writer = VolumeWriter(save_residuals, ref, nvols)
+        s0_all = s0.astype(np.float64)
+        t_all = tensor.astype(np.float64)
+    for i, vol in iter_volumes(data):
+        flat = np.asarray(vol).ravel(order='F')
+        res = flat[allidx] - roi_s0*np.exp(roi_t @ X[i, 1:])
+        for k in range(len(rois_idx)):
+            r = res[bounds[k]:bounds[k+1]]
+            if r.size:
+                mean[k, i] = r.mean()
+                std[k, i] = r.std()
+        if writer:
+            pred = s0_all*np.exp(t_all @ X[i, 1:])
+            writer.write((flat - pred).reshape(vol.shape, order='F'))
+    if writer:
+        writer.close()
+    return mean, std
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Fit the diffusion tensor (dtifit-compatible outputs) without writing 4D images')
+    parser.add_argument('data', help='DWI data')
+    parser.add_argument('bvals', help='Bval file')
+    parser.add_argument('bvecs', help='Bvec file')
+    parser.add_argument('mask', help='Binary brain mask')
+    parser.add_argument('out', help='Output basename, e.g. dtifit/dtifit')
+    parser.add_argument('--save_residuals', action='store_true',
+                        help='Also write the 4D residuals as <out>_residuals.nii.gz')
+    args = parser.parse_args()
+
+    gt = gradients.load(args.bvals, args.bvecs, args.data)
+    bval, bvec = gt.bvals, gt.bvecs
+    from qclog import phase
+    print('Fitting tensor...')
+    with phase('tensorfit', 'fit'):
+        result = fit(args.data, bval, bvec, load_mask(args.mask))
+    with phase('tensorfit', 'save'):
+        save(result, nib.load(args.data), args.out)
+    if args.save_residuals:
+        print('Writing residuals...')
+        with phase('tensorfit', 'residuals'):
+            residual_stats(args.data, load_map(args.out+'_S0.nii.gz'), load_map(args.out+'_tensor.nii.gz'),
+                           bval, bvec, [result['index']], save_residuals=args.out+'_residuals.nii.gz')
+    print('Tensor fit done!')
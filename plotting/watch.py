@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+
+#author: Chiara Maffei
+#cmaffei@mgh.harvard.edu
+
+"""Incremental QC of a DWI series while it is acquired.
+
+Follows either a directory where the converter writes one NIfTI per volume
+(or per block of volumes), or a single NIfTI file whose dim4 grows. Every
+new volume updates, at the cost of one volume:
+    - the voxelwise running mean/std of the b0s (Welford), for the tSNR
+    - the WM mean/std of the volume (the cnrwm.txt values, CNR = mean/std)
+    - the signal of each slice against the expected slice profile of its
+      shell (dropout) and the shift of the signal centroid (motion)
+After each volume a summary JSON is rewritten (atomically) and the volume
+record is appended to <summary>.jsonl.
+
+The brain mask is a threshold of the first volume. Without --bvals, volumes
+whose mean brain signal is at least B0_FRAC of the first volume's are b0s.
+
+Usage: watch.py series_dir_or_file --summary live.json [--bvals dwi.bval]
+                [--wm_mask wm.nii.gz] [--nvols N] [--cnr_txt cnrwm.txt]
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+import zlib
+
+import numpy as np
+import nibabel as nib
+
+from niftiio import decode_volume, iter_volumes, flat_indices
+
+# brain mask: first volume above this fraction of its 99th percentile
+MASK_FRAC = 0.15
+# without bvals: b0 if the mean brain signal is at least this fraction of the first volume's
+B0_FRAC = 0.7
+# a slice is a dropout below this fraction of its expected signal
+DROPOUT_RATIO = 0.7
+# slices with fewer brain voxels are not checked
+MIN_SLICE_VOX = 50
+# centroid shift (mm) from the first volume of the shell flagged as motion
+MOTION_MM = 2.0
+# bytes read and decompressed at a time from a growing .nii.gz
+GZ_CHUNK = 1 << 20
+
+
+def _natural_key(name):
+    return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', name)]
+
+
+class SeriesDir:
+    """New volumes of a directory of NIfTI files (sorted by name).
+
+    A file is read once its size did not change since the previous poll
+    (or at once with stable=False).
+    """
+
+    def __init__(self, path, stable=True):
+        self.path = path
+        self.stable = stable
+        self.done = set()
+        self.sizes = {}
+        self.zooms = None
+
+    def poll(self):
+        names = sorted((f for f in os.listdir(self.path) if f.endswith(('.nii', '.nii.gz'))), key=_natural_key)
+        for name in names:
+            if name in self.done:
+                continue
+            f = os.path.join(self.path, name)
+            size = os.path.getsize(f)
+            if self.stable and self.sizes.get(name) != size:
+                # still being written (or first seen): wait for the next poll
+                self.sizes[name] = size
+                return
+            try:
+                vols = [np.array(v) for i, v in iter_volumes(f)]
+            except (IOError, EOFError, ValueError):
+                return
+            self.done.add(name)
+            self.zooms = self.zooms or nib.load(f).header.get_zooms()
+            for v in vols:
+                yield v
+
+
+class SeriesFile:
+    """New volumes of a 4D NIfTI whose dim4 grows.
+
+    Uncompressed files are read from the new volumes on. Gzipped files are
+    followed with one decompressor kept open between polls, so each poll
+    decompresses only the bytes appended since the previous one; the
+    stream starts again from the top only when the file is replaced or
+    shrinks (rewritten by the converter).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.nread = 0
+        self.zooms = None
+        # gzip stream: raw file, its inode, decompressor, compressed bytes not
+        # decompressed yet, decompressed bytes not consumed yet and the offset
+        # of their first byte in the image
+        self._raw = None
+        self._ino = None
+        self._z = None
+        self._tail = b''
+        self._buf = bytearray()
+        self._pos = 0
+
+    def poll(self):
+        try:
+            img = nib.load(self.path)
+        except Exception:
+            return
+        n = img.shape[3] if len(img.shape) > 3 else 1
+        if n <= self.nread:
+            return
+        self.zooms = img.header.get_zooms()
+        nbytes = int(np.prod(img.shape[:3]))*img.get_data_dtype().itemsize
+        if self.path.endswith('.gz'):
+            yield from self._poll_gz(img, n, nbytes)
+            return
+        if os.path.getsize(self.path) < img.dataobj.offset+n*nbytes:
+            return
+        try:
+            for i, v in iter_volumes(self.path, range(self.nread, n)):
+                vol = np.array(v)
+                self.nread = i+1
+                yield vol
+        except (IOError, EOFError, ValueError):
+            return
+
+    def _chunks(self):
+        """Bytes decompressed from what was appended since the previous poll."""
+        st = os.stat(self.path)
+        if self._raw is None or st.st_ino != self._ino or st.st_size < self._raw.tell():
+            self.close()
+            self._raw = open(self.path, 'rb')
+            self._ino = st.st_ino
+            self._z = zlib.decompressobj(16+zlib.MAX_WBITS)
+            self._tail = b''
+            self._buf = bytearray()
+            self._pos = 0
+        while True:
+            if not self._tail:
+                self._tail = self._raw.read(GZ_CHUNK)
+                if not self._tail:
+                    return
+            out = self._z.decompress(self._tail, GZ_CHUNK)
+            self._tail = self._z.unconsumed_tail
+            if self._z.eof:
+                # concatenated gzip members
+                self._tail = self._z.unused_data
+                self._z = zlib.decompressobj(16+zlib.MAX_WBITS)
+            yield out
+
+    def _poll_gz(self, img, n, nbytes):
+        offset = int(img.dataobj.offset)
+        try:
+            for out in self._chunks():
+                self._buf += out
+                while self.nread < n:
+                    start = offset+self.nread*nbytes-self._pos
+                    if start+nbytes > len(self._buf):
+                        # keep only the start of the next volume
+                        drop = min(start, len(self._buf))
+                        del self._buf[:drop]
+                        self._pos += drop
+                        break
+                    vol = np.array(decode_volume(bytes(self._buf[start:start+nbytes]), img.dataobj, img.shape[:3]))
+                    del self._buf[:start+nbytes]
+                    self._pos += start+nbytes
+                    self.nread += 1
+                    yield vol
+        except (OSError, zlib.error):
+            self.close()
+
+    def close(self):
+        if self._raw is not None:
+            self._raw.close()
+            self._raw = None
+
+
+class WatchQC:
+    """Running statistics of the volumes seen so far."""
+
+    def __init__(self, bvals=None, wm_mask=None, zooms=(1.0, 1.0, 1.0)):
+        self.gt = None
+        if bvals is not None:
+            from gradients import GradientTable
+            self.gt = GradientTable(bvals)
+        self.wm_mask = wm_mask
+        self.zooms = np.asarray(zooms[:3], dtype=float)
+        self.n = 0
+        self.idx = None
+        # b0 Welford state, per brain voxel
+        self.n_b0 = 0
+        self.b0_mean = None
+        self.b0_m2 = None
+        self.tsnr = (None, None)
+        # per shell: expected slice profile (running mean) and reference centroid
+        self.profile = {}
+        self.nprofile = {}
+        self.centroid = {}
+        self.flags = {'dropout': [], 'motion': []}
+
+    def _init_masks(self, vol):
+        mask = vol > MASK_FRAC*np.percentile(vol, 99)
+        self.idx = flat_indices(mask)
+        self.wm_idx = flat_indices(self.wm_mask) if self.wm_mask is not None else self.idx
+        # slice and voxel coordinates of the brain voxels (Fortran order)
+        ijk = np.unravel_index(self.idx, vol.shape, order='F')
+        self.coords = np.column_stack(ijk)*self.zooms
+        self.zidx = ijk[2]
+        self.nz = vol.shape[2]
+        self.zcount = np.bincount(self.zidx, minlength=self.nz)
+        self.zvalid = self.zcount >= min(MIN_SLICE_VOX, self.zcount.max())
+        self.first_mean = None
+
+    def _shell(self, i, x):
+        """Shell label of volume i (b0 from the signal when the bvals are not known)."""
+        if self.gt is not None and i < self.gt.nvols:
+            return int(self.gt.volume_shells()[i])
+        if self.first_mean is None:
+            self.first_mean = x.mean()
+        return 0 if x.mean() >= B0_FRAC*self.first_mean else -1
+
+    def update(self, vol):
+        """Add one volume and return its record."""
+        vol = np.asarray(vol, dtype=np.float32)
+        if self.idx is None:
+            self._init_masks(vol)
+        i = self.n
+        self.n += 1
+        flat = vol.ravel(order='F')
+        x = flat[self.idx].astype(np.float64)
+        shell = self._shell(i, x)
+        rec = {'volume': i, 'shell': 'b=0' if shell == 0 else ('dw' if shell < 0 else 'b='+str(shell)),
+               'brain_mean': float(x.mean())}
+        ######## b0 tSNR (Welford) ########
+        if shell == 0:
+            self.n_b0 += 1
+            if self.b0_mean is None:
+                self.b0_mean = np.zeros_like(x)
+                self.b0_m2 = np.zeros_like(x)
+            delta = x-self.b0_mean
+            self.b0_mean += delta/self.n_b0
+            self.b0_m2 += delta*(x-self.b0_mean)
+            if self.n_b0 > 1:
+                std = np.sqrt(self.b0_m2/(self.n_b0-1))
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    tsnr = np.where(std > 0, self.b0_mean/std, 0)
+                self.tsnr = (float(tsnr.mean()), float(tsnr.std()))
+        ######## WM mean/std (cnrwm.txt) ########
+        wm = flat[self.wm_idx].astype(np.float64)
+        rec['wm_mean'] = float(wm.mean())
+        rec['wm_std'] = float(wm.std())
+        rec['cnr'] = rec['wm_mean']/rec['wm_std'] if rec['wm_std'] > 0 else None
+        ######## slice dropout ########
+        with np.errstate(divide='ignore', invalid='ignore'):
+            prof = np.bincount(self.zidx, weights=x, minlength=self.nz)/self.zcount
+        valid = self.zvalid
+        prof = np.where(valid, prof/np.median(prof[valid]), 0)
+        dropout = []
+        if shell in self.profile:
+            ref = self.profile[shell]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ratio = np.where(valid & (ref > 0), prof/ref, 1)
+            dropout = np.flatnonzero(ratio < DROPOUT_RATIO).tolist()
+            rec['min_slice_ratio'] = float(ratio[valid].min())
+        if not dropout:
+            # only volumes without dropouts update the expected profile
+            k = self.nprofile.get(shell, 0)+1
+            self.nprofile[shell] = k
+            self.profile[shell] = prof if k == 1 else self.profile[shell]+(prof-self.profile[shell])/k
+        rec['dropout_slices'] = dropout
+        ######## centroid shift ########
+        c = (self.coords*x[:, None]).sum(0)/x.sum()
+        if shell not in self.centroid:
+            self.centroid[shell] = c
+        rec['centroid_shift_mm'] = float(np.linalg.norm(c-self.centroid[shell]))
+        if dropout:
+            self.flags['dropout'].append(i)
+        if rec['centroid_shift_mm'] > MOTION_MM:
+            self.flags['motion'].append(i)
+        return rec
+
+    def summary(self, series, nexpected=None, last=None):
+        return {'series': series, 'updated': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'volumes_done': self.n, 'volumes_expected': nexpected,
+                'tsnr': {'n_b0': self.n_b0, 'mean': self.tsnr[0], 'std': self.tsnr[1]},
+                'flags': self.flags, 'thresholds': {'dropout_ratio': DROPOUT_RATIO, 'motion_mm': MOTION_MM},
+                'last': last}
+
+
+def write_json(path, obj):
+    """Atomic rewrite, a reader never sees a partial file."""
+    tmp = path+'.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=1)
+    os.replace(tmp, path)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+            description='Follow a DWI series during acquisition and keep a live QC summary')
+    parser.add_argument('series', help='Directory of per-volume NIfTIs or growing 4D NIfTI')
+    parser.add_argument('--summary', required=True, help='Live summary JSON (volume records in <summary>.jsonl)')
+    parser.add_argument('--bvals', default=None, help='Bval file (b0s and shells). Default: b0s from the signal')
+    parser.add_argument('--wm_mask', default=None, help='WM mask for the CNR. Default: brain threshold mask')
+    parser.add_argument('--cnr_txt', default=None, help='Also append the WM mean/std of each volume (cnrwm.txt layout)')
+    parser.add_argument('--nvols', default=None, type=int,
+                        help='Stop after this many volumes. Default: number of bvals, if given')
+    parser.add_argument('--interval', default=2.0, type=float, help='Seconds between polls. Default=2')
+    parser.add_argument('--timeout', default=600.0, type=float,
+                        help='Stop after this many seconds without a new volume. Default=600')
+    parser.add_argument('--once', action='store_true', help='Process the volumes available now and exit')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    bvals = None
+    if args.bvals:
+        from gradients import read_bvals
+        bvals = read_bvals(args.bvals)
+    nexpected = args.nvols or (bvals.size if bvals is not None else None)
+    source = SeriesDir(args.series, stable=not args.once) if os.path.isdir(args.series) else SeriesFile(args.series)
+    wm = np.asanyarray(nib.load(args.wm_mask).dataobj) > 0 if args.wm_mask else None
+    qc = None
+    last_new = time.time()
+    vlog = os.path.splitext(args.summary)[0]+'.jsonl'
+    open(vlog, 'w').close()
+    if args.cnr_txt:
+        open(args.cnr_txt, 'w').close()
+    while True:
+        for vol in source.poll() or []:
+            if qc is None:
+                if wm is not None and wm.shape != vol.shape:
+                    print('ERROR: WM mask shape '+str(wm.shape)+' does not match the volumes '+str(vol.shape))
+                    return 1
+                qc = WatchQC(bvals, wm, source.zooms)
+            rec = qc.update(vol)
+            last_new = time.time()
+            with open(vlog, 'a') as f:
+                f.write(json.dumps(rec)+'\n')
+            if args.cnr_txt:
+                with open(args.cnr_txt, 'a') as f:
+                    f.write('{:.6f} {:.6f}\n'.format(rec['wm_mean'], rec['wm_std']))
+            write_json(args.summary, qc.summary(args.series, nexpected, rec))
+            warn = []
+            if rec['dropout_slices']:
+                warn.append('dropout in slices '+','.join(str(z) for z in rec['dropout_slices']))
+            if rec['centroid_shift_mm'] > MOTION_MM:
+                warn.append('signal centroid moved {:.1f} mm'.format(rec['centroid_shift_mm']))
+            print('Volume {} ({}): CNR {}'.format(rec['volume'], rec['shell'],
+                  '-' if rec['cnr'] is None else '{:.2f}'.format(rec['cnr']))
+                  + (' WARNING: '+'; '.join(warn) if warn else ''))
+            if nexpected and qc.n >= nexpected:
+                print('All '+str(nexpected)+' volumes received')
+                return 0
+        if args.once or time.time()-last_new > args.timeout:
+            return 0
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
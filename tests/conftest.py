@@ -0,0 +1,5 @@
+# the plotting modules import each other by name, as when run as scripts
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'plotting'))
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from cohortstats import MIN_COHORT, PERCENTILES, RunningStats
+
+
+def _stats(values):
+    s = RunningStats()
+    for v in values:
+        s.add(float(v))
+    return s
+
+
+def test_remove_undoes_add():
+    rng = np.random.default_rng(0)
+    x = rng.normal(10, 3, 200)
+    s = _stats(x)
+    for v in x[:150]:
+        s.remove(float(v))
+    assert s.n == 50
+    assert s.mean == pytest.approx(x[150:].mean())
+    assert s.std == pytest.approx(x[150:].std(ddof=1))
+
+
+def test_remove_replace_and_empty():
+    x = [1.0, 4.0, 9.0, 16.0]
+    s = _stats(x)
+    # a re-run subject: its old value out, the new one in
+    s.remove(9.0)
+    s.add(3.0)
+    assert s.mean == pytest.approx(np.mean([1, 4, 3, 16]))
+    assert s.std == pytest.approx(np.std([1, 4, 3, 16], ddof=1))
+    for v in [1.0, 4.0, 3.0, 16.0]:
+        s.remove(v)
+    assert (s.n, s.mean, s.m2) == (0, 0.0, 0.0)
+
+
+@pytest.mark.parametrize('dist', ['normal', 'lognormal', 'uniform'])
+def test_p2_percentiles(dist):
+    rng = np.random.default_rng(1)
+    x = getattr(rng, dist)(size=5000)
+    s = _stats(x)
+    spread = np.percentile(x, 95)-np.percentile(x, 5)
+    for pc in PERCENTILES:
+        assert abs(s.percentile(pc)-np.percentile(x, pc)) < 0.01*spread
+
+
+def test_p2_survives_storage():
+    # the group store saves and reloads the sketches between subjects
+    rng = np.random.default_rng(2)
+    x = rng.normal(size=1000)
+    s = RunningStats()
+    for v in x:
+        s = RunningStats(s.n, s.mean, s.m2, s.sketch())
+        s.add(float(v))
+    ref = _stats(x)
+    for pc in PERCENTILES:
+        assert s.percentile(pc) == pytest.approx(ref.percentile(pc))
+
+
+def test_p2_exact_below_five_values():
+    s = _stats([3.0, 1.0, 2.0])
+    for pc in PERCENTILES:
+        assert s.percentile(pc) == pytest.approx(np.percentile([1, 2, 3], pc))
+
+
+def test_compare_needs_a_cohort():
+    s = _stats(np.arange(MIN_COHORT-1))
+    assert s.compare(100.0)['decision'] is None
+    s.add(float(MIN_COHORT-1))
+    c = s.compare(100.0)
+    assert c['decision'] == 'flag'
+    assert c['z'] == pytest.approx((100-s.mean)/s.std)
@@ -0,0 +1,40 @@
+import numpy as np
+
+from gradients import B0_MAX, SHELL_TOL, GradientTable, cluster_shells
+
+
+def test_b0_edge():
+    shells, index = cluster_shells([0, B0_MAX-0.1, B0_MAX, 1000])
+    assert shells.tolist() == [0, 100, 1000]
+    assert index.tolist() == [0, 0, 1, 2]
+
+
+def test_shell_tolerance_edge():
+    # consecutive b-values at the tolerance are one shell, above it two
+    shells, index = cluster_shells([1000, 1000, 1000+SHELL_TOL, 2000, 2000+SHELL_TOL+0.5])
+    assert shells.tolist() == [1000, 2000, 2050]
+    assert index.tolist() == [0, 0, 0, 1, 2]
+
+
+def test_shells_chain_and_order():
+    # a shell is split only at gaps larger than the tolerance, not by its width
+    bval = [2005, 0, 995, 1040, 1080, 5, 1995, 1000]
+    shells, index = cluster_shells(bval)
+    assert shells.tolist() == [0, 1020, 2000]
+    assert index.tolist() == [2, 0, 1, 1, 1, 0, 2, 1]
+
+
+def test_no_b0_and_only_b0():
+    shells, index = cluster_shells([1000, 3000])
+    assert shells.tolist() == [1000, 3000]
+    assert index.tolist() == [0, 1]
+    shells, index = cluster_shells([0, 0, 50])
+    assert shells.tolist() == [0]
+    assert index.tolist() == [0, 0, 0]
+
+
+def test_volume_shells():
+    gt = GradientTable(np.array([0, 995, 2010, 1005, 0]))
+    assert gt.volume_shells().tolist() == [0, 1000, 2010, 1000, 0]
+    assert gt.b0.tolist() == [True, False, False, False, True]
+    assert gt.labels == ['b=0', 'b=1000', 'b=2010']
@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import pytest
+
+from cohortstats import RunningStats
+from groupstore import GroupStore
+
+
+def _store(tmp_path):
+    return GroupStore(os.path.join(str(tmp_path), 'group_motion.txt'))
+
+
+def _fill(store, values):
+    for i, v in enumerate(values):
+        store.append({'Sub': 's'+str(i), 'a': v, 'b': 2*v})
+
+
+def test_append_replaces_subject(tmp_path):
+    store = _store(tmp_path)
+    values = list(np.linspace(1, 12, 12))
+    _fill(store, values)
+    store.append({'Sub': 's3', 'a': 100.0, 'b': 200.0})
+    df = store.read()
+    assert len(df) == 12
+    assert df.loc[df['Sub'] == 's3', 'a'].item() == 100.0
+    values[3] = 100.0
+    s = store.stats()['a']
+    assert s.n == 12
+    assert s.mean == pytest.approx(np.mean(values))
+    assert s.std == pytest.approx(np.std(values, ddof=1))
+
+
+def test_append_compares_before_adding(tmp_path):
+    store = _store(tmp_path)
+    _fill(store, np.arange(10.0))
+    cohort = store.append({'Sub': 'new', 'a': 50.0, 'b': 4.0})
+    assert cohort['a']['n'] == 10
+    assert cohort['a']['z'] == pytest.approx((50-4.5)/np.std(np.arange(10.0), ddof=1))
+    assert cohort['a']['decision'] == 'flag'
+    assert cohort['b']['decision'] == 'pass'
+    assert 'Sub' not in cohort
+
+
+def test_compare_is_read_only_and_leaves_out_the_subject(tmp_path):
+    store = _store(tmp_path)
+    assert store.compare({'Sub': 's0', 'a': 1.0}) is None
+    _fill(store, np.arange(12.0))
+    before = store.stats()['a']
+    c = store.compare({'Sub': 's11', 'a': 11.0})
+    ref = RunningStats()
+    for v in np.arange(11.0):
+        ref.add(v)
+    assert c['a']['n'] == 11
+    assert c['a']['mean'] == pytest.approx(ref.mean)
+    assert c['a']['z'] == pytest.approx(ref.compare(11.0)['z'])
+    after = store.stats()['a']
+    assert (after.n, after.mean, after.m2) == (before.n, before.mean, before.m2)
+    assert len(store.read()) == 12
+
+
+def test_export_in_order(tmp_path):
+    store = _store(tmp_path)
+    _fill(store, [1.0, 2.0, 3.0])
+    store.export(order=['s2', 's0'])
+    lines = open(store.txt_path).read().splitlines()
+    assert [l.split()[1] for l in lines[1:]] == ['s2', 's0', 's1']
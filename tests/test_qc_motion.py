@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import pytest
+
+from qc_motion import excitation_groups, s2v_variance
+
+NVOLS = 7
+NSLICES = 12
+
+
+def _s2v(extra=0):
+    # eddy writes one row of 6 parameters per slice of every volume
+    return np.random.default_rng(0).normal(size=(NVOLS*NSLICES+extra, 6))
+
+
+def _loop(s2v, groups=None):
+    """Per-volume loop of the previous version, over excitation groups if given."""
+    out = np.full((NVOLS, 6), -1.0)
+    for i in range(NVOLS):
+        tmp = s2v[i*NSLICES:(i+1)*NSLICES]
+        if groups is not None:
+            tmp = np.array([tmp[groups == g].mean(axis=0) for g in range(groups.max()+1)])
+        out[i] = np.var(tmp, ddof=1, axis=0)
+    return out
+
+
+def test_single_band_matches_loop():
+    s2v = _s2v(extra=5)
+    assert excitation_groups(NSLICES) is None
+    np.testing.assert_allclose(s2v_variance(s2v, NVOLS, NSLICES), _loop(s2v))
+
+
+@pytest.mark.parametrize('mb', [2, 3, 4])
+def test_mb_factor_matches_loop(mb):
+    s2v = _s2v()
+    groups = excitation_groups(NSLICES, mb)
+    assert np.bincount(groups).tolist() == [mb]*(NSLICES//mb)
+    np.testing.assert_allclose(s2v_variance(s2v, NVOLS, NSLICES, groups), _loop(s2v, groups))
+
+
+def test_slspec_matches_loop(tmp_path):
+    # interleaved MB 2 acquisition: slices i and i+6 excited together, odd first
+    order = list(range(1, 6, 2))+list(range(0, 6, 2))
+    spec = np.array([[i, i+NSLICES//2] for i in order])
+    path = os.path.join(str(tmp_path), 'slspec.txt')
+    np.savetxt(path, spec, fmt='%d')
+    groups = excitation_groups(NSLICES, slspec=path)
+    for g, row in enumerate(spec):
+        assert (groups[row] == g).all()
+    s2v = _s2v()
+    expected = _loop(s2v, groups)
+    np.testing.assert_allclose(s2v_variance(s2v, NVOLS, NSLICES, groups), expected)
+    # the same excitations as MB 2, listed in another order
+    np.testing.assert_allclose(s2v_variance(s2v, NVOLS, NSLICES, excitation_groups(NSLICES, 2)), expected)
+
+
+def test_bad_excitation_groups(tmp_path):
+    with pytest.raises(ValueError):
+        excitation_groups(NSLICES, 5)
+    path = os.path.join(str(tmp_path), 'slspec.txt')
+    np.savetxt(path, np.array([[0, 6], [1, 7]]), fmt='%d')
+    with pytest.raises(ValueError):
+        excitation_groups(NSLICES, slspec=path)
+    np.savetxt(path, np.array([[0, 12]]), fmt='%d')
+    with pytest.raises(ValueError):
+        excitation_groups(NSLICES, slspec=path)
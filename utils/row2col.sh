@@ -1,18 +0,0 @@
-#!/bin/bash
-#rm $2
-awk '
-    { 
-        for (i=1; i<=NF; i++)  {
-            a[NR,i] = $i
-        }  
-    }
-    NF>p { p = NF }
-    END {    
-        for(j=1; j<=p; j++) {
-            str=a[1,j]
-            for(i=2; i<=NR; i++){
-                str=str" "a[i,j];
-            }
-            print str
-        }
-     }' $1 > $2
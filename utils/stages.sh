@@ -0,0 +1,404 @@
+#!/bin/bash
+
+# AUTHOR: Chiara Maffei
+# Contact: cmaffei@mgh.harvard.edu
+
+# Stage bookkeeping for dwi_qa.sh (sourced, not executed).
+# Every stage records in $STAGEDIR/<stage>.txt the command line, the tool
+# versions and a signature (size+mtime, or md5 with DWIQAC_STAGE_HASH=1) of
+# its input and output files. A stage is skipped when the recorded manifest
+# matches the current one and all outputs exist.
+# When TIMELOG is set, every command, completed stage and skipped stage
+# appends a JSON line to it: wall time, user/sys CPU time and max RSS (from
+# GNU time, $DWIQAC_TIME or /usr/bin/time, if available; CPU times from the
+# shell 'times' otherwise), exit code and the sizes of the stage outputs.
+# Stages can also be registered with their dependencies (dag_add) and run by
+# dag_run, which starts every stage whose dependencies are done as soon as
+# enough of the thread budget ($DWIQAC_NTHREADS) is free and stops at the
+# first failure. Each stage sees its own share in DWIQAC_STAGE_THREADS and
+# in the OpenMP/BLAS/ITK/MRtrix thread variables.
+# Files in $SCRATCHDIR are intermediates: they are recorded by name
+# (relative to the scratch folder, which changes from run to run) and by the
+# signature of the inputs of the stage writing them (registered by dag_add),
+# so a change upstream still reaches the stages reading them. The stages
+# writing them (dag_transient) run only when a stage reading them has to run.
+# Needs: LF (log file), STAGEDIR, TOOLVER, FORCE ("", "all" or "stage1,stage2"),
+# SCRATCHDIR ("" without scratch folder)
+
+file_sig()
+{
+local f
+for f in $@; do
+	if [[ $SCRATCHDIR && $f == $SCRATCHDIR/* ]]; then
+		# the scratch file may be gone: sign it by what it is made from
+		echo "$f scratch from:" `file_sig ${SCRATCH_SRC[$f]}`
+	elif [[ ! -e $f ]]; then
+		echo "$f missing"
+	elif [[ $DWIQAC_STAGE_HASH ]]; then
+		echo "$f `stat -L -c '%s' $f` `md5sum < $f | awk '{print $1}'`"
+	else
+		echo "$f `stat -L -c '%s %Y' $f`"
+	fi
+done
+}
+
+stage_manifest()
+{
+# stage_manifest NAME "INPUTS" "OUTPUTS" "CMD"
+{
+echo "stage: $1"
+echo "cmd: $4"
+echo "tools: $TOOLVER"
+file_sig $2 | sed 's/^/in: /'
+file_sig $3 | sed 's/^/out: /'
+} | if [[ $SCRATCHDIR ]]; then sed "s|$SCRATCHDIR/|\$SCRATCHDIR/|g"; else cat; fi
+}
+
+json_str()
+{
+printf '"%s"' "$(printf '%s' "$1" | sed -e 's/\\/\\\\/g' -e 's/"/\\"/g' -e 's/\t/\\t/g')"
+}
+
+now()
+{
+date +%s.%N
+}
+
+elapsed()
+{
+# elapsed START: seconds since START (from now)
+awk -v a=$1 -v b=`now` 'BEGIN{printf "%.3f", b-a}'
+}
+
+children_cpu()
+{
+# children_cpu FILE: user and sys CPU seconds of the finished children in the
+# output of 'times' (run it in the current shell, not in a subshell)
+tail -n 1 $1 | awk '{for (i=1; i<=2; i++) {split($i, t, "m"); sub("s", "", t[2]); printf "%.3f ", 60*t[1]+t[2]}}'
+}
+
+gnu_time()
+{
+# path of a GNU time supporting -f/-o, empty if none
+local t=${DWIQAC_TIME:-/usr/bin/time}
+if [[ -x $t ]] && $t -f %e -o /dev/null true &> /dev/null; then
+	echo $t
+fi
+}
+
+time_record()
+{
+# time_record TYPE STAGE [KEY=JSON ...]: append a JSON line to $TIMELOG
+local rec="{\"type\": `json_str "$1"`, \"stage\": `json_str "$2"`, \"subj\": `json_str "$subjid"`"
+shift 2
+for kv in "$@"; do
+	rec="$rec, \"${kv%%=*}\": ${kv#*=}"
+done
+echo "$rec}" >> $TIMELOG
+}
+
+file_sizes()
+{
+# JSON object of the sizes (bytes) of the given files, null if missing
+local out="" f
+for f in $@; do
+	if [[ -e $f ]]; then
+		out="$out, `json_str $f`: `stat -L -c '%s' $f`"
+	else
+		out="$out, `json_str $f`: null"
+	fi
+done
+echo "{${out#, }}"
+}
+
+timed_eval()
+{
+# timed_eval "CMD": eval CMD and append its timing record to $TIMELOG
+local tf=`mktemp` start=`now` rc=0 wall cpu0 cpu1 usr sys rss=null
+if [[ $TIMEBIN ]]; then
+	$TIMEBIN -f '%U %S %M' -o $tf bash -c "$1" || rc=$?
+	wall=`elapsed $start`
+	read usr sys rss < <(tail -n 1 $tf)
+else
+	times > $tf.0
+	eval ${1} || rc=$?
+	times > $tf
+	wall=`elapsed $start`
+	cpu0=(`children_cpu $tf.0`)
+	cpu1=(`children_cpu $tf`)
+	rm -f $tf.0
+	usr=`awk -v a=${cpu0[0]} -v b=${cpu1[0]} 'BEGIN{printf "%.3f", b-a}'`
+	sys=`awk -v a=${cpu0[1]} -v b=${cpu1[1]} 'BEGIN{printf "%.3f", b-a}'`
+fi
+rm -f $tf
+time_record cmd "$DWIQAC_STAGE" "cmd=`json_str "$1"`" "start=$start" "wall_s=$wall" \
+	"user_s=${usr:-null}" "sys_s=${sys:-null}" "max_rss_kb=${rss:-null}" "exit=$rc"
+return $rc
+}
+
+stage_forced()
+{
+[[ $FORCE == all ]] || [[ ",$FORCE," == *",$1,"* ]]
+}
+
+stage_current()
+{
+# stage_current NAME "INPUTS" "OUTPUTS" "CMD": true if the recorded manifest
+# matches and all outputs exist
+local mf=$STAGEDIR/$1.txt
+if stage_forced $1 || [[ ! -f $mf ]]; then
+	return 1
+fi
+for f in $3; do
+	if [[ ! -e $f ]]; then
+		return 1
+	fi
+done
+[[ "`stage_manifest "$1" "$2" "$3" "$4"`" == "`cat $mf`" ]]
+}
+
+stage_needed()
+{
+# stage_needed NAME "INPUTS" "OUTPUTS" "CMD": true if the stage must run
+if stage_current "$1" "$2" "$3" "$4"; then
+	echo "Stage $1 up to date. Skipping (use -F $1 to re-run)"
+	echo "# skipped $1 (up to date)" >> $LF
+	if [[ $TIMELOG ]]; then
+		time_record skip $1
+	fi
+	return 1
+fi
+stage_start $1
+return 0
+}
+
+stage_start()
+{
+export DWIQAC_STAGE=$1
+STAGE_T0=`now`
+}
+
+stage_done()
+{
+# stage_done NAME "INPUTS" "OUTPUTS" "CMD": record the manifest of a completed stage
+mkdir -p $STAGEDIR
+stage_manifest "$1" "$2" "$3" "$4" > $STAGEDIR/$1.txt
+if [[ $TIMELOG ]]; then
+	time_record stage $1 "start=$STAGE_T0" "wall_s=`elapsed $STAGE_T0`" "outputs=`file_sizes $3`"
+fi
+}
+
+run_cmd()
+{
+local rc=0
+echo ${1}
+if [[ $TIMELOG ]]; then
+	timed_eval "$1" || rc=$?
+else
+	eval ${1} || rc=$?
+fi
+echo ${1} >> $LF
+return $rc
+}
+
+run_stage()
+{
+# run_stage NAME "INPUTS" "OUTPUTS" "CMD": single-command stage
+if stage_needed "$1" "$2" "$3" "$4"; then
+	rm -f $STAGEDIR/$1.txt
+	run_cmd "$4"
+	stage_done "$1" "$2" "$3" "$4"
+fi
+}
+
+########## Stage graph ##########
+# thread settings honoured by numpy (OpenMP/BLAS), ITK (FreeSurfer) and MRtrix
+THREAD_VARS="OMP_NUM_THREADS OPENBLAS_NUM_THREADS MKL_NUM_THREADS NUMEXPR_NUM_THREADS VECLIB_MAXIMUM_THREADS ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS MRTRIX_NTHREADS"
+
+set_threads()
+{
+# set_threads N: export N as the thread count of the commands run from now on
+local v
+export DWIQAC_STAGE_THREADS=$1
+for v in $THREAD_VARS; do
+	export $v=$1
+done
+}
+
+DAG_NAMES=()
+declare -gA DAG_DEPS DAG_CPUS DAG_JOB DAG_TRANSIENT SCRATCH_SRC
+
+dag_add()
+{
+# dag_add NAME "DEPS" THREADS CMD [ARGS ...]: register a stage of the graph.
+# CMD ARGS (e.g. run_stage NAME "INPUTS" "OUTPUTS" "CMD") runs in a
+# background subshell with set -e and THREADS threads once the stages in
+# DEPS are done; dependencies that were not registered are ignored
+local name=$1 out
+DAG_NAMES+=($name)
+DAG_DEPS[$name]=$2
+DAG_CPUS[$name]=$3
+shift 3
+DAG_JOB[$name]=`printf '%q ' "$@"`
+if [[ $SCRATCHDIR && $1 == run_stage ]]; then
+	for out in $4; do
+		if [[ $out == $SCRATCHDIR/* ]]; then
+			SCRATCH_SRC[$out]=$3
+		fi
+	done
+fi
+}
+
+dag_transient()
+{
+# dag_transient NAME ...: the outputs of these stages are intermediates,
+# they run only if a stage depending on them is not up to date
+local name
+for name in "$@"; do
+	DAG_TRANSIENT[$name]=1
+done
+}
+
+dag_current()
+{
+# dag_current NAME: true if NAME is a run_stage stage that is up to date
+eval "set -- ${DAG_JOB[$1]}"
+[[ $1 == run_stage ]] && stage_current "$2" "$3" "$4" "$5"
+}
+
+dag_prune()
+{
+# mark as done the transient stages no stage that has to run depends on
+local name dep changed=1
+local -A needed current
+while [[ $changed ]]; do
+	changed=""
+	for name in "${!DAG_TRANSIENT[@]}"; do
+		[[ ${state[$name]} && ! ${needed[$name]} ]] || continue
+		if stage_forced $name; then
+			needed[$name]=1
+			changed=1
+			continue
+		fi
+		for dep in "${DAG_NAMES[@]}"; do
+			[[ " ${DAG_DEPS[$dep]} " == *" $name "* ]] || continue
+			if [[ ${DAG_TRANSIENT[$dep]} ]]; then
+				[[ ${needed[$dep]} ]] || continue
+			else
+				if [[ ! ${current[$dep]} ]]; then
+					current[$dep]=no
+					if dag_current $dep; then
+						current[$dep]=yes
+					fi
+				fi
+				[[ ${current[$dep]} == no ]] || continue
+			fi
+			needed[$name]=1
+			changed=1
+			break
+		done
+	done
+done
+for name in "${!DAG_TRANSIENT[@]}"; do
+	if [[ ${state[$name]} && ! ${needed[$name]} ]]; then
+		echo "Stage $name not needed. Skipping"
+		echo "# skipped $name (not needed)" >> $LF
+		if [[ $TIMELOG ]]; then
+			time_record skip $name
+		fi
+		state[$name]=done
+	fi
+done
+}
+
+kill_tree()
+{
+local c
+for c in `pgrep -P $1`; do
+	kill_tree $c
+done
+kill $1 2> /dev/null || true
+}
+
+dag_run()
+{
+# dag_run: run the registered stages under a budget of $DWIQAC_NTHREADS
+# threads (default: all cores), each as soon as its dependencies are done.
+# On the first failure the running stages are killed and 1 is returned
+local budget=${DWIQAC_NTHREADS:-`nproc`} free name dep ready cpus rc running failed=""
+local dagdir=`mktemp -d`
+local -A state pid used
+free=$budget
+for name in "${DAG_NAMES[@]}"; do
+	state[$name]=wait
+done
+dag_prune
+while :; do
+	for name in "${DAG_NAMES[@]}"; do
+		[[ ${state[$name]} == wait ]] || continue
+		ready=1
+		for dep in ${DAG_DEPS[$name]}; do
+			if [[ ${state[$dep]} && ${state[$dep]} != done ]]; then
+				ready=""
+				break
+			fi
+		done
+		cpus=${DAG_CPUS[$name]}
+		(( cpus <= budget )) || cpus=$budget
+		if [[ ! $ready ]] || (( cpus > free )); then
+			continue
+		fi
+		echo "Starting stage $name ($cpus threads)"
+		{ set +e; (set -e; set_threads $cpus; eval "${DAG_JOB[$name]}"); echo $? > $dagdir/$name.rc; } &
+		pid[$name]=$!
+		used[$name]=$cpus
+		state[$name]=run
+		free=$(( free-cpus ))
+	done
+	running=""
+	for name in "${DAG_NAMES[@]}"; do
+		[[ ${state[$name]} == run ]] && running="$running $name"
+	done
+	[[ $running ]] || break
+	wait -n || true
+	for name in $running; do
+		if [[ -f $dagdir/$name.rc ]]; then
+			wait ${pid[$name]} || true
+			rc=`cat $dagdir/$name.rc`
+		elif kill -0 ${pid[$name]} 2> /dev/null; then
+			continue
+		else
+			# killed before recording its exit code
+			rc=1
+		fi
+		free=$(( free+used[$name] ))
+		if [[ $rc == 0 ]]; then
+			state[$name]=done
+		else
+			state[$name]=failed
+			failed="$failed $name"
+		fi
+	done
+	if [[ $failed ]]; then
+		echo "ERROR: stage(s)$failed failed, stopping"
+		for name in "${DAG_NAMES[@]}"; do
+			if [[ ${state[$name]} == run ]]; then
+				kill_tree ${pid[$name]}
+				echo "Stage $name stopped"
+			fi
+		done
+		wait || true
+		rm -rf $dagdir
+		return 1
+	fi
+done
+rm -rf $dagdir
+for name in "${DAG_NAMES[@]}"; do
+	if [[ ${state[$name]} != done ]]; then
+		echo "ERROR: stage $name not run, dependencies: ${DAG_DEPS[$name]}"
+		return 1
+	fi
+done
+DAG_NAMES=()
+DAG_DEPS=() DAG_CPUS=() DAG_JOB=() DAG_TRANSIENT=()
+}